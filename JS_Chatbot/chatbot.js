@@ -1,6 +1,9 @@
 document.addEventListener('DOMContentLoaded', () => {
 
     const API_BASE_URL = "https://chatbotapi.quandoiai.vn";
+    // Nhận câu trả lời dạng stream (SSE) qua /chat-stream; nếu proxy chưa có route này thì tự quay về /chat
+    const STREAMING_ENABLED = true;
+    let streamingAvailable = STREAMING_ENABLED;
 
     let sessionId = null;
     let customerId = null;
@@ -191,6 +194,90 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    function createStreamingBotMessage() {
+        const messagesContainer = document.querySelector('.chatbot-messages');
+        const botMessageElement = document.createElement('div');
+        botMessageElement.className = 'message bot-message streaming-message';
+        const textElement = document.createElement('p');
+        botMessageElement.appendChild(textElement);
+        messagesContainer.appendChild(botMessageElement);
+
+        let text = '';
+        return {
+            append(chunk) {
+                text += chunk;
+                textElement.innerHTML = linkify(text).replace(/\n/g, '<br>');
+                messagesContainer.scrollTop = messagesContainer.scrollHeight;
+            },
+            remove() {
+                botMessageElement.remove();
+            }
+        };
+    }
+
+    function handleFinalResponse(responseData) {
+        if (responseData.action_data && responseData.action_data.action === 'redirect') {
+            displayBotResponse(responseData);
+            sessionStorage.setItem('chatbot_should_be_open', 'true');
+            setTimeout(() => {
+                window.location.href = responseData.action_data.url;
+            }, 300);
+            return;
+        }
+
+        displayBotResponse(responseData);
+    }
+
+    async function readEventStream(response, typingIndicator) {
+        // Đọc text/event-stream: hiển thị dần các event "token", event "done" chứa phản hồi đầy đủ
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let streamingMessage = null;
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let separatorIndex;
+            while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, separatorIndex);
+                buffer = buffer.slice(separatorIndex + 2);
+
+                let eventName = 'message';
+                let data = '';
+                rawEvent.split('\n').forEach(line => {
+                    if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                    else if (line.startsWith('data:')) data += line.slice(5).trim();
+                });
+                if (!data) continue;
+                const payload = JSON.parse(data);
+
+                if (eventName === 'token') {
+                    if (!streamingMessage) {
+                        typingIndicator.remove();
+                        streamingMessage = createStreamingBotMessage();
+                    }
+                    streamingMessage.append(payload.text);
+                } else if (eventName === 'done') {
+                    typingIndicator.remove();
+                    if (streamingMessage) streamingMessage.remove();
+                    handleFinalResponse(payload);
+                    return;
+                } else if (eventName === 'error') {
+                    typingIndicator.remove();
+                    if (streamingMessage) streamingMessage.remove();
+                    displayBotResponse({ reply: `Có lỗi xảy ra: ${payload.detail || 'Lỗi không xác định'}` });
+                    return;
+                }
+            }
+        }
+
+        typingIndicator.remove();
+        if (streamingMessage) saveMessagesToSession();
+    }
+
     async function sendMessageToApi(messageText) {
         const messagesContainer = document.querySelector('.chatbot-messages');
         const typingIndicator = document.createElement('div');
@@ -199,14 +286,39 @@ document.addEventListener('DOMContentLoaded', () => {
         messagesContainer.appendChild(typingIndicator);
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
 
+        const body = JSON.stringify({ message: messageText, model_choice: "gemini", mode: "json" });
         try {
-            const response = await fetch(`${API_BASE_URL}/chat?session_id=${sessionId}`, {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({ message: messageText, model_choice: "gemini", mode: "json" })
-            });
+            let response = null;
+            if (streamingAvailable) {
+                response = await fetch(`${API_BASE_URL}/chat-stream?session_id=${sessionId}`, {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                        'Accept': 'text/event-stream',
+                    },
+                    body
+                });
+
+                const contentType = response.headers.get('Content-Type') || '';
+                if (response.ok && contentType.includes('text/event-stream') && response.body) {
+                    await readEventStream(response, typingIndicator);
+                    return;
+                }
+                if (response.status === 404 || response.status === 405) {
+                    // Proxy không có route stream: dùng /chat cho các tin nhắn sau
+                    streamingAvailable = false;
+                }
+            }
+
+            if (!response || !response.ok) {
+                response = await fetch(`${API_BASE_URL}/chat?session_id=${sessionId}`, {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    body
+                });
+            }
 
             typingIndicator.remove();
             const responseData = await response.json();
@@ -216,17 +328,8 @@ document.addEventListener('DOMContentLoaded', () => {
                 displayBotResponse({ reply: `Có lỗi xảy ra: ${errorMessage}` });
                 return;
             }
-            if (responseData.action_data && responseData.action_data.action === 'redirect') {
-                displayBotResponse(responseData);
-                sessionStorage.setItem('chatbot_should_be_open', 'true');
-                setTimeout(() => {
-                    window.location.href = responseData.action_data.url;
-                }, 300);
-    
-                return;
-            }
-            
-            displayBotResponse(responseData);
+
+            handleFinalResponse(responseData);
         } catch (error) {
             if(document.querySelector('.typing-indicator')) {
                 document.querySelector('.typing-indicator').remove();
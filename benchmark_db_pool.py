@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Benchmark đọc lịch sử chat đồng thời trên database thật (đường nóng của chat_endpoint).
+So sánh các cách: Session đồng bộ gọi thẳng trong event loop (cách cũ), Session đồng bộ qua asyncio.to_thread,
+AsyncSession với truy vấn async (asyncpg) và AsyncSession chạy hàm đồng bộ qua run_db/run_sync (cách lượt chat gọi
+phần lớn các hàm database khi bật DB_ASYNC_ENABLED). Đo thông lượng, độ trễ và độ trễ lớn nhất của event loop.
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from src.config.settings import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_STATEMENT_TIMEOUT_MS
+from database.database import SessionLocal, get_chat_history
+import database.async_database as async_database
+
+HEARTBEAT_INTERVAL = 0.005
+
+async def _heartbeat(stop: asyncio.Event, lags: list):
+    """Đo độ trễ của event loop: sleep cố định rồi so với thời gian thực tế trôi qua."""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        lags.append((time.perf_counter() - start - HEARTBEAT_INTERVAL) * 1000)
+
+def _read_sync(customer_id: str, thread_id: str, limit: int):
+    db = SessionLocal()
+    try:
+        return get_chat_history(db, customer_id, thread_id, limit=limit)
+    finally:
+        db.close()
+
+async def _read_blocking(customer_id: str, thread_id: str, limit: int):
+    return _read_sync(customer_id, thread_id, limit)
+
+async def _read_thread(customer_id: str, thread_id: str, limit: int):
+    return await asyncio.to_thread(_read_sync, customer_id, thread_id, limit)
+
+async def _read_async(customer_id: str, thread_id: str, limit: int):
+    async with async_database.AsyncSessionLocal() as db:
+        return await async_database.get_chat_history_async(db, customer_id, thread_id, limit=limit)
+
+async def _read_run_sync(customer_id: str, thread_id: str, limit: int):
+    async with async_database.AsyncSessionLocal() as db:
+        return await async_database.run_db(db, get_chat_history, customer_id, thread_id, limit=limit)
+
+async def _run(reader, concurrency: int, total: int, customer_id: str, thread_id: str, limit: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+
+    async def one_request():
+        async with semaphore:
+            start = time.perf_counter()
+            await reader(customer_id, thread_id, limit)
+            timings.append((time.perf_counter() - start) * 1000)
+
+    stop = asyncio.Event()
+    lags = []
+    heartbeat = asyncio.create_task(_heartbeat(stop, lags))
+    start = time.perf_counter()
+    await asyncio.gather(*(one_request() for _ in range(total)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await heartbeat
+
+    timings.sort()
+    return {
+        "rps": total / elapsed,
+        "p50": statistics.median(timings),
+        "p95": timings[max(0, int(len(timings) * 0.95) - 1)],
+        "max_lag": max(lags) if lags else 0.0,
+    }
+
+async def main(modes: list, concurrency: int, total: int, customer_id: str, thread_id: str, limit: int):
+    readers = {"sync": _read_blocking, "thread": _read_thread, "async": _read_async, "run_sync": _read_run_sync}
+    if "async" in modes or "run_sync" in modes:
+        async_database.init_async_engine(force=True)
+
+    print(f"⏱️ Pool: size={DB_POOL_SIZE}, overflow={DB_MAX_OVERFLOW}, statement_timeout={DB_STATEMENT_TIMEOUT_MS}ms")
+    print(f"   {total} lượt đọc {limit} tin nhắn của {customer_id}/{thread_id}, đồng thời {concurrency}")
+    try:
+        for mode in modes:
+            # Làm nóng pool để không tính thời gian mở kết nối lần đầu
+            await readers[mode](customer_id, thread_id, limit)
+            result = await _run(readers[mode], concurrency, total, customer_id, thread_id, limit)
+            print(f"  {mode:<8} {result['rps']:8.1f} req/s  p50={result['p50']:7.1f}ms  p95={result['p95']:7.1f}ms  "
+                  f"event loop trễ tối đa={result['max_lag']:7.1f}ms")
+    finally:
+        await async_database.close_async_engine()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark đọc lịch sử chat đồng thời: Session đồng bộ và AsyncSession.")
+    parser.add_argument("--customer-id", required=True)
+    parser.add_argument("--thread-id", required=True)
+    parser.add_argument("--limit", type=int, default=50, help="Số tin nhắn mỗi lượt đọc (chat dùng 12 và 50)")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=1000)
+    modes = ["sync", "thread", "async", "run_sync"]
+    parser.add_argument("--modes", nargs="+", choices=modes, default=modes)
+    args = parser.parse_args()
+    asyncio.run(main(args.modes, args.concurrency, args.requests, args.customer_id, args.thread_id, args.limit))
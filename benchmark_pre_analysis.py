@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Benchmark giai đoạn phân tích trước (pre-analysis) của chat_endpoint với LLM giả lập.
+So sánh cách gọi tuần tự cũ (ý định rồi mới tới "xem thêm") với _run_pre_analysis chạy song song.
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+import src.api.chat_routes as chat_routes
+
+def _make_stubs(intent_latency: float, more_latency: float, purchase: bool):
+    """Tạo các hàm giả lập có độ trễ cố định thay cho lệnh gọi LLM thật."""
+    async def fake_analyze_intent(user_query, history=None, model_choice="gemini", api_key=None):
+        await asyncio.sleep(intent_latency)
+        return {"is_purchase_intent": purchase, "needs_search": not purchase, "search_params": {"products": []}}
+
+    async def fake_is_asking_for_more(user_query, history_text, api_key=None):
+        await asyncio.sleep(more_latency)
+        return False
+
+    return fake_analyze_intent, fake_is_asking_for_more
+
+async def _sequential(user_query: str, history: list):
+    analysis_result = await chat_routes.analyze_intent_and_extract_entities(user_query, history, "gemini", api_key="stub")
+    history_text = chat_routes.format_history_text(history, limit=4)
+    asking_for_more = await chat_routes.is_asking_for_more(user_query, history_text, api_key="stub")
+    return analysis_result, asking_for_more
+
+async def _concurrent(user_query: str, history: list):
+    return await chat_routes._run_pre_analysis(user_query, history, "gemini", "stub")
+
+async def _measure(runner, rounds: int) -> list:
+    history = [{"user": "shop có máy hàn không", "bot": "Dạ bên em có máy hàn ạ."}]
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        await runner("còn loại nào khác không", history)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+async def main(rounds: int, intent_latency: float, more_latency: float, purchase: bool):
+    fake_intent, fake_more = _make_stubs(intent_latency, more_latency, purchase)
+    chat_routes.analyze_intent_and_extract_entities = fake_intent
+    chat_routes.is_asking_for_more = fake_more
+
+    print(f"⏱️ LLM giả lập: intent={intent_latency * 1000:.0f}ms, xem thêm={more_latency * 1000:.0f}ms, {rounds} lượt")
+    for name, runner in (("Tuần tự", _sequential), ("Song song", _concurrent)):
+        timings = await _measure(runner, rounds)
+        print(f"  {name:<10} p50={statistics.median(timings):8.1f}ms  max={max(timings):8.1f}ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark giai đoạn pre-analysis của chat_endpoint.")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--intent-latency", type=float, default=1.2, help="Độ trễ giả lập của phân tích ý định (giây)")
+    parser.add_argument("--more-latency", type=float, default=0.8, help="Độ trễ giả lập của is_asking_for_more (giây)")
+    parser.add_argument("--purchase", action="store_true", help="Giả lập ý định mua hàng (hủy tác vụ 'xem thêm')")
+    args = parser.parse_args()
+    asyncio.run(main(args.rounds, args.intent_latency, args.more_latency, args.purchase))
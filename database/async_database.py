@@ -0,0 +1,71 @@
+from typing import Any, Callable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+from src.config.settings import (
+    DB_ASYNC_ENABLED, ASYNC_DATABASE_URL,
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_STATEMENT_TIMEOUT_MS
+)
+from database.database import DATABASE_URL, ChatHistory
+
+# AsyncEngine (asyncpg) cho toàn bộ lượt chat: chat_endpoint chạy trên một AsyncSession duy nhất, không lấy thêm
+# kết nối từ engine đồng bộ. Chỉ tạo khi DB_ASYNC_ENABLED (cần cài asyncpg)
+async_engine: Optional[AsyncEngine] = None
+AsyncSessionLocal: Optional[async_sessionmaker] = None
+
+def _async_database_url() -> str:
+    if ASYNC_DATABASE_URL:
+        return ASYNC_DATABASE_URL
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if DATABASE_URL.startswith(prefix):
+            return "postgresql+asyncpg://" + DATABASE_URL[len(prefix):]
+    return DATABASE_URL
+
+def init_async_engine(force: bool = False) -> Optional[AsyncEngine]:
+    """Tạo AsyncEngine dùng chung với cấu hình pool như engine đồng bộ. force=True để tạo kể cả khi tắt DB_ASYNC_ENABLED (benchmark)."""
+    global async_engine, AsyncSessionLocal
+    if async_engine is None and (DB_ASYNC_ENABLED or force):
+        server_settings = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)} if DB_STATEMENT_TIMEOUT_MS > 0 else {}
+        async_engine = create_async_engine(
+            _async_database_url(),
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING,
+            connect_args={"server_settings": server_settings}
+        )
+        AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+    return async_engine
+
+async def close_async_engine():
+    global async_engine, AsyncSessionLocal
+    if async_engine is not None:
+        await async_engine.dispose()
+        async_engine = None
+        AsyncSessionLocal = None
+
+def is_async_db_ready() -> bool:
+    return AsyncSessionLocal is not None
+
+async def run_db(db, func: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Gọi hàm database đồng bộ func(session, *args, **kwargs) với db là Session hoặc AsyncSession.
+    Với AsyncSession, hàm chạy qua run_sync: vẫn là code ORM đồng bộ nhưng truy vấn đi qua asyncpg, không chặn event loop.
+    """
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(lambda session: func(session, *args, **kwargs))
+    return func(db, *args, **kwargs)
+
+async def get_chat_history_async(db: AsyncSession, customer_id: str, thread_id: str, limit: int = 20):
+    """Giống get_chat_history nhưng chạy trên AsyncSession: lấy `limit` tin nhắn gần nhất, trả về theo thứ tự thời gian."""
+    result = await db.execute(
+        select(ChatHistory).where(
+            ChatHistory.customer_id == customer_id,
+            ChatHistory.thread_id == thread_id
+        ).order_by(ChatHistory.created_at.desc(), ChatHistory.id.desc()).limit(limit)
+    )
+    history_records = list(result.scalars().all())
+    history_records.reverse()
+    return history_records
@@ -1,14 +1,29 @@
 import os
-from sqlalchemy import Boolean, create_engine, Column, String, DateTime, Integer, Text, JSON, Float, ForeignKey
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship
-from sqlalchemy.sql import func
+from sqlalchemy import Boolean, create_engine, Column, String, DateTime, Integer, Text, Float, ForeignKey, Index, insert, tuple_, update, cast
+from sqlalchemy.dialects.postgresql import insert as pg_insert, array_agg, aggregate_order_by, JSONB, ARRAY
+from sqlalchemy.orm import sessionmaker, declarative_base, relationship, selectinload, contains_eager
+from sqlalchemy.sql import func, text
 from dotenv import load_dotenv
+from src.config.settings import (
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_STATEMENT_TIMEOUT_MS
+)
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
-
-engine = create_engine(DATABASE_URL)
+# Bật để create_order/add_order_item/update_order_status cập nhật bảng order_status_summaries
+# (chạy migration_add_order_summary.py trước khi bật) và endpoint tóm tắt đơn hàng đọc từ bảng này.
+ORDER_SUMMARY_MATERIALIZED = os.getenv("ORDER_SUMMARY_MATERIALIZED", "false").lower() == "true"
+
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args={"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"} if DB_STATEMENT_TIMEOUT_MS > 0 else {}
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -45,6 +60,14 @@ class ChatbotSettings(Base):
     chatbot_callout = Column(String, nullable=True)
     chatbot_name = Column(String, nullable=True)
 
+class GlobalBotSwitch(Base):
+    """Công tắc bật/tắt bot cho toàn hệ thống (một dòng duy nhất id=1), dùng chung cho mọi worker."""
+    __tablename__ = "global_bot_switch"
+
+    id = Column(Integer, primary_key=True, default=1)
+    running = Column(Boolean, nullable=False, default=True)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
 class BotStatus(Base):
     __tablename__ = "bot_status"
 
@@ -61,10 +84,23 @@ class SessionControl(Base):
     session_id = Column(String, nullable=False, index=True)
     session_name = Column(String, nullable=True)
     status = Column(String, nullable=False, default="active")  # active, stopped, human_chatting
-    session_data = Column(JSON, nullable=True)
+    session_data = Column(JSONB, nullable=True)  # migration_session_data_jsonb.py chuyển cột cũ (JSON) sang JSONB
+    # Tách từ session_data để truy vấn/cập nhật không cần đọc/ghi cả khối JSON (ghi song song với session_data)
+    state = Column(String, nullable=True, index=True)                 # session_data["state"]
+    handover_timestamp = Column(Float, nullable=True, index=True)     # Mốc handover đang hiệu lực (chỉ khi state là human_calling/human_chatting)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
+HANDOVER_STATUSES = ("human_calling", "human_chatting")
+
+def session_state_columns(session_data: dict) -> dict:
+    """Giá trị các cột state/handover_timestamp tương ứng với session_data."""
+    state = session_data.get("state")
+    return {
+        "state": state,
+        "handover_timestamp": session_data.get("handover_timestamp") if state in HANDOVER_STATUSES else None
+    }
+
 class CustomerisSale(Base):
     __tablename__ = "customer_is_sale"
 
@@ -83,6 +119,10 @@ class ChatHistory(Base):
     message = Column(Text, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+# Index phục vụ get_chat_history/get_chat_history_page: lọc theo (customer_id, thread_id), sắp xếp và phân trang keyset theo
+# (created_at DESC, id DESC) đúng thứ tự các truy vấn dùng nên không cần bước sort. Với database đã tồn tại, chạy migration_add_chat_history_index.py.
+Index("ix_chat_history_customer_thread_created", ChatHistory.customer_id, ChatHistory.thread_id, ChatHistory.created_at.desc(), ChatHistory.id.desc())
+
 class CustomerProfile(Base):
     __tablename__ = 'customer_profiles'
 
@@ -215,7 +255,18 @@ class OrderItem(Base):
     
     # Relationship
     order = relationship("Order", back_populates="order_items")
-    
+
+class OrderStatusSummary(Base):
+    """Bảng tổng hợp đơn hàng theo (customer_id, order_status), được cập nhật dần khi tạo/sửa đơn."""
+    __tablename__ = 'order_status_summaries'
+
+    customer_id = Column(String, primary_key=True)            # ID của cửa hàng
+    order_status = Column(String, primary_key=True)
+    order_count = Column(Integer, nullable=False, default=0)  # Số đơn hàng đang ở trạng thái này
+    item_count = Column(Integer, nullable=False, default=0)   # Số dòng sản phẩm của các đơn đó
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
 def init_db():
     Base.metadata.create_all(bind=engine)
 
@@ -227,13 +278,71 @@ def get_db():
         db.close()
 
 # Helper functions for SessionControl
+def diff_session_data(old: dict, new: dict) -> dict:
+    """
+    So sánh hai bản session_data (đã JSON-safe) theo khóa cấp một, trả về patch cho patch_session_control:
+    {"set": {khóa: giá trị mới}, "append": {khóa: phần tử thêm vào cuối list}, "remove": [khóa bị xóa]}.
+    List chỉ dài thêm (như shown_product_keys) được ghi bằng "append" để không gửi lại cả list.
+    """
+    patch = {"set": {}, "append": {}, "remove": [key for key in old if key not in new]}
+    for key, value in new.items():
+        old_value = old.get(key)
+        if key in old and old_value == value:
+            continue
+        if isinstance(value, list) and isinstance(old_value, list) and len(value) > len(old_value) and value[:len(old_value)] == old_value:
+            patch["append"][key] = value[len(old_value):]
+        else:
+            patch["set"][key] = value
+    return patch
+
+def _session_data_patch_expr(patch: dict):
+    """Biểu thức JSONB áp dụng patch lên session_data hiện có: (session_data - remove) || set, rồi nối thêm các list."""
+    expr = func.coalesce(SessionControl.session_data, cast({}, JSONB))
+    if patch["remove"]:
+        expr = expr.op("-", return_type=JSONB)(cast(patch["remove"], ARRAY(Text)))
+    if patch["set"]:
+        expr = expr.op("||", return_type=JSONB)(cast(patch["set"], JSONB))
+    for key, items in patch["append"].items():
+        current = func.coalesce(SessionControl.session_data[key], cast([], JSONB))
+        expr = func.jsonb_set(expr, cast([key], ARRAY(Text)), current.op("||", return_type=JSONB)(cast(items, JSONB)), type_=JSONB)
+    return expr
+
+def patch_session_control(db: SessionLocal, customer_id: str, session_id: str, status: str, patch: dict, session_data: dict, commit: bool = True) -> bool:
+    """
+    Cập nhật session control chỉ với các khóa session_data đã thay đổi (patch từ diff_session_data) thay vì ghi lại cả khối JSON.
+    session_data (bản đầy đủ) chỉ dùng để tính cột state/handover_timestamp.
+    Trả về False nếu session chưa tồn tại (caller cần ghi đầy đủ bằng create_or_update_session_control).
+    """
+    values = {"status": status, "updated_at": func.now(), **session_state_columns(session_data)}
+    if patch["set"] or patch["append"] or patch["remove"]:
+        values["session_data"] = _session_data_patch_expr(patch)
+    result = db.execute(
+        update(SessionControl)
+        .where(SessionControl.id == f"{customer_id}_{session_id}")
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    if commit:
+        db.commit()
+    return result.rowcount > 0
+
 def get_session_control(db: SessionLocal, customer_id: str, session_id: str):
     """Lấy thông tin session control từ database"""
     composite_id = f"{customer_id}_{session_id}"
     return db.query(SessionControl).filter(SessionControl.id == composite_id).first()
 
-def create_or_update_session_control(db: SessionLocal, customer_id: str, session_id: str, status: str, session_name: str = None, session_data: dict = None):
-    """Tạo mới hoặc cập nhật session control"""
+def get_session_control_version(db: SessionLocal, customer_id: str, session_id: str):
+    """Chỉ đọc (status, updated_at) của session control để kiểm tra bản cache còn mới không; None nếu chưa tồn tại."""
+    return db.query(SessionControl.status, SessionControl.updated_at).filter(
+        SessionControl.id == f"{customer_id}_{session_id}"
+    ).first()
+
+def create_or_update_session_control(db: SessionLocal, customer_id: str, session_id: str, status: str, session_name: str = None, session_data: dict = None, write_json: bool = True):
+    """
+    Tạo mới hoặc cập nhật session control.
+    Có session_data thì luôn cập nhật cột state/handover_timestamp; write_json=False để không ghi lại cả khối session_data
+    (dùng khi chỉ state/handover_timestamp thay đổi và SESSION_STATE_SOURCE="columns").
+    """
     composite_id = f"{customer_id}_{session_id}"
     session_control = db.query(SessionControl).filter(SessionControl.id == composite_id).first()
     
@@ -250,6 +359,9 @@ def create_or_update_session_control(db: SessionLocal, customer_id: str, session
         if session_name:
             session_control.session_name = session_name
         if session_data is not None:
+            for column, value in session_state_columns(session_data).items():
+                setattr(session_control, column, value)
+        if session_data is not None and write_json:
             json_safe_data = _make_json_safe(session_data)
             print(f"   📝 JSON safe data state: {json_safe_data.get('state')}")
             session_control.session_data = json_safe_data
@@ -264,7 +376,8 @@ def create_or_update_session_control(db: SessionLocal, customer_id: str, session
             session_id=session_id,
             session_name=session_name,
             status=status,
-            session_data=json_safe_data
+            session_data=json_safe_data,
+            **(session_state_columns(session_data) if session_data is not None else {})
         )
         db.add(session_control)
     
@@ -280,6 +393,14 @@ def get_all_session_controls_by_customer(db: SessionLocal, customer_id: str):
     """Lấy tất cả session controls của một customer"""
     return db.query(SessionControl).filter(SessionControl.customer_id == customer_id).all()
 
+def count_session_controls_by_status(db: SessionLocal, customer_id: str) -> tuple:
+    """Đếm (tổng số session, số session đang stopped) của một customer bằng một truy vấn."""
+    total, stopped = db.query(
+        func.count(SessionControl.id),
+        func.count(SessionControl.id).filter(SessionControl.status == "stopped")
+    ).filter(SessionControl.customer_id == customer_id).one()
+    return total, stopped
+
 def delete_session_control(db: SessionLocal, customer_id: str, session_id: str):
     """Xóa session control"""
     composite_id = f"{customer_id}_{session_id}"
@@ -295,6 +416,10 @@ def get_customer_is_sale(db: SessionLocal, customer_id: str, thread_id: str):
     """Lấy thông tin is_sale của khách hàng"""
     return db.query(CustomerisSale).filter_by(customer_id=customer_id, thread_id=thread_id).first()
 
+def get_customer_sale_info(db: SessionLocal, customer_id: str):
+    """Lấy bản ghi is_sale của customer (mỗi customer_id có tối đa một bản ghi)."""
+    return db.query(CustomerisSale).filter_by(customer_id=customer_id).first()
+
 def create_or_update_customer_is_sale(db: SessionLocal, customer_id: str, thread_id: str, is_sale: bool):
     """Tạo mới hoặc cập nhật trạng thái is_sale của khách hàng"""
     customer_sale_info = get_customer_is_sale(db, customer_id, thread_id)
@@ -339,12 +464,75 @@ def add_chat_message(db: SessionLocal, customer_id: str, thread_id: str, role: s
     db.refresh(chat_message)
     return chat_message
 
+def append_chat_turn(db: SessionLocal, customer_id: str, thread_id: str, user_message: str, bot_message: str, status: str = None, session_data: dict = None, thread_name: str = None, write_json: bool = True, session_data_patch: dict = None) -> list:
+    """
+    Ghi một lượt chat trong một transaction duy nhất (một lần commit):
+    - Chèn tin nhắn user và bot bằng một câu INSERT nhiều dòng ... RETURNING id (bỏ qua tin nhắn rỗng như add_chat_message).
+    - Nếu có status: upsert session control (INSERT ... ON CONFLICT DO UPDATE), session_data None thì giữ nguyên dữ liệu cũ.
+      Cột state/handover_timestamp đi theo session_data; write_json như create_or_update_session_control.
+      Có session_data_patch (session đã tồn tại) thì chỉ cập nhật các khóa thay đổi như patch_session_control.
+    Hai tin nhắn có cùng created_at (thời điểm bắt đầu transaction) nên thứ tự được giữ bằng id.
+    Trả về danh sách id các tin nhắn đã chèn.
+    """
+    rows = [
+        {"customer_id": customer_id, "thread_id": thread_id, "thread_name": thread_name, "role": role, "message": message}
+        for role, message in (("user", user_message), ("bot", bot_message))
+        if message and message.strip()
+    ]
+    try:
+        inserted_ids = []
+        if rows:
+            result = db.execute(insert(ChatHistory).values(rows).returning(ChatHistory.id))
+            inserted_ids = [row[0] for row in result]
+
+        patched = status is not None and session_data_patch is not None and patch_session_control(
+            db, customer_id, thread_id, status, session_data_patch, session_data, commit=False
+        )
+        if status is not None and not patched:
+            state_columns = session_state_columns(session_data) if session_data is not None else {}
+            stmt = pg_insert(SessionControl).values(
+                id=f"{customer_id}_{thread_id}",
+                customer_id=customer_id,
+                session_id=thread_id,
+                status=status,
+                session_data=_make_json_safe(session_data) if session_data is not None else None,
+                **state_columns
+            )
+            update_values = {"status": stmt.excluded.status, "updated_at": func.now()}
+            for column in state_columns:
+                update_values[column] = stmt.excluded[column]
+            if session_data is not None and write_json:
+                update_values["session_data"] = stmt.excluded.session_data
+            db.execute(stmt.on_conflict_do_update(index_elements=[SessionControl.id], set_=update_values))
+
+        db.commit()
+        return inserted_ids
+    except Exception:
+        db.rollback()
+        raise
+
 def get_chat_history(db: SessionLocal, customer_id: str, thread_id: str, limit: int = 20):
     """Lấy lịch sử chat từ database, sắp xếp theo thời gian gần nhất"""
     history_records = db.query(ChatHistory).filter(
         ChatHistory.customer_id == customer_id,
         ChatHistory.thread_id == thread_id
-    ).order_by(ChatHistory.created_at.desc()).limit(limit).all()
+    ).order_by(ChatHistory.created_at.desc(), ChatHistory.id.desc()).limit(limit).all()
+    history_records.reverse()
+    return history_records
+
+def get_chat_history_page(db: SessionLocal, customer_id: str, thread_id: str, before_id: int = None, limit: int = 50):
+    """
+    Lấy một trang lịch sử chat theo keyset (created_at, id): tối đa `limit` tin nhắn ngay trước tin nhắn before_id
+    (hoặc mới nhất nếu không có before_id), trả về theo thứ tự thời gian tăng dần.
+    """
+    query = db.query(ChatHistory).filter(
+        ChatHistory.customer_id == customer_id,
+        ChatHistory.thread_id == thread_id
+    )
+    if before_id is not None:
+        cursor_created_at = db.query(ChatHistory.created_at).filter(ChatHistory.id == before_id).scalar_subquery()
+        query = query.filter(tuple_(ChatHistory.created_at, ChatHistory.id) < tuple_(cursor_created_at, before_id))
+    history_records = query.order_by(ChatHistory.created_at.desc(), ChatHistory.id.desc()).limit(limit).all()
     history_records.reverse()
     return history_records
 
@@ -353,28 +541,22 @@ def get_full_chat_history(db: SessionLocal, customer_id: str, thread_id: str):
     return db.query(ChatHistory).filter(
         ChatHistory.customer_id == customer_id,
         ChatHistory.thread_id == thread_id
-    ).order_by(ChatHistory.created_at.desc()).all()
-
-def get_sessions_for_timeout_check(db: SessionLocal):
-    """Lấy các session đang ở trạng thái cần handover để kiểm tra timeout."""
-    # Lấy tất cả sessions có status là human_calling hoặc human_chatting
-    sessions = db.query(SessionControl).filter(
-        SessionControl.status.in_(["human_calling", "human_chatting"])
-    ).all()
-    
-    # Filter thêm theo session_data.state nếu cần
-    filtered_sessions = []
-    if not sessions:
-        sessions = db.query(SessionControl).all()
-        for session in sessions:
-            session_data = session.session_data or {}
-            state = session_data.get("state")
-            
-            # Chỉ lấy sessions có state là human_calling hoặc human_chatting
-            if state in ["human_calling", "human_chatting"]:
-                filtered_sessions.append(session)
-    
-    return filtered_sessions
+    ).order_by(ChatHistory.created_at.desc(), ChatHistory.id.desc()).all()
+
+def get_pending_handovers(db: SessionLocal, due_before: float = None):
+    """
+    Các session đang chờ/đang chat với nhân viên có mốc handover, dạng (customer_id, session_id, handover_timestamp).
+    Truy vấn khoảng trên index handover_timestamp, không đọc session_data. due_before: chỉ lấy handover_timestamp <= due_before.
+    Lọc theo cột state (handover do khách yêu cầu có status "active"), bỏ qua session admin đã dừng.
+    """
+    query = db.query(SessionControl.customer_id, SessionControl.session_id, SessionControl.handover_timestamp).filter(
+        SessionControl.handover_timestamp.isnot(None),
+        SessionControl.state.in_(HANDOVER_STATUSES),
+        SessionControl.status != "stopped"
+    )
+    if due_before is not None:
+        query = query.filter(SessionControl.handover_timestamp <= due_before)
+    return query.order_by(SessionControl.handover_timestamp).all()
 
 # Helper functions for ChatbotSettings
 def get_chatbot_settings(db: SessionLocal, customer_id: str):
@@ -519,6 +701,8 @@ def create_order(db: SessionLocal, customer_profile_id: int, customer_id: str, s
         notes=notes
     )
     db.add(order)
+    if ORDER_SUMMARY_MATERIALIZED:
+        _bump_order_summary(db, customer_id, order_status, orders_delta=1)
     db.commit()
     db.refresh(order)
     return order
@@ -527,15 +711,126 @@ def get_orders_by_customer_profile(db: SessionLocal, customer_profile_id: int):
     """Lấy tất cả đơn hàng của một customer profile"""
     return db.query(Order).filter(Order.customer_profile_id == customer_profile_id).order_by(Order.created_at.desc()).all()
 
+def get_orders_page(db: SessionLocal, customer_id: str, session_id: str = None, status: str = None,
+                    cursor: int = None, limit: int = None):
+    """
+    Lấy đơn hàng của customer (mới nhất trước) kèm customer profile và order items trong một lượt:
+    profile được JOIN sẵn, order items nạp bằng selectinload (1 truy vấn IN cho cả trang).
+    - session_id/status: lọc tùy chọn.
+    - cursor: id đơn hàng cuối của trang trước (phân trang keyset theo (created_at, id)); limit None để lấy tất cả.
+    """
+    query = db.query(Order).join(Order.customer_profile).options(
+        contains_eager(Order.customer_profile),
+        selectinload(Order.order_items)
+    ).filter(CustomerProfile.customer_id == customer_id)
+    if session_id:
+        query = query.filter(CustomerProfile.session_id == session_id)
+    if status:
+        query = query.filter(Order.order_status == status)
+    if cursor is not None:
+        cursor_created_at = db.query(Order.created_at).filter(Order.id == cursor).scalar_subquery()
+        query = query.filter(tuple_(Order.created_at, Order.id) < tuple_(cursor_created_at, cursor))
+    query = query.order_by(Order.created_at.desc(), Order.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+def get_orders_summary(db: SessionLocal, customer_id: str) -> dict:
+    """
+    Tóm tắt đơn hàng của customer bằng một truy vấn GROUP BY order_status:
+    số đơn và số dòng sản phẩm theo từng trạng thái, tổng toàn bộ (window function) và đơn hàng mới nhất.
+    Trả về {"orders_by_status": {...}, "items_by_status": {...}, "total_orders", "total_items", "latest_order"}.
+    """
+    items_per_order = db.query(
+        OrderItem.order_id,
+        func.count(OrderItem.id).label("item_count")
+    ).group_by(OrderItem.order_id).subquery()
+
+    order_count = func.count(Order.id)
+    item_count = func.coalesce(func.sum(items_per_order.c.item_count), 0)
+    rows = db.query(
+        Order.order_status,
+        order_count,
+        item_count,
+        func.sum(order_count).over(),
+        func.sum(item_count).over(),
+        func.max(Order.created_at),
+        array_agg(aggregate_order_by(Order.id, Order.created_at.desc(), Order.id.desc()))[1]
+    ).outerjoin(
+        items_per_order, items_per_order.c.order_id == Order.id
+    ).filter(Order.customer_id == customer_id).group_by(Order.order_status).all()
+
+    summary = {"orders_by_status": {}, "items_by_status": {}, "total_orders": 0, "total_items": 0, "latest_order": None}
+    latest_created_at = None
+    for status, orders, items, total_orders, total_items, max_created_at, latest_id in rows:
+        summary["orders_by_status"][status] = orders
+        summary["items_by_status"][status] = int(items)
+        summary["total_orders"] = int(total_orders)
+        summary["total_items"] = int(total_items)
+        if max_created_at and (latest_created_at is None or max_created_at > latest_created_at):
+            latest_created_at = max_created_at
+            summary["latest_order"] = {"id": latest_id, "created_at": max_created_at, "status": status}
+    return summary
+
+def _bump_order_summary(db: SessionLocal, customer_id: str, order_status: str, orders_delta: int = 0, items_delta: int = 0):
+    """Cộng dồn vào bảng order_status_summaries trong transaction hiện tại (caller commit)."""
+    stmt = pg_insert(OrderStatusSummary).values(
+        customer_id=customer_id,
+        order_status=order_status,
+        order_count=orders_delta,
+        item_count=items_delta
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[OrderStatusSummary.customer_id, OrderStatusSummary.order_status],
+        set_={
+            "order_count": OrderStatusSummary.order_count + stmt.excluded.order_count,
+            "item_count": OrderStatusSummary.item_count + stmt.excluded.item_count,
+            "updated_at": func.now()
+        }
+    )
+    db.execute(stmt)
+
+def get_materialized_orders_summary(db: SessionLocal, customer_id: str) -> dict:
+    """Giống get_orders_summary nhưng đọc số liệu từ bảng order_status_summaries (chỉ đơn mới nhất là truy vấn orders)."""
+    rows = db.query(OrderStatusSummary).filter(OrderStatusSummary.customer_id == customer_id).all()
+    latest_order = db.query(Order.id, Order.created_at, Order.order_status).filter(
+        Order.customer_id == customer_id
+    ).order_by(Order.created_at.desc(), Order.id.desc()).first()
+    return {
+        "orders_by_status": {row.order_status: row.order_count for row in rows if row.order_count},
+        "items_by_status": {row.order_status: row.item_count for row in rows if row.order_count},
+        "total_orders": sum(row.order_count for row in rows),
+        "total_items": sum(row.item_count for row in rows),
+        "latest_order": {
+            "id": latest_order.id,
+            "created_at": latest_order.created_at,
+            "status": latest_order.order_status
+        } if latest_order else None
+    }
+
 def get_order_by_id(db: SessionLocal, order_id: int):
     """Lấy đơn hàng theo ID"""
     return db.query(Order).filter(Order.id == order_id).first()
 
+def _get_order_for_summary(db: SessionLocal, order_id: int):
+    """
+    Đọc đơn hàng để cập nhật order_status_summaries. Khi bật ORDER_SUMMARY_MATERIALIZED thì khóa dòng (SELECT ... FOR UPDATE)
+    tới hết transaction, để hai request đồng thời không cùng trừ/cộng vào bucket của một trạng thái cũ.
+    """
+    if not ORDER_SUMMARY_MATERIALIZED:
+        return get_order_by_id(db, order_id)
+    return db.query(Order).filter(Order.id == order_id).populate_existing().with_for_update().first()
+
 def update_order_status(db: SessionLocal, order_id: int, status: str):
     """Cập nhật trạng thái đơn hàng"""
-    order = get_order_by_id(db, order_id)
+    order = _get_order_for_summary(db, order_id)
     if order:
+        old_status = order.order_status
         order.order_status = status
+        if ORDER_SUMMARY_MATERIALIZED and old_status != status:
+            item_count = db.query(func.count(OrderItem.id)).filter(OrderItem.order_id == order.id).scalar() or 0
+            _bump_order_summary(db, order.customer_id, old_status, orders_delta=-1, items_delta=-item_count)
+            _bump_order_summary(db, order.customer_id, status, orders_delta=1, items_delta=item_count)
         db.commit()
         db.refresh(order)
     return order
@@ -553,6 +848,10 @@ def add_order_item(db: SessionLocal, order_id: int, product_name: str, propertie
         total_price=total_price
     )
     db.add(order_item)
+    if ORDER_SUMMARY_MATERIALIZED:
+        order = _get_order_for_summary(db, order_id)
+        if order:
+            _bump_order_summary(db, order.customer_id, order.order_status, items_delta=1)
     db.commit()
     db.refresh(order_item)
     return order_item
@@ -698,6 +997,24 @@ def create_or_update_bot_status(db: SessionLocal, customer_id: str, status: str)
     db.refresh(bot_status)
     return bot_status
 
+# Kênh LISTEN/NOTIFY báo cho các worker khi công tắc bot toàn hệ thống thay đổi (payload "on"/"off")
+BOT_SWITCH_CHANNEL = "bot_switch"
+
+def get_global_bot_running(db: SessionLocal) -> bool:
+    """Đọc công tắc bot toàn hệ thống, mặc định là đang chạy nếu chưa có bản ghi."""
+    switch = db.query(GlobalBotSwitch).filter(GlobalBotSwitch.id == 1).first()
+    return switch.running if switch else True
+
+def set_global_bot_running(db: SessionLocal, running: bool):
+    """Bật/tắt bot toàn hệ thống và NOTIFY các worker trong cùng transaction (thông báo gửi đi khi commit)."""
+    stmt = pg_insert(GlobalBotSwitch).values(id=1, running=running)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[GlobalBotSwitch.id],
+        set_={"running": stmt.excluded.running, "updated_at": func.now()}
+    ))
+    db.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": BOT_SWITCH_CHANNEL, "payload": "on" if running else "off"})
+    db.commit()
+
 def is_bot_active(db: SessionLocal, customer_id: str):
     """Kiểm tra bot có đang active không"""
     bot_status = get_bot_status(db, customer_id)
@@ -1,6 +1,7 @@
 from elasticsearch import AsyncElasticsearch
-from src.config.settings import ELASTIC_HOST
+from src.config.settings import ELASTIC_HOST, ES_CONNECTIONS_PER_NODE
 from database.database import SessionLocal
+import database.async_database as async_database
 from elastic_search_push_data import ensure_shared_indices_exist
 
 
@@ -14,7 +15,7 @@ async def init_es_client():
     if es_client is None:
         try:
             print(f"🔌 Connecting to Elasticsearch at {ELASTIC_HOST}...")
-            es_client = AsyncElasticsearch(hosts=[ELASTIC_HOST])
+            es_client = AsyncElasticsearch(hosts=[ELASTIC_HOST], connections_per_node=ES_CONNECTIONS_PER_NODE)
             if not await es_client.ping():
                 raise ConnectionError("Could not connect to Elasticsearch")
             print("✅ Successfully connected to Elasticsearch!")
@@ -52,4 +53,19 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_chat_db():
+    """
+    Dependency provider cho lượt chat: AsyncSession khi đã bật DB_ASYNC_ENABLED (mọi truy vấn của lượt chat
+    đi qua asyncpg, không lấy kết nối từ pool đồng bộ), nếu không thì Session đồng bộ như get_db.
+    """
+    if async_database.is_async_db_ready():
+        async with async_database.AsyncSessionLocal() as db:
+            yield db
+        return
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Đánh giá bộ phân loại nhanh bằng luật (fast-path) trong intent_service trên tập mẫu có gán nhãn.
+
+Mỗi dòng của corpus (mặc định intent_fast_path_corpus.jsonl) có dạng:
+{"kind": "intent" | "confirmation" | "customer_info", "query": "...", "history": [...], "state": ..., "label": ...}
+- state (tùy chọn, chỉ dùng cho "intent"): session_data["state"] lúc khách gửi câu này.
+- label là kết quả mong đợi khi luật được phép xử lý (các cờ ý định / "CONFIRM"|"CANCEL" / {"phone": ...}),
+  hoặc null nếu câu này phải được chuyển cho LLM.
+
+Mặc định chỉ chạy luật (không tốn token). Với --with-llm, script gọi thêm LLM thật (tắt fast-path và cache)
+để đo mức trùng khớp giữa luật và LLM cùng thời gian tiết kiệm được.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import src.services.intent_service as intent_service
+import src.services.response_service as response_service
+
+def _load_corpus(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def _run_rules(sample: dict):
+    """Chạy luật tương ứng với loại mẫu, trả về kết quả đã chuẩn hóa để so sánh hoặc None nếu nhường cho LLM."""
+    kind, query = sample["kind"], sample["query"]
+    if kind == "intent":
+        result = intent_service.classify_intent_fast(query, sample.get("history"), sample.get("state"))
+    elif kind == "confirmation":
+        result = intent_service.classify_purchase_confirmation_fast(query)
+    else:
+        result = intent_service.extract_customer_info_fast(query)
+    return result if intent_service.accept_fast_path(result) else None
+
+def _matches(kind: str, result, label) -> bool:
+    if result is None or label is None:
+        return result is None and label is None
+    if kind == "confirmation":
+        label = {"decision": label}
+    return all(result.get(key) == value for key, value in label.items())
+
+def _history_text(history: list) -> str:
+    return "".join(f"Khách: {turn['user']}\nBot: {turn['bot']}\n" for turn in history or [])
+
+async def _run_llm(sample: dict, model_choice: str, api_key: str):
+    kind, query = sample["kind"], sample["query"]
+    if kind == "intent":
+        return await intent_service.analyze_intent_and_extract_entities(
+            query, sample.get("history"), model_choice, api_key=api_key, pending_state=sample.get("state")
+        )
+    if kind == "confirmation":
+        history_text = _history_text(sample.get("history"))
+        return await response_service.evaluate_purchase_confirmation(query, history_text, model_choice, api_key=api_key)
+    return await intent_service.extract_customer_info(query, model_choice, api_key=api_key)
+
+async def main(path: str, with_llm: bool, model_choice: str, api_key: str):
+    samples = _load_corpus(path)
+    hits = correct = false_positives = 0
+    rule_results = []
+    start = time.perf_counter()
+    for sample in samples:
+        result = _run_rules(sample)
+        rule_results.append(result)
+        if result is not None:
+            hits += 1
+            if sample["label"] is None:
+                false_positives += 1
+        if _matches(sample["kind"], result, sample["label"]):
+            correct += 1
+        else:
+            print(f"❌ [{sample['kind']}] {sample['query']!r}: luật={result} nhãn={sample['label']}")
+    rules_ms = (time.perf_counter() - start) * 1000
+
+    print(f"\n📊 {len(samples)} mẫu | fast-path xử lý: {hits} ({hits / len(samples):.0%}) | đúng nhãn: {correct}/{len(samples)} | nhận nhầm: {false_positives}")
+    print(f"   Tổng thời gian chạy luật: {rules_ms:.2f}ms")
+
+    if not with_llm:
+        return
+
+    # Tắt fast-path và cache để đo LLM thật
+    intent_service.INTENT_FAST_PATH_ENABLED = False
+    intent_service._intent_cache.clear()
+    agreements = 0
+    saved_ms = 0.0
+    for sample, rule_result in zip(samples, rule_results):
+        if rule_result is None:
+            continue
+        llm_start = time.perf_counter()
+        llm_result = await _run_llm(sample, model_choice, api_key)
+        llm_ms = (time.perf_counter() - llm_start) * 1000
+        saved_ms += llm_ms
+        expected = {key: value for key, value in rule_result.items() if key not in ("confidence", "search_params") and value is not None}
+        if all(llm_result.get(key) == value for key, value in expected.items()):
+            agreements += 1
+        else:
+            print(f"⚠️ [{sample['kind']}] {sample['query']!r}: luật={expected} LLM={llm_result}")
+
+    if hits:
+        print(f"\n🤖 Trùng khớp luật/LLM: {agreements}/{hits} | thời gian LLM tiết kiệm: {saved_ms:.0f}ms (trung bình {saved_ms / hits:.0f}ms/lượt)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Đánh giá bộ phân loại nhanh bằng luật trước LLM.")
+    parser.add_argument("--corpus", default="intent_fast_path_corpus.jsonl")
+    parser.add_argument("--with-llm", action="store_true", help="Gọi LLM thật để đo mức trùng khớp và thời gian tiết kiệm")
+    parser.add_argument("--model-choice", default="gemini")
+    parser.add_argument("--api-key", default=None)
+    args = parser.parse_args()
+    asyncio.run(main(args.corpus, args.with_llm, args.model_choice, args.api_key))
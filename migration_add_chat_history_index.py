@@ -0,0 +1,32 @@
+import os
+from sqlalchemy import create_engine, text
+from dotenv import load_dotenv
+
+# Tải các biến môi trường từ tệp .env
+load_dotenv()
+
+# Lấy URL cơ sở dữ liệu từ biến môi trường
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+if not DATABASE_URL:
+    print("Lỗi: Biến môi trường DATABASE_URL chưa được đặt.")
+else:
+    try:
+        # Tạo kết nối đến cơ sở dữ liệu
+        engine = create_engine(DATABASE_URL)
+
+        # Index kết hợp cho truy vấn lịch sử chat theo (customer_id, thread_id) và phân trang keyset theo (created_at DESC, id DESC).
+        # CONCURRENTLY để không khóa ghi bảng chat_history trong lúc tạo index; IF NOT EXISTS nên chạy lại vẫn an toàn.
+        create_index_sql = text(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_chat_history_customer_thread_created "
+            "ON chat_history (customer_id, thread_id, created_at DESC, id DESC)"
+        )
+        # CREATE INDEX CONCURRENTLY không chạy được trong transaction nên dùng AUTOCOMMIT
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            print("Đang kết nối đến cơ sở dữ liệu...")
+            connection.execute(create_index_sql)
+            print("Thành công! Index 'ix_chat_history_customer_thread_created' đã được tạo trên bảng 'chat_history'.")
+
+    except Exception as e:
+        print(f"Đã xảy ra lỗi: {e}")
+        print("Nếu lần tạo trước bị gián đoạn, hãy DROP INDEX ix_chat_history_customer_thread_created (index INVALID) rồi chạy lại.")
@@ -0,0 +1,36 @@
+import os
+from sqlalchemy import create_engine, text
+from dotenv import load_dotenv
+
+# Tải các biến môi trường từ tệp .env
+load_dotenv()
+
+# Lấy URL cơ sở dữ liệu từ biến môi trường
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+if not DATABASE_URL:
+    print("Lỗi: Biến môi trường DATABASE_URL chưa được đặt.")
+else:
+    try:
+        # Tạo kết nối đến cơ sở dữ liệu
+        engine = create_engine(DATABASE_URL)
+
+        # Bảng một dòng chứa công tắc bot toàn hệ thống, dùng chung cho mọi worker
+        create_table_sql = text("""
+            CREATE TABLE IF NOT EXISTS global_bot_switch (
+                id INTEGER PRIMARY KEY,
+                running BOOLEAN NOT NULL DEFAULT TRUE,
+                updated_at TIMESTAMP WITH TIME ZONE DEFAULT now()
+            )
+        """)
+        insert_row_sql = text("INSERT INTO global_bot_switch (id, running) VALUES (1, TRUE) ON CONFLICT (id) DO NOTHING")
+
+        with engine.begin() as connection:
+            print("Đang kết nối đến cơ sở dữ liệu...")
+            connection.execute(create_table_sql)
+            connection.execute(insert_row_sql)
+            print("Thành công! Bảng 'global_bot_switch' đã sẵn sàng (bot đang bật).")
+
+    except Exception as e:
+        print(f"Đã xảy ra lỗi: {e}")
+        print("Vui lòng kiểm tra lại kết nối cơ sở dữ liệu và quyền truy cập.")
@@ -0,0 +1,61 @@
+import os
+from sqlalchemy import create_engine, text
+from dotenv import load_dotenv
+
+# Tải các biến môi trường từ tệp .env
+load_dotenv()
+
+# Lấy URL cơ sở dữ liệu từ biến môi trường
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+if not DATABASE_URL:
+    print("Lỗi: Biến môi trường DATABASE_URL chưa được đặt.")
+else:
+    try:
+        # Tạo kết nối đến cơ sở dữ liệu
+        engine = create_engine(DATABASE_URL)
+
+        create_table_sql = text("""
+            CREATE TABLE IF NOT EXISTS order_status_summaries (
+                customer_id VARCHAR NOT NULL,
+                order_status VARCHAR NOT NULL,
+                order_count INTEGER NOT NULL DEFAULT 0,
+                item_count INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+                PRIMARY KEY (customer_id, order_status)
+            )
+        """)
+
+        # Tính lại toàn bộ số liệu từ orders/order_items (chạy lại bất cứ lúc nào để đồng bộ)
+        backfill_sql = text("""
+            INSERT INTO order_status_summaries (customer_id, order_status, order_count, item_count, updated_at)
+            SELECT o.customer_id, o.order_status, COUNT(*), COALESCE(SUM(i.item_count), 0), now()
+            FROM orders o
+            LEFT JOIN (
+                SELECT order_id, COUNT(*) AS item_count FROM order_items GROUP BY order_id
+            ) i ON i.order_id = o.id
+            GROUP BY o.customer_id, o.order_status
+            ON CONFLICT (customer_id, order_status) DO UPDATE
+            SET order_count = EXCLUDED.order_count, item_count = EXCLUDED.item_count, updated_at = now()
+        """)
+
+        # Xóa các dòng không còn đơn hàng nào tương ứng
+        cleanup_sql = text("""
+            DELETE FROM order_status_summaries s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM orders o WHERE o.customer_id = s.customer_id AND o.order_status = s.order_status
+            )
+        """)
+
+        with engine.begin() as connection:
+            print("Đang kết nối đến cơ sở dữ liệu...")
+            connection.execute(create_table_sql)
+            print("Bảng 'order_status_summaries' đã sẵn sàng.")
+            result = connection.execute(backfill_sql)
+            connection.execute(cleanup_sql)
+            print(f"Thành công! Đã tổng hợp {result.rowcount} dòng (customer_id, order_status).")
+            print("Đặt ORDER_SUMMARY_MATERIALIZED=true để endpoint tóm tắt đơn hàng đọc từ bảng này.")
+
+    except Exception as e:
+        print(f"Đã xảy ra lỗi: {e}")
+        print("Vui lòng kiểm tra lại kết nối cơ sở dữ liệu và quyền truy cập.")
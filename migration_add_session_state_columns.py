@@ -0,0 +1,71 @@
+import os
+from sqlalchemy import create_engine, text
+from dotenv import load_dotenv
+
+# Tải các biến môi trường từ tệp .env
+load_dotenv()
+
+# Lấy URL cơ sở dữ liệu từ biến môi trường
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+if not DATABASE_URL:
+    print("Lỗi: Biến môi trường DATABASE_URL chưa được đặt.")
+else:
+    try:
+        # Tạo kết nối đến cơ sở dữ liệu
+        engine = create_engine(DATABASE_URL)
+
+        add_columns_sql = text("""
+            ALTER TABLE session_controls
+            ADD COLUMN IF NOT EXISTS state VARCHAR,
+            ADD COLUMN IF NOT EXISTS handover_timestamp DOUBLE PRECISION
+        """)
+
+        # Sao chép state/handover_timestamp từ session_data (chạy lại được, nên chạy thêm một lần sau khi deploy code ghi song song)
+        backfill_sql = text("""
+            UPDATE session_controls
+            SET state = session_data->>'state',
+                handover_timestamp = CASE
+                    WHEN session_data->>'state' IN ('human_calling', 'human_chatting')
+                    THEN (session_data->>'handover_timestamp')::double precision
+                END
+            WHERE session_data IS NOT NULL
+              AND (state IS DISTINCT FROM session_data->>'state'
+                   OR handover_timestamp IS DISTINCT FROM CASE
+                        WHEN session_data->>'state' IN ('human_calling', 'human_chatting')
+                        THEN (session_data->>'handover_timestamp')::double precision
+                      END)
+        """)
+        # Mốc handover còn sót trên dòng có state không còn là handover: bỏ đi để bộ hẹn giờ không nạp lại.
+        # Xét state chứ không xét status: handover do khách yêu cầu có status "active" và vẫn đang chờ nhân viên.
+        clear_stale_sql = text("""
+            UPDATE session_controls
+            SET handover_timestamp = NULL
+            WHERE handover_timestamp IS NOT NULL
+              AND (state IS NULL OR state NOT IN ('human_calling', 'human_chatting'))
+        """)
+
+        create_index_sqls = [
+            text("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_session_controls_state ON session_controls (state)"),
+            text("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_session_controls_handover_timestamp ON session_controls (handover_timestamp)"),
+        ]
+
+        with engine.begin() as connection:
+            print("Đang kết nối đến cơ sở dữ liệu...")
+            connection.execute(add_columns_sql)
+            print("Đã thêm cột 'state' và 'handover_timestamp' vào bảng 'session_controls'.")
+            result = connection.execute(backfill_sql)
+            print(f"Đã sao chép dữ liệu cho {result.rowcount} session.")
+            result = connection.execute(clear_stale_sql)
+            print(f"Đã xóa mốc handover cũ của {result.rowcount} session không còn chờ nhân viên.")
+
+        # CREATE INDEX CONCURRENTLY không chạy được trong transaction nên dùng AUTOCOMMIT
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            for create_index_sql in create_index_sqls:
+                connection.execute(create_index_sql)
+            print("Thành công! Đã tạo index cho 'state' và 'handover_timestamp'.")
+            print("Sau khi chạy lại script này một lần với code mới, có thể đặt SESSION_STATE_SOURCE=columns.")
+
+    except Exception as e:
+        print(f"Đã xảy ra lỗi: {e}")
+        print("Vui lòng kiểm tra lại kết nối cơ sở dữ liệu và quyền truy cập.")
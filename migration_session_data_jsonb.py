@@ -0,0 +1,31 @@
+import os
+from sqlalchemy import create_engine, text
+from dotenv import load_dotenv
+
+# Tải các biến môi trường từ tệp .env
+load_dotenv()
+
+# Lấy URL cơ sở dữ liệu từ biến môi trường
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+if not DATABASE_URL:
+    print("Lỗi: Biến môi trường DATABASE_URL chưa được đặt.")
+else:
+    try:
+        # Tạo kết nối đến cơ sở dữ liệu
+        engine = create_engine(DATABASE_URL)
+
+        # Chuyển session_data từ JSON sang JSONB để cập nhật từng khóa bằng || / jsonb_set (khóa bảng trong lúc chuyển)
+        alter_column_sql = text(
+            "ALTER TABLE session_controls ALTER COLUMN session_data TYPE JSONB USING session_data::jsonb"
+        )
+
+        with engine.begin() as connection:
+            print("Đang kết nối đến cơ sở dữ liệu...")
+            connection.execute(alter_column_sql)
+            print("Thành công! Cột 'session_data' của bảng 'session_controls' đã chuyển sang JSONB.")
+            print("Đặt SESSION_DATA_PATCH_WRITES=true để chỉ ghi các khóa session_data thay đổi.")
+
+    except Exception as e:
+        print(f"Đã xảy ra lỗi: {e}")
+        print("Vui lòng kiểm tra lại kết nối cơ sở dữ liệu và quyền truy cập.")
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Chạy lại các lượt chốt đơn đã ghi nhận để so sánh hai chế độ đánh giá sản phẩm của _resolve_order_items:
+"paged" (đánh giá từng trang) và "single" (gộp ứng viên, một lần gọi LLM).
+
+Mỗi dòng của file JSONL đầu vào có dạng:
+{"customer_id": "...", "user_query": "...", "history_text": "...",
+ "items": [{"intent": {"product_name": "...", "category": "...", "properties": "...", "quantity": 1}}],
+ "expected": ["product_name::properties", ...]}
+Trường "expected" (tùy chọn) là key sản phẩm đúng cho từng mục, theo _get_product_key.
+File mẫu order_evaluation_samples.jsonl (mặc định) ghi lại vài lượt chốt đơn điển hình; dùng --customer-id để chạy
+các lượt này trên dữ liệu sản phẩm của một customer khác (khi đó bỏ qua "expected").
+File mẫu chỉ để chạy thử script (4 lượt, 2 lượt có "expected"), không đủ để kết luận chất lượng của chế độ "single":
+cần một tập lượt chốt đơn thật có gán nhãn của customer, xem tỉ lệ trùng khớp giữa hai chế độ và số đúng theo nhãn.
+
+Script dùng Elasticsearch và LLM thật (cấu hình như khi chạy server), chỉ bọc thêm bộ đếm số lần gọi.
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import statistics
+import time
+
+import src.api.chat_routes as chat_routes
+from src.utils.helpers import sanitize_for_es
+
+_counters = {"llm": 0, "es": 0}
+
+def _install_counters():
+    """Bọc evaluate_and_choose_product và msearch_products để đếm số lần gọi LLM/ES."""
+    evaluate = chat_routes.evaluate_and_choose_product
+    msearch = chat_routes.msearch_products
+
+    async def counted_evaluate(*args, **kwargs):
+        _counters["llm"] += 1
+        return await evaluate(*args, **kwargs)
+
+    async def counted_msearch(*args, **kwargs):
+        _counters["es"] += 1
+        return await msearch(*args, **kwargs)
+
+    chat_routes.evaluate_and_choose_product = counted_evaluate
+    chat_routes.msearch_products = counted_msearch
+
+def _load_turns(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+async def _replay(turn: dict, mode: str, model_choice: str, api_key: str) -> dict:
+    items = copy.deepcopy(turn["items"])
+    _counters["llm"] = _counters["es"] = 0
+    start = time.perf_counter()
+    await chat_routes._resolve_order_items(
+        items, sanitize_for_es(turn["customer_id"]), turn["user_query"], turn.get("history_text", ""),
+        model_choice, api_key, eval_mode=mode
+    )
+    elapsed = (time.perf_counter() - start) * 1000
+    chosen = [
+        chat_routes._get_product_key(item["evaluation"]["product"]) if item["evaluation"].get("product") else None
+        for item in items
+    ]
+    return {"chosen": chosen, "llm_calls": _counters["llm"], "es_calls": _counters["es"], "latency_ms": elapsed}
+
+async def main(path: str, model_choice: str, api_key: str, customer_id: str = None):
+    _install_counters()
+    turns = _load_turns(path)
+    if customer_id:
+        turns = [dict(turn, customer_id=customer_id, expected=None) for turn in turns]
+    summary = {mode: {"latency": [], "llm": 0, "es": 0, "correct": 0, "labelled": 0} for mode in ("paged", "single")}
+    agreements = 0
+    total_items = 0
+
+    for turn in turns:
+        results = {}
+        for mode in ("paged", "single"):
+            result = await _replay(turn, mode, model_choice, api_key)
+            results[mode] = result
+            stats = summary[mode]
+            stats["latency"].append(result["latency_ms"])
+            stats["llm"] += result["llm_calls"]
+            stats["es"] += result["es_calls"]
+            for chosen, expected in zip(result["chosen"], turn.get("expected") or []):
+                if expected is not None:
+                    stats["labelled"] += 1
+                    stats["correct"] += int(chosen == expected)
+
+        for paged_key, single_key in zip(results["paged"]["chosen"], results["single"]["chosen"]):
+            total_items += 1
+            agreements += int(paged_key == single_key)
+        print(f"🔁 {turn['user_query'][:50]!r}: paged={results['paged']['chosen']} single={results['single']['chosen']}")
+
+    print(f"\n📊 {len(turns)} lượt, {total_items} sản phẩm, trùng khớp giữa hai chế độ: {agreements}/{total_items}")
+    for mode, stats in summary.items():
+        if not stats["latency"]:
+            continue
+        accuracy = f"{stats['correct']}/{stats['labelled']}" if stats["labelled"] else "n/a"
+        print(
+            f"  {mode:<7} LLM={stats['llm']:<4} ES={stats['es']:<4} "
+            f"p50={statistics.median(stats['latency']):8.1f}ms  max={max(stats['latency']):8.1f}ms  đúng={accuracy}"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="So sánh chế độ đánh giá sản phẩm paged và single trên các lượt chốt đơn đã ghi.")
+    parser.add_argument("path", nargs="?", default="order_evaluation_samples.jsonl", help="File JSONL chứa các lượt chốt đơn")
+    parser.add_argument("--model-choice", default="gemini")
+    parser.add_argument("--api-key", default=None)
+    parser.add_argument("--customer-id", default=None, help="Chạy các lượt trên sản phẩm của customer này thay vì customer_id trong file")
+    args = parser.parse_args()
+    asyncio.run(main(args.path, args.model_choice, args.api_key, args.customer_id))
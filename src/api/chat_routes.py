@@ -1,33 +1,40 @@
 from fastapi import HTTPException, UploadFile, Path
-from typing import Dict, Any, List, Optional
-import threading
+from typing import Dict, Any, List, Optional, Tuple, Callable, Awaitable, AsyncIterator
+import asyncio
+import json
+from contextvars import ContextVar
 import requests
 from collections import defaultdict
 
 from src.models.schemas import ChatResponse, ImageInfo, PurchaseItem, CustomerInfo, ControlBotRequest
 from src.services.intent_service import analyze_intent_and_extract_entities, extract_customer_info
-from src.services.search_service import search_products, search_products_by_image
+from src.services.search_service import search_products, search_products_by_image, msearch_products
 from src.services.response_service import generate_llm_response
 from src.services.llm_service import analyze_image_with_vision
-from src.utils.helpers import is_asking_for_more, format_history_text, sanitize_for_es
-from src.config.settings import PAGE_SIZE
+from src.utils.helpers import is_asking_for_more, format_history_text, sanitize_for_es, get_shown_product_hashes, add_shown_product_keys, hash_product_key
+from src.config.settings import PAGE_SIZE, PRODUCT_EVAL_MODE, PRODUCT_EVAL_CANDIDATES, SHOWN_PRODUCT_KEYS_MAX
 from src.services.response_service import evaluate_and_choose_product, evaluate_purchase_confirmation, filter_products_with_ai
-from src.utils.get_customer_info import get_customer_store_info
+from src.services.config_cache import get_store_info_cached
+from src.services.bot_switch import is_bot_running, set_bot_running
+from src.services.tenant_state import is_tenant_bot_active, is_sale_thread, get_tenant_bot_status, set_tenant_bot_active
+from src.services.session_store import load_session, stage_session, flush_session, invalidate_session, set_session_status, persist_turn
+from src.services.handover_scheduler import schedule_handover, cancel_handover
+from src.utils.metrics import timed, turn_metrics, bind_turn_customer
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+import database.async_database as async_database
+from database.async_database import run_db
 from database.database import (
-    get_session_control, create_or_update_session_control, get_customer_is_sale, 
-    add_chat_message, get_chat_history, get_full_chat_history, get_all_session_controls_by_customer,
+    get_session_control,
+    get_chat_history, get_full_chat_history, get_chat_history_page, get_all_session_controls_by_customer, count_session_controls_by_status,
     create_or_update_customer_profile, has_previous_orders, create_order, add_order_item,
     get_customer_profile_by_phone, get_customer_order_history, get_customer_profile,
     is_bot_active, power_off_bot_for_customer, power_on_bot_for_customer, get_bot_status,
-    ChatHistory
+    ChatHistory, SessionLocal
 )
 import time
 HANDOVER_TIMEOUT = 900
 
-bot_running = True
-bot_state_lock = threading.Lock()
-
 def _get_product_key(product: Dict) -> str:
     """Tạo một key định danh duy nhất cho sản phẩm."""
     return f"{product.get('product_name', '')}::{product.get('properties', '')}"
@@ -60,22 +67,147 @@ def _format_db_history(history_records: List[Any]) -> List[Dict[str, str]]:
             i += 1
     return paired_history
 
-def _get_customer_bot_status(db: Session, customer_id: str) -> str:
+# Ngữ cảnh của lượt chat đang xử lý: chế độ trả lịch sử ("full"/"incremental") và các lượt vừa được ghi
+_turn_context: ContextVar[Optional[dict]] = ContextVar("chat_turn_context", default=None)
+
+@timed("db_read_history")
+async def _load_recent_history(db: Session, customer_id: str, session_id: str, limit: int) -> List[Any]:
+    """Đọc `limit` tin nhắn gần nhất, bằng truy vấn async thuần khi lượt chat chạy trên AsyncSession (DB_ASYNC_ENABLED)."""
+    if isinstance(db, AsyncSession):
+        return await async_database.get_chat_history_async(db, customer_id, session_id, limit=limit)
+    return get_chat_history(db, customer_id, session_id, limit=limit)
+
+async def _final_history(db: Session, customer_id: str, session_id: str) -> List[Dict[str, str]]:
+    """
+    Lịch sử trả về cho client cuối lượt chat.
+    - "full": đọc lại 50 tin nhắn gần nhất từ DB.
+    - "incremental": chỉ trả các lượt vừa ghi trong request này (client tự nối vào lịch sử đã có), không đọc DB.
+    """
+    turn_context = _turn_context.get()
+    if turn_context and turn_context["history_mode"] == "incremental":
+        return list(turn_context["turns"])
+    return _format_db_history(await _load_recent_history(db, customer_id, session_id, limit=50))
+
+async def _get_customer_bot_status(db: Session, customer_id: str) -> str:
     """
     Kiểm tra trạng thái bot của customer dựa trên các session hiện có.
-    Trả về 'stopped' nếu tất cả sessions đều bị dừng, 'active' nếu ngược lại.
+    Trả về 'stopped' nếu tất cả sessions đều bị dừng, 'active' nếu ngược lại (kể cả khi chưa có session nào).
+    Đọc từ bộ đếm session stopped/tổng trong tenant_state thay vì tải toàn bộ session của customer.
     """
-    sessions = get_all_session_controls_by_customer(db, customer_id)
-    
-    if not sessions:
-        return "active"  # Mặc định là active nếu chưa có session nào
-    
-    # Nếu tất cả sessions đều bị stopped, thì customer bot bị stopped
-    stopped_sessions = [s for s in sessions if s.status == "stopped"]
-    if len(stopped_sessions) == len(sessions):
-        return "stopped"
-    
-    return "active"
+    return await run_db(db, get_tenant_bot_status, customer_id)
+
+MAX_SEARCH_PAGES = 5
+
+async def _evaluate_order_item_page(state: dict, found_products: List[Dict], page: int, history_text: str, model_choice: str, api_key: str):
+    """Đánh giá một trang kết quả cho một sản phẩm trong đơn, cập nhật best_evaluation và đánh dấu done khi đã xác định xong."""
+    previous_suggestion = state["previous_suggestion"]
+    if previous_suggestion:
+        suggestion_key = _get_product_key(previous_suggestion)
+        if not found_products or not any(_get_product_key(p) == suggestion_key for p in found_products):
+            found_products = [previous_suggestion] + (found_products or [])
+
+    if not found_products and page > 0:
+        state["done"] = True
+        return
+
+    current_evaluation = await evaluate_and_choose_product(
+        state["query_for_evaluation"], history_text, found_products, model_choice, api_key=api_key
+    )
+
+    best_evaluation = state["best_evaluation"]
+    if current_evaluation.get("type") == "PERFECT_MATCH":
+        state["best_evaluation"] = current_evaluation
+        state["done"] = True
+        return
+
+    if not best_evaluation or current_evaluation.get("score", 0.0) > best_evaluation.get("score", 0.0):
+        state["best_evaluation"] = current_evaluation
+
+    if state["best_evaluation"].get("score", 0.0) >= 0.8 or not found_products:
+        state["done"] = True
+
+async def _evaluate_order_item_candidates(state: dict, found_products: List[Dict], history_text: str, model_choice: str, api_key: str):
+    """Chấm điểm toàn bộ ứng viên (đã loại trùng theo _get_product_key) của một sản phẩm trong đơn bằng một lần gọi LLM."""
+    candidates = []
+    seen_keys = set()
+    previous_suggestion = state["previous_suggestion"]
+    for product in ([previous_suggestion] if previous_suggestion else []) + (found_products or []):
+        product_key = _get_product_key(product)
+        if product_key not in seen_keys:
+            seen_keys.add(product_key)
+            candidates.append(product)
+
+    state["best_evaluation"] = await evaluate_and_choose_product(
+        state["query_for_evaluation"], history_text, candidates, model_choice, api_key=api_key
+    )
+    state["done"] = True
+
+async def _resolve_order_items(items: List[Dict], sanitized_customer_id: str, user_query: str, history_text: str, model_choice: str, api_key: str, eval_mode: str = None):
+    """
+    Tìm và chọn sản phẩm cho các mục trong đơn hàng.
+    - Chế độ "paged": theo từng vòng trang, mỗi vòng gửi trang hiện tại của tất cả mục chưa xác định
+      trong một request _msearch rồi đánh giá các mục song song. Chỉ các mục chưa xác định mới được tìm tiếp trang sau.
+    - Chế độ "single": lấy PRODUCT_EVAL_CANDIDATES ứng viên cho mỗi mục trong một request _msearch
+      và chấm điểm mỗi mục bằng một lần gọi LLM duy nhất.
+    Kết quả được ghi vào item["evaluation"].
+    """
+    eval_mode = eval_mode or PRODUCT_EVAL_MODE
+    states = []
+    for item in items:
+        item_intent = item["intent"]
+        product_name_intent = item_intent.get("product_name")
+        properties_intent = item_intent.get("properties")
+
+        sub_query = f"khách muốn mua {item_intent.get('quantity', 1)} {product_name_intent}"
+        if properties_intent:
+            sub_query += f" loại {properties_intent}"
+
+        is_close_match = bool(item.get("evaluation") and item["evaluation"].get("type") == "CLOSE_MATCH")
+        states.append({
+            "item": item,
+            "query_for_evaluation": user_query if is_close_match else sub_query,
+            "previous_suggestion": item["evaluation"].get("product") if is_close_match else None,
+            "best_evaluation": None,
+            "done": False,
+        })
+
+    if eval_mode == "single" and states:
+        candidates = await msearch_products(sanitized_customer_id, [
+            {
+                "product_name": state["item"]["intent"].get("product_name"),
+                "category": state["item"]["intent"].get("category"),
+                "properties": state["item"]["intent"].get("properties"),
+                "offset": 0,
+                "size": PRODUCT_EVAL_CANDIDATES,
+            }
+            for state in states
+        ])
+        await asyncio.gather(*[
+            _evaluate_order_item_candidates(state, found_products, history_text, model_choice, api_key)
+            for state, found_products in zip(states, candidates)
+        ])
+
+    for page in range(MAX_SEARCH_PAGES):
+        active = [state for state in states if not state["done"]]
+        if not active:
+            break
+
+        pages = await msearch_products(sanitized_customer_id, [
+            {
+                "product_name": state["item"]["intent"].get("product_name"),
+                "category": state["item"]["intent"].get("category"),
+                "properties": state["item"]["intent"].get("properties"),
+                "offset": page * PAGE_SIZE,
+            }
+            for state in active
+        ])
+        await asyncio.gather(*[
+            _evaluate_order_item_page(state, found_products, page, history_text, model_choice, api_key)
+            for state, found_products in zip(active, pages)
+        ])
+
+    for state in states:
+        state["item"]["evaluation"] = state["best_evaluation"] if state["best_evaluation"] else {"type": "NO_MATCH"}
 
 def _update_session_state(db: Session, customer_id: str, session_id: str, status: str, session_data: dict):
     """Cập nhật trạng thái session trong cả database và memory"""   
@@ -97,27 +229,58 @@ def _update_session_state(db: Session, customer_id: str, session_id: str, status
         session_data["handover_timestamp"] = time.time()
         print(f"   ✅ Set session_data state = human_chatting, handover_timestamp = {session_data['handover_timestamp']}")
     
-    # Cập nhật database với session_data đã được cập nhật   
+    # Ghi vào session store; thay đổi được gộp và ghi xuống database một lần khi kết thúc lượt chat (flush_session)
+    stage_session(customer_id, session_id, status, session_data)
+
+    # Hẹn giờ tự kích hoạt lại bot khi nhân viên không phản hồi
+    if status in ("human_calling", "human_chatting"):
+        schedule_handover(customer_id, session_id, session_data["handover_timestamp"] + HANDOVER_TIMEOUT)
+    else:
+        cancel_handover(customer_id, session_id)
+
+# Các ý định mà khi xuất hiện thì kết quả "xem thêm" không còn được dùng tới
+# (chat_endpoint trả về hoặc rẽ nhánh trước khi xét tới asking_for_more).
+MORE_PRODUCTS_IRRELEVANT_INTENTS = (
+    "is_purchase_intent",
+    "wants_human_agent",
+    "is_bank_transfer",
+    "wants_warranty_service",
+    "wants_store_info",
+)
+
+async def _run_pre_analysis(user_query: str, history: list, model_choice: str, api_key: str, pending_state: str = None) -> Tuple[Dict[str, Any], bool]:
+    """
+    Chạy song song các bộ phân loại độc lập (phân tích ý định và "xem thêm") rồi gộp kết quả.
+    Hai lệnh gọi chỉ phụ thuộc vào user_query và history nên không cần chờ nhau.
+    Nếu ý định là mua hàng/chuyển nhân viên thì hủy tác vụ "xem thêm" và bỏ qua kết quả của nó.
+    """
+    history_text_for_more = format_history_text(history, limit=4)
+
+    intent_task = asyncio.create_task(
+        analyze_intent_and_extract_entities(user_query, history, model_choice, api_key=api_key, pending_state=pending_state)
+    )
+    more_task = asyncio.create_task(
+        is_asking_for_more(user_query, history_text_for_more, api_key=api_key)
+    )
+
     try:
-        # Tạo một copy mới của session_data để tránh reference issues
-        session_data_copy = dict(session_data)
-        
-        result = create_or_update_session_control(db, customer_id, session_id, status=status, session_data=session_data_copy)
-        
-        # Verify the state was actually updated in DB
-        db_state = result.session_data.get('state') if result.session_data else None
-        expected_state = session_data_copy.get('state')
-        
-        if db_state != expected_state:
-            result.session_data = session_data_copy
-            db.commit()
-            db.refresh(result)
-        
-        return result
-    except Exception as e:
-        print(f"   ❌ Database update failed: {e}")
+        analysis_result = await intent_task
+    except BaseException:
+        more_task.cancel()
         raise
 
+    # Kết quả từ bộ phân loại luật (có "confidence") là câu chào/xác nhận/thông tin đơn giản, không phải "xem thêm"
+    if "confidence" in analysis_result or any(analysis_result.get(flag) for flag in MORE_PRODUCTS_IRRELEVANT_INTENTS):
+        more_task.cancel()
+        return analysis_result, False
+
+    try:
+        asking_for_more = await more_task
+    except Exception as e:
+        print(f"Lỗi khi đánh giá ý định 'xem thêm': {e}")
+        asking_for_more = False
+    return analysis_result, asking_for_more
+
 async def chat_endpoint(
     customer_id: str,
     session_id: str,
@@ -126,7 +289,41 @@ async def chat_endpoint(
     model_choice: str,
     api_key: str,
     image_url: Optional[str] = None,
-    image: Optional[UploadFile] = None
+    image: Optional[UploadFile] = None,
+    on_token: Optional[Callable[[str], Awaitable[None]]] = None,
+    history_mode: str = "full"
+) -> ChatResponse:
+    """
+    Xử lý một lượt chat. Mọi thay đổi session trong lượt được giữ trong session store
+    và chỉ ghi xuống database một lần khi lượt chat kết thúc.
+    history_mode="incremental": history chỉ chứa lượt mới, kèm last_message_id làm cursor cho client.
+    db là Session hoặc AsyncSession (DB_ASYNC_ENABLED); các hàm database đồng bộ được gọi qua run_db.
+    """
+    turn_context = {"history_mode": history_mode, "turns": [], "message_ids": []}
+    context_token = _turn_context.set(turn_context)
+    with turn_metrics(model_choice):
+        try:
+            response = await _process_chat_turn(
+                customer_id, session_id, db, message, model_choice, api_key,
+                image_url=image_url, image=image, on_token=on_token
+            )
+            if turn_context["message_ids"]:
+                response.last_message_id = max(turn_context["message_ids"])
+            return response
+        finally:
+            _turn_context.reset(context_token)
+            await run_db(db, flush_session, customer_id, session_id)
+
+async def _process_chat_turn(
+    customer_id: str,
+    session_id: str,
+    db: Session,
+    message: str,
+    model_choice: str,
+    api_key: str,
+    image_url: Optional[str] = None,
+    image: Optional[UploadFile] = None,
+    on_token: Optional[Callable[[str], Awaitable[None]]] = None
 ) -> ChatResponse:
     # # Validate và sanitize input parameters
     # import inspect
@@ -164,12 +361,12 @@ async def chat_endpoint(
     #             elif param_name == 'image_url':
     #                 image_url = str(param_value) if param_value else None
     
-    with bot_state_lock:
-        if not bot_running:
-            return ChatResponse(reply="", history=[], human_handover_required=False)
+    # Công tắc toàn hệ thống: đọc bản sao trong bộ nhớ (được đồng bộ giữa các worker qua LISTEN/NOTIFY)
+    if not is_bot_running():
+        return ChatResponse(reply="", history=[], human_handover_required=False)
     
     # Kiểm tra trạng thái bot cho customer này
-    if not is_bot_active(db, customer_id):
+    if not await run_db(db, is_tenant_bot_active, customer_id):
         return ChatResponse(
             reply="", 
             history=[],
@@ -184,35 +381,29 @@ async def chat_endpoint(
     
     if not user_query and not image_url and not image:
         raise HTTPException(status_code=400, detail="Không có tin nhắn hoặc hình ảnh nào được gửi")
+    bind_turn_customer(customer_id)
     
     sanitized_customer_id = sanitize_for_es(customer_id)
     
     # Lấy lịch sử chat từ DB
-    db_history = get_chat_history(db, customer_id, session_id, limit=12)
+    db_history = await _load_recent_history(db, customer_id, session_id, limit=12)
     history = _format_db_history(db_history)
 
     # Kiểm tra khách hàng có phải là sale không
-    is_sale_customer = False
-    customer_sale_info = get_customer_is_sale(db, customer_id, session_id)
-    if customer_sale_info and customer_sale_info.is_sale:
-        is_sale_customer = True
+    is_sale_customer = await run_db(db, is_sale_thread, customer_id, session_id)
 
-    # Kiểm tra trạng thái session từ database
-    session_control = get_session_control(db, customer_id, session_id)
+    # Kiểm tra trạng thái session (session store, đọc database nếu chưa có trong cache)
+    session_control = await run_db(db, load_session, customer_id, session_id)
     if session_control and session_control.session_data:
         session_data = session_control.session_data
-        # Đảm bảo shown_product_keys luôn là list để tránh lỗi JSON serialization
-        if 'shown_product_keys' in session_data and session_data['shown_product_keys'] is not None:
-            # Đảm bảo là list, không phải set
-            if isinstance(session_data['shown_product_keys'], set):
-                session_data['shown_product_keys'] = list(session_data['shown_product_keys'])
-        else:
+        # shown_product_keys: list hash 64-bit của các sản phẩm đã hiển thị (xem add_shown_product_keys)
+        if session_data.get('shown_product_keys') is None:
             session_data['shown_product_keys'] = []
     else:
         session_data = {
             "last_query": None,
             "offset": 0,
-            "shown_product_keys": [],  # Sử dụng list thay vì set
+            "shown_product_keys": [],  # List hash 64-bit, xem add_shown_product_keys
             "state": None, 
             "pending_purchase_item": None,
             "negativity_score": 0,
@@ -227,7 +418,7 @@ async def chat_endpoint(
         session_status = session_control.status
     else:
         # Kiểm tra xem customer có bot bị dừng không
-        customer_bot_status = _get_customer_bot_status(db, customer_id)
+        customer_bot_status = await _get_customer_bot_status(db, customer_id)
         session_status = customer_bot_status
         
         # Tạo session mới với trạng thái phù hợp
@@ -235,29 +426,23 @@ async def chat_endpoint(
             session_data["state"] = "stop_bot"
             session_data["collected_customer_info"] = {}
         
-        create_or_update_session_control(
-            db, 
-            customer_id=customer_id, 
-            session_id=session_id, 
-            status=session_status,
-            session_data=session_data
-        )
+        stage_session(customer_id, session_id, session_status, session_data)
 
     # Kiểm tra trạng thái từ database
     if session_status == "stopped":
-        _update_chat_history(db, customer_id, session_id, user_query, "", session_data)
-        final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+        await _update_chat_history(db, customer_id, session_id, user_query, "", session_data)
+        final_history = await _final_history(db, customer_id, session_id)
         return ChatResponse(reply="", history=final_history, human_handover_required=False)
 
     if session_status == "human_chatting":
-        _update_chat_history(db, customer_id, session_id, user_query, "", session_data)
-        final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+        await _update_chat_history(db, customer_id, session_id, user_query, "", session_data)
+        final_history = await _final_history(db, customer_id, session_id)
         return ChatResponse(reply="", history=final_history, human_handover_required=False)
     
     if session_data.get("state") == "human_calling":
         response_text = "Dạ, nhân viên bên em đang vào ngay ạ, anh/chị vui lòng đợi trong giây lát."
-        _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-        final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+        await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+        final_history = await _final_history(db, customer_id, session_id)
         return ChatResponse(reply=response_text, history=final_history, human_handover_required=False)
  
     if image_url or image:
@@ -292,7 +477,7 @@ async def chat_endpoint(
                 user_query = image_description
                 print(f" -> AI Vision mô tả: {user_query}")
 
-                response_text = generate_llm_response(
+                response_text = await generate_llm_response(
                     user_query=user_query,
                     search_results=None,
                     history=history,
@@ -301,18 +486,19 @@ async def chat_endpoint(
                     api_key=api_key,
                     db=db,
                     customer_id=customer_id,
-                    is_sale=is_sale_customer
+                    is_sale=is_sale_customer,
+                    on_token=on_token
                 )
 
-                _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-                final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+                await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+                final_history = await _final_history(db, customer_id, session_id)
                 return ChatResponse(reply=response_text, history=final_history, human_handover_required=False)
 
             # --- Bước 4: Nếu AI Vision không nhận diện được ---
             else:
                 response_text = "Dạ, em chưa nhận ra sản phẩm hoặc nội dung trong ảnh ạ. Anh/chị có thể nói rõ hơn giúp em được không?"
-                _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-                final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+                await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+                final_history = await _final_history(db, customer_id, session_id)
                 return ChatResponse(reply=response_text, history=final_history)
 
         except Exception as e:
@@ -320,26 +506,23 @@ async def chat_endpoint(
             return ChatResponse(reply="Dạ, em xin lỗi, em chưa xem được hình ảnh của mình ạ.", history=history)
 
     
-    analysis_result = analyze_intent_and_extract_entities(user_query, history, model_choice, api_key=api_key)
+    analysis_result, asking_for_more = await _run_pre_analysis(user_query, history, model_choice, api_key, session_data.get("state"))
     print(f"🔍 Intent Analysis Result: {analysis_result}")
     print(f"🎯 wants_human_agent: {analysis_result.get('wants_human_agent')}")
 
-    history_text_for_more = format_history_text(history, limit=4)
-    asking_for_more = is_asking_for_more(user_query, history_text_for_more, api_key=api_key)
-
     retrieved_data, product_images = [], []
     response_text = ""
 
     if user_query.strip().lower() == "/bot":
         _update_session_state(db, customer_id, session_id, "active", session_data)
         response_text = "Dạ, em có thể giúp gì tiếp cho anh/chị ạ?"
-        _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-        final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+        await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+        final_history = await _final_history(db, customer_id, session_id)
         return ChatResponse(reply=response_text, history=final_history, human_handover_required=False)
 
     if session_data.get("state") == "awaiting_purchase_confirmation":
         history_text = format_history_text(history, limit=4)
-        evaluation = evaluate_purchase_confirmation(user_query, history_text, model_choice, api_key=api_key)
+        evaluation = await evaluate_purchase_confirmation(user_query, history_text, model_choice, api_key=api_key)
         decision = evaluation.get("decision")
         if decision == "CONFIRM":
             collected_info = session_data.get("collected_customer_info", {})
@@ -348,8 +531,8 @@ async def chat_endpoint(
             if not pending_items:
                 response_text = "Dạ có lỗi xảy ra, không tìm thấy sản phẩm cần xác nhận ạ."
                 _update_session_state(db, customer_id, session_id, "active", session_data)
-                _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-                final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+                await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+                final_history = await _final_history(db, customer_id, session_id)
                 return ChatResponse(reply=response_text, history=final_history)
 
             if collected_info.get("name") and collected_info.get("phone") and collected_info.get("address"):
@@ -373,8 +556,8 @@ async def chat_endpoint(
                 # Tạo đơn hàng trong database
                 try:
                     # Tạo hoặc cập nhật customer profile
-                    profile = create_or_update_customer_profile(
-                        db,
+                    profile = await run_db(
+                        db, create_or_update_customer_profile,
                         customer_id=customer_id,
                         session_id=session_id,
                         name=collected_info.get("name"),
@@ -383,8 +566,8 @@ async def chat_endpoint(
                     )
                     
                     # Tạo đơn hàng mới
-                    order = create_order(
-                        db=db,
+                    order = await run_db(
+                        db, create_order,
                         customer_profile_id=profile.id, # Sửa lại cho đúng
                         customer_id=customer_id,
                         session_id=session_id, # Thêm session_id
@@ -409,8 +592,8 @@ async def chat_endpoint(
                         item_total = price * quantity
                         total_amount += item_total
                         
-                        add_order_item(
-                            db,
+                        await run_db(
+                            db, add_order_item,
                             order_id=order.id,
                             product_name=item_data.get("product_name", "N/A"),
                             properties=item_data.get("properties", ""),
@@ -419,8 +602,7 @@ async def chat_endpoint(
                         )
                     
                     # Cập nhật tổng tiền đơn hàng
-                    order.total_amount = total_amount
-                    db.commit()
+                    await run_db(db, _set_order_total, order, total_amount)
                     
                     confirmed_names = [f"{item.quantity} x {item.product_name}" for item in purchase_items]
                     response_text = f"Dạ, em đã nhận được thông tin và tạo đơn hàng cho các sản phẩm cho anh/chị {collected_info.get("name")} địa chỉ {collected_info.get("address")}: {', '.join(confirmed_names)}. Tổng tiền: {total_amount:,.0f}đ.\nBên em sẽ liên hệ lại với anh/chị sớm nhất.\nEm cảm ơn anh/chị! /-heart"
@@ -436,8 +618,8 @@ async def chat_endpoint(
                 session_data["pending_purchase_item"] = None
                 session_data["has_past_purchase"] = True 
                 
-                _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-                final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+                await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+                final_history = await _final_history(db, customer_id, session_id)
                 
                 return ChatResponse(
                     reply=response_text,
@@ -447,7 +629,7 @@ async def chat_endpoint(
                     has_purchase=True
                 )
             else:
-                store_info = get_customer_store_info(db, customer_id)
+                store_info = await run_db(db, get_store_info_cached, customer_id)
                 store_name = store_info.get("store_name", "")
                 store_address = store_info.get("store_address", "")
                 response_text = (
@@ -457,15 +639,15 @@ async def chat_endpoint(
                 )
                 session_data["state"] = "awaiting_customer_info"
                 
-                _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-                final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+                await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+                final_history = await _final_history(db, customer_id, session_id)
                 return ChatResponse(reply=response_text, history=final_history, human_handover_required=False)
         elif decision == "CANCEL":
             response_text = "Dạ, em đã hủy yêu cầu đặt mua sản phẩm, nếu anh/chị muốn mua sản phẩm khác thì báo lại cho em ạ. /-heart"
             _update_session_state(db, customer_id, session_id, "active", session_data)
             session_data["pending_purchase_item"] = None
-            _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-            final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+            await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+            final_history = await _final_history(db, customer_id, session_id)
             return ChatResponse(reply=response_text, history=final_history, human_handover_required=False)
         else:
             _update_session_state(db, customer_id, session_id, "active", session_data)
@@ -483,15 +665,15 @@ async def chat_endpoint(
                 session_data["pending_purchase_item"] = None
                 
                 response_text = "Dạ vâng, anh/chị muốn thêm sản phẩm nào vào đơn hàng ạ?"
-                _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-                final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+                await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+                final_history = await _final_history(db, customer_id, session_id)
                 return ChatResponse(reply=response_text, history=final_history)
         else:
             # 1. Kiểm tra xem session này đã có profile/đơn hàng trước đây chưa
-            existing_profile = get_customer_profile(db, customer_id, session_id)
-            if existing_profile and has_previous_orders(db, customer_id, session_id=session_id):
+            existing_profile = await run_db(db, get_customer_profile, customer_id, session_id)
+            if existing_profile and await run_db(db, has_previous_orders, customer_id, session_id=session_id):
                 # Khách hàng cũ - hiển thị thông tin để xác nhận
-                order_history = get_customer_order_history(db, customer_id, session_id=session_id)
+                order_history = await run_db(db, get_customer_order_history, customer_id, session_id=session_id)
                 last_order = order_history[0] if order_history else None
 
                 response_parts = []
@@ -515,13 +697,13 @@ async def chat_endpoint(
                 }
                 session_data["existing_profile_id"] = existing_profile.id
                 
-                _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-                final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+                await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+                final_history = await _final_history(db, customer_id, session_id)
                 return ChatResponse(reply=response_text, history=final_history, human_handover_required=False)
             
             # 2. Xử lý thông tin khách hàng (mới hoặc cập nhật)
             current_info = session_data.get("collected_customer_info", {})
-            extracted_info = extract_customer_info(user_query, model_choice, api_key=api_key)
+            extracted_info = await extract_customer_info(user_query, model_choice, api_key=api_key)
 
             # Merge thông tin mới vào thông tin hiện có
             for key, value in extracted_info.items():
@@ -539,18 +721,18 @@ async def chat_endpoint(
             if missing_info:
                 response_text = f"Dạ, anh/chị vui lòng cho em xin { ' và '.join(missing_info) } để em lên đơn ạ."
                 session_data["collected_customer_info"] = current_info
-                _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-                final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+                await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+                final_history = await _final_history(db, customer_id, session_id)
                 return ChatResponse(reply=response_text, history=final_history, human_handover_required=False)
 
             # 3. Đã có đủ thông tin - kiểm tra khách hàng cũ qua số điện thoại (nếu chưa có profile)
             if not existing_profile and current_info.get("phone"):
-                phone_profile = get_customer_profile_by_phone(db, customer_id, current_info["phone"])
-                if phone_profile and has_previous_orders(db, customer_id, phone=current_info["phone"]):
+                phone_profile = await run_db(db, get_customer_profile_by_phone, customer_id, current_info["phone"])
+                if phone_profile and await run_db(db, has_previous_orders, customer_id, phone=current_info["phone"]):
                     response_text = f"Dạ, em nhận ra anh/chị là khách hàng quen của shop rồi ạ! Anh/chị đã từng đặt hàng với số điện thoại này. Em sẽ cập nhật thông tin mới cho anh/chị."
                     session_data["existing_profile_id"] = phone_profile.id
-                    _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-                    final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+                    await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+                    final_history = await _final_history(db, customer_id, session_id)
                     # Không return ở đây, tiếp tục xử lý tạo đơn hàng
 
             # 4. Tạo/cập nhật profile và đơn hàng
@@ -560,13 +742,13 @@ async def chat_endpoint(
                     response_text = "Dạ, anh chị đợi chút, em chưa tìm thấy sản phẩm để đặt hàng ạ. Nhân viên phụ trách bên em sẽ vào trả lời ngay ạ."
                     _update_session_state(db, customer_id, session_id, "human_calling", session_data)
                     session_data["state"] = None
-                    _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-                    final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+                    await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+                    final_history = await _final_history(db, customer_id, session_id)
                     return ChatResponse(reply=response_text, history=final_history)
 
                 # Tạo/cập nhật customer profile
-                profile = create_or_update_customer_profile(
-                    db=db,
+                profile = await run_db(
+                    db, create_or_update_customer_profile,
                     customer_id=customer_id,
                     session_id=session_id,
                     name=current_info.get("name"),
@@ -575,8 +757,8 @@ async def chat_endpoint(
                 )
 
                 # Tạo đơn hàng
-                order = create_order(
-                    db=db,
+                order = await run_db(
+                    db, create_order,
                     customer_profile_id=profile.id,
                     customer_id=customer_id,
                     session_id=session_id,
@@ -594,8 +776,8 @@ async def chat_endpoint(
                         final_props = str(props_value)
                     
                     # Thêm vào database
-                    add_order_item(
-                        db=db,
+                    await run_db(
+                        db, add_order_item,
                         order_id=order.id,
                         product_name=item_data.get("product_name", "N/A"),
                         properties=final_props,
@@ -621,8 +803,8 @@ async def chat_endpoint(
                 session_data["pending_purchase_item"] = None
                 session_data["has_past_purchase"] = True
                 
-                _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-                final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+                await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+                final_history = await _final_history(db, customer_id, session_id)
                 
                 return ChatResponse(
                     reply=response_text,
@@ -642,8 +824,8 @@ async def chat_endpoint(
     if analysis_result.get("is_bank_transfer"):
         response_text = "Dạ, anh/chị đợi chút, nhân viên bên em sẽ vào ngay ạ."
         _update_session_state(db, customer_id, session_id, "human_calling", session_data)
-        _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-        final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+        await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+        final_history = await _final_history(db, customer_id, session_id)
         return ChatResponse(
             reply=response_text,
             history=final_history,
@@ -657,8 +839,8 @@ async def chat_endpoint(
             response_text = "Em đã báo nhân viên phụ trách, anh/chị vui lòng đợi để được hỗ trợ ngay ạ."
             _update_session_state(db, customer_id, session_id, "human_calling", session_data)
             session_data["negativity_score"] = 0
-            _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-            final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+            await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+            final_history = await _final_history(db, customer_id, session_id)
             
             return ChatResponse(
                 reply=response_text,
@@ -671,7 +853,7 @@ async def chat_endpoint(
         if not db:
             response_text = "Dạ, em xin lỗi, em chưa có thông tin cửa hàng ạ."
         else:
-            store_info = get_customer_store_info(db, customer_id)
+            store_info = await run_db(db, get_store_info_cached, customer_id)
             if store_info:
                 parts = []
                 if store_info.get("store_name"):
@@ -702,8 +884,8 @@ async def chat_endpoint(
                         )
                     )
                 
-                _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-                final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+                await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+                final_history = await _final_history(db, customer_id, session_id)
                 return ChatResponse(
                     reply=response_text,
                     history=final_history,
@@ -715,16 +897,16 @@ async def chat_endpoint(
             else:
                 response_text = f"Dạ, em xin lỗi, em chưa có thông tin cho cửa hàng ạ."
         
-        _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-        final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+        await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+        final_history = await _final_history(db, customer_id, session_id)
         return ChatResponse(reply=response_text, history=final_history)
 
     if analysis_result.get("wants_warranty_service"):
         if session_data.get("has_past_purchase"):
             response_text = "Dá anh/chị đợi chút, nhân viên phụ trách bảo hành bên em sẽ vào trả lời ngay ạ."
             _update_session_state(db, customer_id, session_id, "human_calling", session_data)
-            _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-            final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+            await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+            final_history = await _final_history(db, customer_id, session_id)
             return ChatResponse(
                 reply=response_text,
                 history=final_history,
@@ -734,8 +916,8 @@ async def chat_endpoint(
 
         response_text = "Dá anh/chị đợi chút, nhân viên phụ trách bảo hành bên em sẽ vào trả lời ngay ạ."
         _update_session_state(db, customer_id, session_id, "human_calling", session_data)
-        _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-        final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+        await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+        final_history = await _final_history(db, customer_id, session_id)
         return ChatResponse(
             reply=response_text,
             history=final_history,
@@ -748,8 +930,8 @@ async def chat_endpoint(
         response_text = "Em đã báo nhân viên phụ trách, anh/chị vui lòng đợi để được hỗ trợ ngay ạ."
         _update_session_state(db, customer_id, session_id, "human_calling", session_data)
         
-        _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
-        final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+        await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+        final_history = await _final_history(db, customer_id, session_id)
         
         return ChatResponse(
             reply=response_text,
@@ -772,61 +954,13 @@ async def chat_endpoint(
         if "pending_order" in session_data and session_data["pending_order"]:
             history_text = format_history_text(history, limit=6)
             
+            await _resolve_order_items(
+                [item for item in session_data["pending_order"] if item["status"] != "confirmed"],
+                sanitized_customer_id, user_query, history_text, model_choice, api_key
+            )
+
             for item in session_data["pending_order"]:
                 if item["status"] != "confirmed":
-                    item_intent = item["intent"]
-                    product_name_intent = item_intent.get("product_name")
-                    properties_intent = item_intent.get("properties")
-                    
-                    sub_query = f"khách muốn mua {item_intent.get('quantity', 1)} {product_name_intent}"
-                    if properties_intent:
-                        sub_query += f" loại {properties_intent}"
-
-                    query_for_evaluation = user_query
-                    if not (item.get("evaluation") and item["evaluation"].get("type") == "CLOSE_MATCH"):
-                         query_for_evaluation = sub_query
-
-
-                    best_evaluation = None
-                    MAX_SEARCH_PAGES = 5 
-                    for page in range(MAX_SEARCH_PAGES):
-                        found_products = search_products(
-                            customer_id=sanitized_customer_id,
-                            product_name=product_name_intent,
-                            category=item_intent.get("category"),
-                            properties=properties_intent,
-                            offset=page * PAGE_SIZE
-                        )
-                        
-                        previous_suggestion = None
-                        if item.get("evaluation") and item["evaluation"].get("type") == "CLOSE_MATCH":
-                            previous_suggestion = item["evaluation"].get("product")
-
-                        if previous_suggestion:
-                            suggestion_key = _get_product_key(previous_suggestion)
-                            if not found_products or not any(_get_product_key(p) == suggestion_key for p in found_products):
-                                found_products = [previous_suggestion] + (found_products or [])
-                        
-                        if not found_products and page > 0: break
-
-                        current_evaluation = evaluate_and_choose_product(
-                            query_for_evaluation, history_text, found_products, model_choice, api_key=api_key
-                        )
-
-                        if current_evaluation.get("type") == "PERFECT_MATCH":
-                            best_evaluation = current_evaluation
-                            break
-                        
-                        if not best_evaluation or current_evaluation.get("score", 0.0) > best_evaluation.get("score", 0.0):
-                            best_evaluation = current_evaluation
-                        
-                        if best_evaluation and best_evaluation.get("score", 0.0) >= 0.8:
-                            break
-                        
-                        if not found_products: break
-                    
-                    item["evaluation"] = best_evaluation if best_evaluation else {"type": "NO_MATCH"}
-                    
                     if item["evaluation"].get("type") == "PERFECT_MATCH":
                         product_data = item["evaluation"]["product"]
                         requested_quantity = item["intent"].get("quantity", 1)
@@ -917,16 +1051,16 @@ async def chat_endpoint(
             response_text = "Dạ, anh/chị muốn mua sản phẩm nào ạ?"
 
     elif asking_for_more and session_data.get("last_query"):
-        response_text, retrieved_data, product_images = _handle_more_products(
-            customer_id, user_query, session_data, history, model_choice, analysis_result, db, api_key=api_key
+        response_text, retrieved_data, product_images = await _handle_more_products(
+            customer_id, user_query, session_data, history, model_choice, analysis_result, db, api_key=api_key, on_token=on_token
         )
     else:
-        session_data["shown_product_keys"] = []  # Sử dụng list thay vì set
-        response_text, retrieved_data, product_images = _handle_new_query(
-            customer_id, user_query, session_data, history, model_choice, analysis_result, db, api_key=api_key
+        session_data["shown_product_keys"] = []
+        response_text, retrieved_data, product_images = await _handle_new_query(
+            customer_id, user_query, session_data, history, model_choice, analysis_result, db, api_key=api_key, on_token=on_token
         )
 
-    _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
+    await _update_chat_history(db, customer_id, session_id, user_query, response_text, session_data)
     images = _process_images(analysis_result.get("wants_images", False), retrieved_data, product_images)
 
     action_data = None
@@ -938,7 +1072,7 @@ async def chat_endpoint(
             action_data = {"action": "redirect", "url": product_link}
 
 
-    final_history = _format_db_history(get_chat_history(db, customer_id, session_id, limit=50))
+    final_history = await _final_history(db, customer_id, session_id)
     return ChatResponse(
         reply=response_text,
         history=final_history,
@@ -950,6 +1084,81 @@ async def chat_endpoint(
         action_data=action_data
     )
 
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# Giữ tham chiếu tới các lượt chat stream đang chạy (kể cả khi client đã ngắt kết nối) để task không bị GC thu hồi
+_stream_turn_tasks: set = set()
+
+async def _chat_with_own_session(**kwargs) -> ChatResponse:
+    """Chạy chat_endpoint với DB session riêng (AsyncSession nếu bật DB_ASYNC_ENABLED), mở và đóng ngay trong task của lượt chat."""
+    if async_database.is_async_db_ready():
+        async with async_database.AsyncSessionLocal() as db:
+            return await chat_endpoint(db=db, **kwargs)
+    db = SessionLocal()
+    try:
+        return await chat_endpoint(db=db, **kwargs)
+    finally:
+        db.close()
+
+async def chat_stream_endpoint(
+    customer_id: str,
+    session_id: str,
+    message: str,
+    model_choice: str,
+    api_key: str,
+    image_url: Optional[str] = None,
+    image: Optional[UploadFile] = None,
+    history_mode: str = "full"
+) -> AsyncIterator[str]:
+    """
+    Phiên bản streaming (Server-Sent Events) của chat_endpoint.
+    - event "token": {"text": ...} mỗi khi LLM sinh thêm một đoạn câu trả lời.
+    - event "done": ChatResponse đầy đủ (reply cuối cùng, images, action_data, has_purchase...), client nên hiển thị lại theo reply này.
+    - event "error": {"detail": ...} nếu xử lý thất bại.
+    Các nhánh không gọi LLM sinh văn bản (chốt đơn, chuyển nhân viên, yêu cầu ảnh...) chỉ gửi event "done".
+    Lượt chat chạy trong task riêng và tự quản lý DB session: client ngắt kết nối thì response bị hủy
+    nhưng lượt chat vẫn chạy xong và đóng session của nó.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def on_token(text: str):
+        await queue.put(text)
+
+    chat_task = asyncio.create_task(_chat_with_own_session(
+        customer_id=customer_id,
+        session_id=session_id,
+        message=message,
+        model_choice=model_choice,
+        api_key=api_key,
+        image_url=image_url,
+        image=image,
+        on_token=on_token,
+        history_mode=history_mode
+    ))
+    _stream_turn_tasks.add(chat_task)
+    chat_task.add_done_callback(_stream_turn_tasks.discard)
+    chat_task.add_done_callback(lambda _: queue.put_nowait(None))
+
+    try:
+        while True:
+            text = await queue.get()
+            if text is None:
+                break
+            yield _sse_event("token", {"text": text})
+
+        response = chat_task.result()
+        yield _sse_event("done", response.model_dump(mode="json"))
+    except HTTPException as e:
+        yield _sse_event("error", {"detail": e.detail})
+    except Exception as e:
+        print(f"Lỗi khi stream phản hồi chat: {e}")
+        yield _sse_event("error", {"detail": "Đã có lỗi xảy ra khi xử lý tin nhắn."})
+    finally:
+        # Client ngắt kết nối giữa chừng: để lượt chat chạy xong nhằm lưu lịch sử/session nhất quán
+        if not chat_task.done():
+            await asyncio.shield(chat_task)
+
 async def control_bot_endpoint(request: ControlBotRequest, customer_id: str, session_id: str, db: Session):
     """
     Điều khiển trạng thái của bot (dừng hoặc tiếp tục).
@@ -976,7 +1185,7 @@ async def control_bot_endpoint(request: ControlBotRequest, customer_id: str, ses
     command = request.command.lower()
     
     if command == "stop":
-        create_or_update_session_control(db, customer_id, session_id, "stopped")
+        set_session_status(db, customer_id, session_id, "stopped")
         
         # with chat_history_lock: # Removed as per new_code
         #     chat_history[composite_session_id]["collected_customer_info"] = {} # Removed as per new_code
@@ -984,11 +1193,11 @@ async def control_bot_endpoint(request: ControlBotRequest, customer_id: str, ses
         return {"status": "success", "message": f"Bot cho session {composite_session_id} đã được tạm dừng."}
     
     elif command == "start":
-        session_control = get_session_control(db, customer_id, session_id)
+        session_control = load_session(db, customer_id, session_id)
         current_status = session_control.status if session_control else "active"
         
         if current_status == "stopped":
-            create_or_update_session_control(db, customer_id, session_id, "active")
+            set_session_status(db, customer_id, session_id, "active")
             
             # with chat_history_lock: # Removed as per new_code
             #     chat_history[composite_session_id]["negativity_score"] = 0 # Removed as per new_code
@@ -1029,14 +1238,14 @@ async def human_chatting_endpoint(customer_id: str, session_id: str, db: Session
     #     else:
     #         message = f"Bot cho session {composite_session_id} đã chuyển sang trạng thái human_chatting." # Removed as per new_code
 
-    create_or_update_session_control(db, customer_id, session_id, "human_chatting")
+    set_session_status(db, customer_id, session_id, "human_chatting")
     
     # with chat_history_lock: # Removed as per new_code
     #     chat_history[composite_session_id]["handover_timestamp"] = time.time() # Removed as per new_code
     
     return {"status": "success", "message": f"Bot cho session {composite_session_id} đã chuyển sang trạng thái human_chatting."}
  
-def _handle_more_products(customer_id: str, user_query: str, session_data: dict, history: list, model_choice: str, analysis: dict, db: Session, api_key: str = None):
+async def _handle_more_products(customer_id: str, user_query: str, session_data: dict, history: list, model_choice: str, analysis: dict, db: Session, api_key: str = None, on_token: Optional[Callable[[str], Awaitable[None]]] = None):
     last_query = session_data.get("last_query")
     if not last_query:
         return "Dạ, em chưa biết mình đang tìm sản phẩm nào để xem thêm ạ.", [], []
@@ -1051,8 +1260,9 @@ def _handle_more_products(customer_id: str, user_query: str, session_data: dict,
     if not products_to_search and "product_name" in last_query:
         products_to_search = [last_query]
 
-    for product_intent in products_to_search:
-        retrieved_data = search_products(
+    # Tìm kiếm song song cho tất cả sản phẩm
+    search_results = await asyncio.gather(*[
+        search_products(
             customer_id=sanitized_customer_id,
             product_name=product_intent.get("product_name"),
             category=product_intent.get("category"),
@@ -1061,14 +1271,17 @@ def _handle_more_products(customer_id: str, user_query: str, session_data: dict,
             strict_properties=False,
             strict_category=False
         )
+        for product_intent in products_to_search
+    ])
+    for retrieved_data in search_results:
         all_new_products.extend(retrieved_data)
 
     history_text = format_history_text(history, limit=5)
     # Lọc tất cả sản phẩm mới tìm được cùng lúc
-    retrieved_data = filter_products_with_ai(user_query, history_text, all_new_products, api_key=api_key)
+    retrieved_data = await filter_products_with_ai(user_query, history_text, all_new_products, api_key=api_key)
     
-    shown_keys = set(session_data.get("shown_product_keys", []))  # Convert list to set for checking
-    new_products = [p for p in retrieved_data if _get_product_key(p) not in shown_keys]
+    shown_hashes = get_shown_product_hashes(session_data)
+    new_products = [p for p in retrieved_data if hash_product_key(_get_product_key(p)) not in shown_hashes]
 
     if not new_products:
         response_text = "Dạ, hết rồi ạ."
@@ -1077,23 +1290,15 @@ def _handle_more_products(customer_id: str, user_query: str, session_data: dict,
 
 
 
-    # Thêm product keys mới vào list (tránh duplicate)
-    for p in new_products:
-        product_key = _get_product_key(p)
-        if product_key not in session_data["shown_product_keys"]:
-            session_data["shown_product_keys"].append(product_key)
+    # Ghi nhớ các sản phẩm vừa hiển thị (tránh duplicate, giới hạn SHOWN_PRODUCT_KEYS_MAX)
+    add_shown_product_keys(session_data, [_get_product_key(p) for p in new_products], SHOWN_PRODUCT_KEYS_MAX)
 
     # Kiểm tra is_sale
-    session_id = session_data.get("session_id", "")
-    is_sale_customer = False
-    if session_id:
-        customer_sale_info = get_customer_is_sale(db, customer_id, session_id)
-        if customer_sale_info and customer_sale_info.is_sale:
-            is_sale_customer = True
+    is_sale_customer = await run_db(db, is_sale_thread, customer_id, session_data.get("session_id", ""))
 
 
-    result = generate_llm_response(
-        user_query, new_products, history, analysis["wants_specs"], model_choice, True, analysis["wants_images"], db=db, customer_id=customer_id, api_key=api_key, is_sale=is_sale_customer
+    result = await generate_llm_response(
+        user_query, new_products, history, analysis["wants_specs"], model_choice, True, analysis["wants_images"], db=db, customer_id=customer_id, api_key=api_key, is_sale=is_sale_customer, on_token=on_token
     )
     
     product_images = []
@@ -1106,10 +1311,9 @@ def _handle_more_products(customer_id: str, user_query: str, session_data: dict,
         response_text = result
 
     session_data["offset"] = new_offset
-    session_data["shown_product_keys"] = shown_keys
     return response_text, new_products, product_images
 
-def _handle_new_query(customer_id: str, user_query: str, session_data: dict, history: list, model_choice: str, analysis: dict, db: Session, api_key: str = None):
+async def _handle_new_query(customer_id: str, user_query: str, session_data: dict, history: list, model_choice: str, analysis: dict, db: Session, api_key: str = None, on_token: Optional[Callable[[str], Awaitable[None]]] = None):
     retrieved_data = []
     product_images = []
     sanitized_customer_id = sanitize_for_es(customer_id)
@@ -1121,13 +1325,13 @@ def _handle_new_query(customer_id: str, user_query: str, session_data: dict, his
         if products_list:
             history_text = format_history_text(history, limit=5)
             
-            for product_intent in products_list:
+            async def search_and_filter(product_intent: dict) -> list:
                 product_name_to_search = product_intent.get("product_name", user_query)
                 category_to_search = product_intent.get("category", user_query)
                 properties_to_search = product_intent.get("properties")
 
                 # Tìm kiếm cho từng sản phẩm
-                found_products = search_products(
+                found_products = await search_products(
                     customer_id=sanitized_customer_id,
                     product_name=product_name_to_search,
                     category=category_to_search,
@@ -1136,13 +1340,16 @@ def _handle_new_query(customer_id: str, user_query: str, session_data: dict, his
                     strict_category=False,
                     strict_properties=False
                 )
-                
-                # Lọc kết quả và thêm vào danh sách chung
-                if found_products:
-                    # Tạo một truy vấn con cho AI filter để nó hiểu ngữ cảnh của từng sản phẩm
-                    sub_user_query = f"{product_name_to_search} {properties_to_search or ''}".strip()
-                    filtered_products = filter_products_with_ai(sub_user_query, history_text, found_products, api_key=api_key)
-                    all_retrieved_data.extend(filtered_products)
+                if not found_products:
+                    return []
+
+                # Tạo một truy vấn con cho AI filter để nó hiểu ngữ cảnh của từng sản phẩm
+                sub_user_query = f"{product_name_to_search} {properties_to_search or ''}".strip()
+                return await filter_products_with_ai(sub_user_query, history_text, found_products, api_key=api_key)
+
+            # Tìm kiếm và lọc song song cho từng sản phẩm, giữ nguyên thứ tự kết quả
+            for filtered_products in await asyncio.gather(*[search_and_filter(p) for p in products_list]):
+                all_retrieved_data.extend(filtered_products)
 
             retrieved_data = all_retrieved_data
             
@@ -1151,22 +1358,18 @@ def _handle_new_query(customer_id: str, user_query: str, session_data: dict, his
                 "products": products_list
             }
             session_data["offset"] = 0
-            session_data["shown_product_keys"] = [_get_product_key(p) for p in retrieved_data]  # Sử dụng list thay vì set
+            session_data["shown_product_keys"] = []
+            add_shown_product_keys(session_data, [_get_product_key(p) for p in retrieved_data], SHOWN_PRODUCT_KEYS_MAX)
         else:
             session_data["last_query"] = None
             session_data["offset"] = 0
-            session_data["shown_product_keys"] = []  # Sử dụng list thay vì set
+            session_data["shown_product_keys"] = []
 
     # Kiểm tra is_sale
-    session_id = session_data.get("session_id", "")
-    is_sale_customer = False
-    if session_id:
-        customer_sale_info = get_customer_is_sale(db, customer_id, session_id)
-        if customer_sale_info and customer_sale_info.is_sale:
-            is_sale_customer = True
-
-    result = generate_llm_response(
-        user_query, retrieved_data, history, analysis["wants_specs"], model_choice, analysis["needs_search"], analysis["wants_images"], db=db, customer_id=customer_id, api_key=api_key, is_sale=is_sale_customer
+    is_sale_customer = await run_db(db, is_sale_thread, customer_id, session_data.get("session_id", ""))
+
+    result = await generate_llm_response(
+        user_query, retrieved_data, history, analysis["wants_specs"], model_choice, analysis["needs_search"], analysis["wants_images"], db=db, customer_id=customer_id, api_key=api_key, is_sale=is_sale_customer, on_token=on_token
     )
     
     if analysis["wants_images"] and isinstance(result, dict):
@@ -1179,16 +1382,19 @@ def _handle_new_query(customer_id: str, user_query: str, session_data: dict, his
 
     return response_text, retrieved_data, product_images
 
-def _update_chat_history(db: Session, customer_id: str, session_id: str, user_query: str, response_text: str, session_data: dict):
-    """Lưu tin nhắn vào DB và cập nhật session_data."""
-    add_chat_message(db, customer_id, session_id, 'user', user_query)
-    add_chat_message(db, customer_id, session_id, 'bot', response_text)
-    
-    # JSON không lưu được set
-    if 'shown_product_keys' in session_data:
-        session_data['shown_product_keys'] = list(session_data['shown_product_keys'])
-        
-    create_or_update_session_control(db, customer_id, session_id, status="active", session_data=session_data)
+def _set_order_total(db: Session, order, total_amount: float):
+    order.total_amount = total_amount
+    db.commit()
+
+async def _update_chat_history(db: Session, customer_id: str, session_id: str, user_query: str, response_text: str, session_data: dict):
+    """Lưu tin nhắn và session_data của lượt chat vào DB trong một transaction."""
+    stage_session(customer_id, session_id, "active", session_data)
+    message_ids = await run_db(db, persist_turn, customer_id, session_id, user_query, response_text)
+
+    turn_context = _turn_context.get()
+    if turn_context is not None:
+        turn_context["turns"].append({"user": user_query or "", "bot": response_text or ""})
+        turn_context["message_ids"].extend(message_ids)
 
 def _process_images(wants_images: bool, retrieved_data: list, product_images_names: list) -> list[ImageInfo]:
     images = []
@@ -1221,21 +1427,22 @@ def _process_images(wants_images: bool, retrieved_data: list, product_images_nam
                 ))
     return images
 
-async def power_off_bot_endpoint(request: ControlBotRequest):
-    global bot_running
+async def power_off_bot_endpoint(request: ControlBotRequest, db: Session):
+    """
+    Dừng hoặc khởi động bot cho toàn hệ thống. Trạng thái lưu trong database và được báo cho mọi worker.
+    """
     command = request.command.lower()
-    with bot_state_lock:
-        if command == "stop":
-            bot_running = False
-            return {"status": "success", "message": "Bot đã được tạm dừng."}
-        elif command == "start":
-            bot_running = True
-            return {"status": "success", "message": "Bot đã được kích hoạt lại."}
-        elif command == "status":
-            status_message = "Bot đang chạy" if bot_running else "Bot đã dừng"
-            return {"status": "info", "message": status_message}
-        else:
-            raise HTTPException(status_code=400, detail="Invalid command. Use 'start' or 'stop'.")
+    if command == "stop":
+        set_bot_running(db, False)
+        return {"status": "success", "message": "Bot đã được tạm dừng."}
+    elif command == "start":
+        set_bot_running(db, True)
+        return {"status": "success", "message": "Bot đã được kích hoạt lại."}
+    elif command == "status":
+        status_message = "Bot đang chạy" if is_bot_running() else "Bot đã dừng"
+        return {"status": "info", "message": status_message}
+    else:
+        raise HTTPException(status_code=400, detail="Invalid command. Use 'start' or 'stop'.")
 
 async def power_off_bot_customer_endpoint(customer_id: str, request: ControlBotRequest, db: Session):
     """
@@ -1246,21 +1453,23 @@ async def power_off_bot_customer_endpoint(customer_id: str, request: ControlBotR
     if command == "stop":
         # Tắt bot cho customer trong bảng BotStatus
         power_off_bot_for_customer(db, customer_id)
+        set_tenant_bot_active(customer_id, False)
         return {"status": "success", "message": f"Bot đã được tắt cho customer {customer_id}. Tất cả sessions của customer này sẽ không hoạt động."}
     
     elif command == "start":
         # Bật bot cho customer trong bảng BotStatus
         power_on_bot_for_customer(db, customer_id)
+        set_tenant_bot_active(customer_id, True)
         return {"status": "success", "message": f"Bot đã được bật cho customer {customer_id}. Tất cả sessions của customer này sẽ hoạt động bình thường."}
     
     elif command == "status":
         # Kiểm tra trạng thái bot của customer từ bảng BotStatus
         bot_active = is_bot_active(db, customer_id)
-        sessions = get_all_session_controls_by_customer(db, customer_id)
+        total_sessions, _ = count_session_controls_by_status(db, customer_id)
         
         status_message = f"Customer {customer_id}: Bot {'ĐANG HOẠT ĐỘNG' if bot_active else 'ĐÃ TẮT'}"
-        if sessions:
-            status_message += f" - Có {len(sessions)} session(s) trong hệ thống"
+        if total_sessions:
+            status_message += f" - Có {total_sessions} session(s) trong hệ thống"
         else:
             status_message += " - Chưa có session nào"
         
@@ -1285,20 +1494,31 @@ async def get_session_controls_endpoint(customer_id: str, db: Session):
             "session_id": control.session_id,
             "session_name": control.session_name,
             "status": control.status,
+            "state": control.state,
             "created_at": control.created_at.isoformat() if control.created_at else None,
             "updated_at": control.updated_at.isoformat() if control.updated_at else None
         })
     
     return {"status": "success", "data": result}
 
-async def get_chat_history_endpoint(customer_id: str, session_id: str, db: Session):
+async def get_chat_history_endpoint(customer_id: str, session_id: str, db: Session, before_id: Optional[int] = None, limit: Optional[int] = None):
     """
-    Lấy toàn bộ lịch sử chat của một thread.
+    Lấy lịch sử chat của một thread, tin mới nhất trước.
+    - Không truyền limit: trả toàn bộ thread như trước.
+    - Có limit: phân trang keyset, trả tối đa `limit` tin nhắn cũ hơn before_id kèm next_before_id (None nếu hết).
     """
-    history_records = get_full_chat_history(db, customer_id, session_id)
+    next_before_id = None
+    if limit is None and before_id is None:
+        history_records = get_full_chat_history(db, customer_id, session_id)
+    else:
+        limit = max(1, min(limit or 100, 500))
+        history_records = get_chat_history_page(db, customer_id, session_id, before_id=before_id, limit=limit)
+        history_records.reverse()
+        if len(history_records) == limit:
+            next_before_id = history_records[-1].id
     
     if not history_records:
-        return {"status": "success", "data": []}
+        return {"status": "success", "data": [], "next_before_id": None}
 
     result = []
     for record in history_records:
@@ -1311,7 +1531,27 @@ async def get_chat_history_endpoint(customer_id: str, session_id: str, db: Sessi
             "created_at": record.created_at.isoformat()
         })
         
-    return {"status": "success", "data": result}
+    return {"status": "success", "data": result, "next_before_id": next_before_id}
+
+async def get_chat_turns_endpoint(customer_id: str, session_id: str, db: Session, before_id: Optional[int] = None, limit: int = 20):
+    """
+    Lấy lịch sử chat theo từng lượt (user/bot) để widget tải lần đầu và cuộn lên xem tin cũ.
+    Trả về tối đa `limit` lượt trước tin nhắn before_id, kèm next_before_id để lấy trang tiếp theo (None nếu hết).
+    """
+    limit = max(1, min(limit, 100))
+    records = get_chat_history_page(db, customer_id, session_id, before_id=before_id, limit=limit * 2)
+    has_more = len(records) == limit * 2
+
+    # Không cắt đôi một lượt: tin bot đầu trang thuộc về tin user ở trang trước
+    if has_more and records and records[0].role == 'bot':
+        records = records[1:]
+
+    return {
+        "status": "success",
+        "data": _format_db_history(records),
+        "next_before_id": records[0].id if has_more and records else None,
+        "last_message_id": records[-1].id if records else None
+    }
 
 async def get_bot_status_endpoint(customer_id: str, db: Session):
     """
@@ -1352,6 +1592,9 @@ async def delete_chat_history_endpoint(customer_id: str, session_id: str, db: Se
     Xóa lịch sử chat của session_id thuộc customer_id.
     """
     try:
+        # Ghi các thay đổi session đang chờ trước khi sửa trực tiếp trong database
+        flush_session(db, customer_id, session_id, force=True)
+
         # Kiểm tra xem session có tồn tại không
         session_control = get_session_control(db, customer_id, session_id)
         if not session_control:
@@ -1393,8 +1636,12 @@ async def delete_chat_history_endpoint(customer_id: str, session_id: str, db: Se
                 "has_past_purchase": False,
                 "pending_order": None
             }
+        session_control.state = None
+        session_control.handover_timestamp = None
         
         db.commit()
+        invalidate_session(customer_id, session_id)
+        cancel_handover(customer_id, session_id)
         
         return {
             "status": "success",
@@ -2,6 +2,7 @@ from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from database.database import get_db, get_customer_is_sale, create_or_update_customer_is_sale
 from src.models.schemas import CustomerIsSale, CustomerIsSaleCreate
+from src.services.tenant_state import set_tenant_sale
 
 router = APIRouter()
 
@@ -19,6 +20,7 @@ async def set_customer_is_sale(
         thread_id=customer_is_sale.thread_id,
         is_sale=customer_is_sale.is_sale
     )
+    set_tenant_sale(customer_is_sale.customer_id, customer_is_sale.thread_id, customer_is_sale.is_sale)
     return db_customer_is_sale
 
 @router.get("/customer-is-sale/{customer_id}/{thread_id}", response_model=CustomerIsSale, tags=["Customer is Sale"])
@@ -5,6 +5,8 @@ from typing import List
 from database.database import Customer
 from src.models.schemas import StoreInfo
 from dependencies import get_db
+from src.services.response_cache import invalidate_response_cache
+from src.services.config_cache import invalidate_config_cache
 
 router = APIRouter()
 
@@ -30,6 +32,8 @@ def create_or_update_store_info(
         
     db.commit()
     db.refresh(customer)
+    invalidate_config_cache(customer_id)
+    invalidate_response_cache(customer_id)
     return customer
 
 @router.get("/{customer_id}", response_model=StoreInfo)
@@ -74,4 +78,6 @@ def delete_store_info(
     
     db.delete(customer)
     db.commit()
+    invalidate_config_cache(customer_id)
+    invalidate_response_cache(customer_id)
     return None
@@ -4,14 +4,15 @@ Chứa các API để quản lý đơn hàng của customers
 """
 
 from fastapi import APIRouter, HTTPException, Query, Depends
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload, joinedload
 from typing import Optional
 from datetime import datetime
 from dependencies import get_db
 from database.database import (
-    CustomerProfile, Order, OrderItem,
-    get_customer_profile, get_customer_profile_by_phone,
-    get_customer_order_history, get_orders_by_customer_profile
+    Order,
+    get_customer_profile_by_phone,
+    get_customer_order_history, get_orders_page,
+    get_orders_summary, get_materialized_orders_summary, update_order_status as save_order_status, ORDER_SUMMARY_MATERIALIZED
 )
 
 # Tạo router với tag
@@ -21,37 +22,21 @@ router = APIRouter(
     responses={404: {"description": "Not found"}}
 )
 
-async def get_orders_by_customer_endpoint(customer_id: str, db: Session, session_id: Optional[str] = None):
+async def get_orders_by_customer_endpoint(customer_id: str, db: Session, session_id: Optional[str] = None,
+                                          limit: Optional[int] = None, cursor: Optional[int] = None):
     """
-    Lấy tất cả đơn hàng của customer_id.
+    Lấy đơn hàng của customer_id (mới nhất trước).
     Có thể filter theo session_id nếu được cung cấp.
+    Có limit thì phân trang: truyền next_cursor của trang trước vào cursor để lấy trang tiếp theo.
     """
     try:
-        orders = []
-        
-        if session_id:
-            # Lấy đơn hàng theo customer_id + session_id
-            profile = get_customer_profile(db, customer_id, session_id)
-            if profile:
-                orders = get_orders_by_customer_profile(db, profile.id)
-        else:
-            # Lấy tất cả đơn hàng của customer_id (từ tất cả sessions)
-            profiles = db.query(CustomerProfile).filter(
-                CustomerProfile.customer_id == customer_id
-            ).all()
-            
-            for profile in profiles:
-                profile_orders = get_orders_by_customer_profile(db, profile.id)
-                orders.extend(profile_orders)
+        orders = get_orders_page(db, customer_id, session_id=session_id, cursor=cursor, limit=limit)
         
         # Format response
         result = []
         for order in orders:
-            # Lấy order items
-            order_items = db.query(OrderItem).filter(OrderItem.order_id == order.id).all()
-            
             items_data = []
-            for item in order_items:
+            for item in order.order_items:
                 items_data.append({
                     "id": item.id,
                     "product_name": item.product_name,
@@ -62,8 +47,8 @@ async def get_orders_by_customer_endpoint(customer_id: str, db: Session, session
                     "created_at": item.created_at.isoformat()
                 })
             
-            # Lấy thông tin customer profile
-            profile = db.query(CustomerProfile).filter(CustomerProfile.id == order.customer_profile_id).first()
+            # Customer profile đã được JOIN sẵn trong truy vấn
+            profile = order.customer_profile
             
             order_data = {
                 "id": order.id,
@@ -86,13 +71,11 @@ async def get_orders_by_customer_endpoint(customer_id: str, db: Session, session
             }
             result.append(order_data)
         
-        # Sắp xếp theo thời gian tạo (mới nhất trước)
-        result.sort(key=lambda x: x["created_at"], reverse=True)
-        
         return {
             "status": "success",
             "data": result,
             "total_orders": len(result),
+            "next_cursor": orders[-1].id if limit is not None and len(orders) == limit else None,
             "customer_id": customer_id,
             "session_id": session_id
         }
@@ -105,8 +88,11 @@ async def get_order_by_id_endpoint(customer_id: str, order_id: int, db: Session)
     Lấy chi tiết một đơn hàng cụ thể theo order_id và customer_id.
     """
     try:
-        # Kiểm tra đơn hàng có thuộc về customer này không
-        order = db.query(Order).filter(
+        # Kiểm tra đơn hàng có thuộc về customer này không (nạp luôn items và profile)
+        order = db.query(Order).options(
+            selectinload(Order.order_items),
+            joinedload(Order.customer_profile)
+        ).filter(
             Order.id == order_id,
             Order.customer_id == customer_id
         ).first()
@@ -117,12 +103,9 @@ async def get_order_by_id_endpoint(customer_id: str, order_id: int, db: Session)
                 "message": f"Không tìm thấy đơn hàng #{order_id} cho customer {customer_id}"
             }
         
-        # Lấy order items
-        order_items = db.query(OrderItem).filter(OrderItem.order_id == order.id).all()
-        
         items_data = []
         total_quantity = 0
-        for item in order_items:
+        for item in order.order_items:
             items_data.append({
                 "id": item.id,
                 "product_name": item.product_name,
@@ -134,8 +117,7 @@ async def get_order_by_id_endpoint(customer_id: str, order_id: int, db: Session)
             })
             total_quantity += item.quantity
         
-        # Lấy thông tin customer profile
-        profile = db.query(CustomerProfile).filter(CustomerProfile.id == order.customer_profile_id).first()
+        profile = order.customer_profile
         
         return {
             "status": "success",
@@ -165,9 +147,11 @@ async def get_order_by_id_endpoint(customer_id: str, order_id: int, db: Session)
     except Exception as e:
         return {"status": "error", "message": f"Lỗi khi lấy chi tiết đơn hàng: {str(e)}"}
 
-async def get_orders_by_status_endpoint(customer_id: str, status: str, db: Session):
+async def get_orders_by_status_endpoint(customer_id: str, status: str, db: Session,
+                                        limit: Optional[int] = None, cursor: Optional[int] = None):
     """
     Lấy đơn hàng của customer theo trạng thái (pending, confirmed, completed, cancelled).
+    Phân trang bằng limit/cursor giống get_orders_by_customer_endpoint.
     """
     try:
         valid_statuses = ["pending", "confirmed", "completed", "cancelled"]
@@ -178,18 +162,12 @@ async def get_orders_by_status_endpoint(customer_id: str, status: str, db: Sessi
             }
         
         # Lấy đơn hàng theo trạng thái
-        orders = db.query(Order).filter(
-            Order.customer_id == customer_id,
-            Order.order_status == status
-        ).order_by(Order.created_at.desc()).all()
+        orders = get_orders_page(db, customer_id, status=status, cursor=cursor, limit=limit)
         
         result = []
         for order in orders:
-            # Lấy order items
-            order_items = db.query(OrderItem).filter(OrderItem.order_id == order.id).all()
-            
             items_data = []
-            for item in order_items:
+            for item in order.order_items:
                 items_data.append({
                     "id": item.id,
                     "product_name": item.product_name,
@@ -199,8 +177,7 @@ async def get_orders_by_status_endpoint(customer_id: str, status: str, db: Sessi
                     "total_price": item.total_price
                 })
             
-            # Lấy thông tin customer profile
-            profile = db.query(CustomerProfile).filter(CustomerProfile.id == order.customer_profile_id).first()
+            profile = order.customer_profile
             
             order_data = {
                 "id": order.id,
@@ -223,6 +200,7 @@ async def get_orders_by_status_endpoint(customer_id: str, status: str, db: Sessi
             "status": "success",
             "data": result,
             "total_orders": len(result),
+            "next_cursor": orders[-1].id if limit is not None and len(orders) == limit else None,
             "customer_id": customer_id,
             "filter_status": status
         }
@@ -233,57 +211,30 @@ async def get_orders_by_status_endpoint(customer_id: str, status: str, db: Sessi
 async def get_orders_summary_endpoint(customer_id: str, db: Session):
     """
     Lấy tóm tắt đơn hàng của customer (thống kê theo trạng thái).
+    Một truy vấn GROUP BY, hoặc đọc bảng tổng hợp khi bật ORDER_SUMMARY_MATERIALIZED.
     """
     try:
-        # Đếm đơn hàng theo từng trạng thái
-        pending_count = db.query(Order).filter(
-            Order.customer_id == customer_id,
-            Order.order_status == "pending"
-        ).count()
-        
-        confirmed_count = db.query(Order).filter(
-            Order.customer_id == customer_id,
-            Order.order_status == "confirmed"
-        ).count()
-        
-        completed_count = db.query(Order).filter(
-            Order.customer_id == customer_id,
-            Order.order_status == "completed"
-        ).count()
-        
-        cancelled_count = db.query(Order).filter(
-            Order.customer_id == customer_id,
-            Order.order_status == "cancelled"
-        ).count()
-        
-        total_orders = pending_count + confirmed_count + completed_count + cancelled_count
-        
-        # Lấy đơn hàng gần nhất
-        latest_order = db.query(Order).filter(
-            Order.customer_id == customer_id
-        ).order_by(Order.created_at.desc()).first()
+        if ORDER_SUMMARY_MATERIALIZED:
+            summary = get_materialized_orders_summary(db, customer_id)
+        else:
+            summary = get_orders_summary(db, customer_id)
         
-        # Tính tổng số sản phẩm đã bán
-        total_items = db.query(OrderItem).join(Order).filter(
-            Order.customer_id == customer_id
-        ).count()
+        # Luôn trả đủ 4 trạng thái chuẩn, kèm các trạng thái khác đang có (vd: "Chưa gọi")
+        orders_by_status = {status: 0 for status in ["pending", "confirmed", "completed", "cancelled"]}
+        orders_by_status.update(summary["orders_by_status"])
+        latest_order = summary["latest_order"]
         
         return {
             "status": "success",
             "data": {
                 "customer_id": customer_id,
-                "total_orders": total_orders,
-                "orders_by_status": {
-                    "pending": pending_count,
-                    "confirmed": confirmed_count,
-                    "completed": completed_count,
-                    "cancelled": cancelled_count
-                },
-                "total_items": total_items,
+                "total_orders": summary["total_orders"],
+                "orders_by_status": orders_by_status,
+                "total_items": summary["total_items"],
                 "latest_order": {
-                    "id": latest_order.id,
-                    "created_at": latest_order.created_at.isoformat(),
-                    "status": latest_order.order_status
+                    "id": latest_order["id"],
+                    "created_at": latest_order["created_at"].isoformat(),
+                    "status": latest_order["status"]
                 } if latest_order else None
             }
         }
@@ -303,11 +254,11 @@ async def update_order_status_endpoint(customer_id: str, thread_id: str, order_i
                 "message": f"Trạng thái không hợp lệ. Chỉ chấp nhận: {', '.join(valid_statuses)}"
             }
         
-        # Tìm đơn hàng
+        # Tìm đơn hàng (thread_id chính là session_id của đơn hàng)
         order = db.query(Order).filter(
             Order.id == order_id,
             Order.customer_id == customer_id,
-            Order.thread_id == thread_id
+            Order.session_id == thread_id
         ).first()
         
         if not order:
@@ -317,8 +268,7 @@ async def update_order_status_endpoint(customer_id: str, thread_id: str, order_i
             }
         
         old_status = order.order_status
-        order.order_status = new_status
-        db.commit()
+        save_order_status(db, order.id, new_status)
         
         return {
             "status": "success",
@@ -343,18 +293,21 @@ async def update_order_status_endpoint(customer_id: str, thread_id: str, order_i
 async def get_orders_by_customer(
     customer_id: str,
     session_id: str = Query(None, description="ID session để filter (tùy chọn)"),
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Số đơn hàng mỗi trang (bỏ trống để lấy tất cả)"),
+    cursor: Optional[int] = Query(None, description="next_cursor của trang trước"),
     db: Session = Depends(get_db)
 ):
     """
     Endpoint để lấy tất cả đơn hàng của một customer.
     - **customer_id**: Mã khách hàng.
     - **session_id**: ID session để filter (tùy chọn). Nếu không cung cấp sẽ lấy tất cả đơn hàng.
+    - **limit**, **cursor**: phân trang (tùy chọn), đơn hàng mới nhất trước.
     
     Returns:
     - Danh sách đơn hàng với thông tin chi tiết
     - Thông tin khách hàng và sản phẩm trong từng đơn hàng
     """
-    return await get_orders_by_customer_endpoint(customer_id, db, session_id)
+    return await get_orders_by_customer_endpoint(customer_id, db, session_id, limit=limit, cursor=cursor)
 
 @router.get("/{customer_id}/{order_id}", summary="Lấy chi tiết một đơn hàng")
 async def get_order_by_id(
@@ -378,17 +331,20 @@ async def get_order_by_id(
 async def get_orders_by_status(
     customer_id: str,
     status: str,
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Số đơn hàng mỗi trang (bỏ trống để lấy tất cả)"),
+    cursor: Optional[int] = Query(None, description="next_cursor của trang trước"),
     db: Session = Depends(get_db)
 ):
     """
     Endpoint để lấy đơn hàng theo trạng thái.
     - **customer_id**: Mã khách hàng.
     - **status**: Trạng thái đơn hàng (pending, confirmed, completed, cancelled).
+    - **limit**, **cursor**: phân trang (tùy chọn).
     
     Returns:
     - Danh sách đơn hàng có trạng thái được chỉ định
     """
-    return await get_orders_by_status_endpoint(customer_id, status, db)
+    return await get_orders_by_status_endpoint(customer_id, status, db, limit=limit, cursor=cursor)
 
 @router.get("/{customer_id}/summary", summary="Lấy tóm tắt đơn hàng của customer")
 async def get_orders_summary(
@@ -8,6 +8,8 @@ from database.database import (
     get_combined_system_prompt
 )
 from src.models.schemas import SystemPromptResponse, SystemPromptUpdate
+from src.services.response_cache import invalidate_response_cache
+from src.services.config_cache import invalidate_config_cache
 
 prompt_router = APIRouter()
 
@@ -34,6 +36,8 @@ def update_general_prompt_endpoint(
     updated_prompt = update_general_prompt(db, prompt_data.prompt_content)
     if not updated_prompt:
         raise HTTPException(status_code=500, detail="Failed to update the general prompt.")
+    invalidate_config_cache()
+    invalidate_response_cache()
     return SystemPromptResponse(prompt_content=updated_prompt.prompt_content)
 
 @prompt_router.get("/prompts/{customer_id}", response_model=SystemPromptResponse, summary="Get Customer System Prompt (Customer chỉnh)")
@@ -64,6 +68,8 @@ def update_prompt(
     updated_prompt = update_system_prompt(db, customer_id, prompt_data.prompt_content)
     if not updated_prompt:
         raise HTTPException(status_code=500, detail="Failed to update the prompt.")
+    invalidate_config_cache(customer_id)
+    invalidate_response_cache(customer_id)
     return SystemPromptResponse(prompt_content=updated_prompt.prompt_content)
 
 # === COMBINED PROMPT ENDPOINT ===
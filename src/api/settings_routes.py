@@ -2,8 +2,9 @@ import os
 import shutil
 from fastapi import APIRouter, Depends, HTTPException, Path, File, UploadFile
 from sqlalchemy.orm import Session
-from database.database import get_db, get_chatbot_settings, create_or_update_chatbot_settings
+from database.database import get_db, create_or_update_chatbot_settings
 from src.models.schemas import ChatbotSettingsResponse, ChatbotSettingsCreate
+from src.services.config_cache import get_chatbot_settings_cached, invalidate_config_cache
 
 router = APIRouter()
 
@@ -15,7 +16,7 @@ def read_chatbot_settings(
     """
     Retrieve chatbot settings for a specific customer.
     """
-    settings = get_chatbot_settings(db, customer_id)
+    settings = get_chatbot_settings_cached(db, customer_id)
     if not settings:
         # Return default settings if none are found
         return ChatbotSettingsResponse()
@@ -35,7 +36,9 @@ def create_or_update_settings(
     if not update_data:
         raise HTTPException(status_code=400, detail="No settings data provided")
 
-    return create_or_update_chatbot_settings(db, customer_id, update_data)
+    settings = create_or_update_chatbot_settings(db, customer_id, update_data)
+    invalidate_config_cache(customer_id)
+    return settings
 
 @router.post("/settings/{customer_id}/upload-icon", response_model=ChatbotSettingsResponse)
 def upload_chatbot_icon(
@@ -75,4 +78,6 @@ def upload_chatbot_icon(
     icon_url = f"/images/{new_filename}"
     update_data = {"chatbot_icon_url": icon_url}
     
-    return create_or_update_chatbot_settings(db, customer_id, update_data)
+    settings = create_or_update_chatbot_settings(db, customer_id, update_data)
+    invalidate_config_cache(customer_id)
+    return settings
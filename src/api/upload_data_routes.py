@@ -14,6 +14,7 @@ from elastic_search_push_data import (
 )
 from src.models.schemas import ProductRow, BulkDeleteInput
 from src.utils.helpers import sanitize_for_es
+from src.services.response_cache import invalidate_response_cache
 router = APIRouter()
 
 PRODUCT_COLUMNS_CONFIG = {
@@ -69,6 +70,8 @@ async def upload_product_data(
             file_content=content,
             columns_config=PRODUCT_COLUMNS_CONFIG
         )
+        # Xóa cache sau khi ghi xong: xóa trước thì lượt chat chạy song song có thể cache lại dữ liệu cũ
+        invalidate_response_cache(customer_id)
         
         return {
             "message": f"Dữ liệu sản phẩm cho khách hàng '{customer_id}' đã được xử lý.",
@@ -100,6 +103,7 @@ async def add_product(
             raise HTTPException(status_code=400, detail="Thiếu 'product_code' trong dữ liệu đầu vào.")
 
         response = await index_single_document(es_client, PRODUCTS_INDEX, sanitized_customer_id, doc_id, product_dict)
+        invalidate_response_cache(customer_id)
         return {"message": "Sản phẩm đã được thêm/cập nhật thành công.", "result": response.body}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -136,6 +140,7 @@ async def update_product(
             product_id, 
             product_dict
         )
+        invalidate_response_cache(customer_id)
         
         result_status = response.body.get('result')
         if result_status == 'created':
@@ -163,6 +168,7 @@ async def delete_product(
     try:
         sanitized_customer_id = sanitize_for_es(customer_id)
         response = await delete_single_document(es_client, PRODUCTS_INDEX, sanitized_customer_id, product_id)
+        invalidate_response_cache(customer_id)
         return {"message": "Sản phẩm đã được xóa thành công.", "result": response.body}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -184,6 +190,7 @@ async def delete_all_products_by_customer(
             PRODUCTS_INDEX, 
             sanitized_customer_id
         )
+        invalidate_response_cache(customer_id)
         deleted_count = response.get('deleted', 0)
         return {"message": f"Đã xóa thành công {deleted_count} phụ kiện cho khách hàng '{customer_id}'.", "details": response}
     except Exception as e:
@@ -209,6 +216,7 @@ async def delete_products_bulk(
             delete_input.ids,
             id_field='product_code'
         )
+        invalidate_response_cache(customer_id)
         deleted_count = response.get('deleted', 0)
         return {"message": f"Đã xóa thành công {deleted_count} phụ kiện.", "details": response}
     except Exception as e:
@@ -236,6 +244,7 @@ async def add_products_bulk(
             product_dicts, 
             id_field='product_code'
         )
+        invalidate_response_cache(customer_id)
         return {
             "message": "Thao tác hàng loạt hoàn tất.",
             "successfully_indexed": success,
@@ -267,6 +276,7 @@ async def append_product_data_from_file(
             file_content=content,
             columns_config=PRODUCT_COLUMNS_CONFIG
         )
+        invalidate_response_cache(customer_id)
         
         return {
             "message": f"Dữ liệu sản phẩm cho khách hàng '{customer_id}' đã được nạp thêm/cập nhật.",
@@ -9,12 +9,90 @@ load_dotenv()
 # Cấu hình chung
 PAGE_SIZE = 10
 
+# Chế độ đánh giá sản phẩm khi chốt đơn:
+# - "paged": đánh giá từng trang PAGE_SIZE kết quả, tối đa MAX_SEARCH_PAGES lần gọi LLM cho mỗi sản phẩm
+# - "single": lấy PRODUCT_EVAL_CANDIDATES ứng viên trong một lần tìm kiếm và chấm điểm bằng một lần gọi LLM.
+#   Chỉ trả về một lựa chọn (không có danh sách xếp hạng) và CHƯA được kiểm chứng chất lượng so với "paged":
+#   chạy replay_order_evaluation.py trên các lượt chốt đơn thật của customer trước khi bật.
+PRODUCT_EVAL_MODE = os.getenv("PRODUCT_EVAL_MODE", "paged")
+PRODUCT_EVAL_CANDIDATES = int(os.getenv("PRODUCT_EVAL_CANDIDATES", "30"))
+
+# Số sản phẩm đã hiển thị tối đa nhớ trong session (hash 64-bit, bỏ dần các sản phẩm cũ nhất khi vượt quá)
+SHOWN_PRODUCT_KEYS_MAX = int(os.getenv("SHOWN_PRODUCT_KEYS_MAX", "500"))
+
+# Pool kết nối PostgreSQL (dùng cho cả engine đồng bộ và AsyncEngine)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+# statement_timeout (ms) đặt cho mỗi kết nối, 0 (mặc định) để không giới hạn
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+# Bật để lượt chat (/chat, /chat-stream) chạy mọi truy vấn trên một AsyncSession (asyncpg) thay vì Session đồng bộ chặn event loop
+DB_ASYNC_ENABLED = os.getenv("DB_ASYNC_ENABLED", "false").lower() == "true"
+# Mặc định suy ra từ DATABASE_URL (postgresql:// -> postgresql+asyncpg://)
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")
+
 # API Keys
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 LMSTUDIO_API_URL = os.getenv("LMSTUDIO_API_URL")
 LMSTUDIO_MODEL = os.getenv("LMSTUDIO_MODEL")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 ELASTIC_HOST = os.getenv("ELASTIC_HOST")
+# Số kết nối tối đa tới mỗi node Elasticsearch trong pool của AsyncElasticsearch dùng chung
+ES_CONNECTIONS_PER_NODE = int(os.getenv("ES_CONNECTIONS_PER_NODE", "25"))
+
+# LLM client pool: client được cache theo (provider, API key) để tái sử dụng kết nối giữa các lượt chat
+LLM_CLIENT_CACHE_SIZE = int(os.getenv("LLM_CLIENT_CACHE_SIZE", "64"))
+LLM_CLIENT_TTL = float(os.getenv("LLM_CLIENT_TTL", "3600"))
+
+# Cache câu trả lời của LLM theo customer_id (câu hỏi đã chuẩn hóa + context sản phẩm + system prompt)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "900"))
+
+# Cache kết quả phân tích ý định theo (câu hỏi đã chuẩn hóa, fingerprint 6 lượt hội thoại gần nhất, model_choice)
+INTENT_CACHE_SIZE = int(os.getenv("INTENT_CACHE_SIZE", "5000"))
+INTENT_CACHE_TTL = float(os.getenv("INTENT_CACHE_TTL", "3600"))
+
+# Bộ phân loại nhanh bằng luật trước LLM: chỉ dùng kết quả có confidence >= ngưỡng
+INTENT_FAST_PATH_ENABLED = os.getenv("INTENT_FAST_PATH_ENABLED", "true").lower() == "true"
+INTENT_FAST_PATH_THRESHOLD = float(os.getenv("INTENT_FAST_PATH_THRESHOLD", "0.85"))
+
+# Session store trong bộ nhớ: gộp mọi thay đổi session của một lượt chat thành một lần ghi database
+SESSION_STORE_SIZE = int(os.getenv("SESSION_STORE_SIZE", "10000"))
+SESSION_STORE_TTL = float(os.getenv("SESSION_STORE_TTL", "1800"))
+# Mỗi lần dùng session trong cache, đối chiếu status/updated_at với database (một SELECT nhỏ) để nhận thay đổi do worker khác ghi.
+# Chỉ tắt khi chạy đúng một worker.
+SESSION_STORE_VALIDATE = os.getenv("SESSION_STORE_VALIDATE", "true").lower() == "true"
+# > 0: ghi xuống database định kỳ (giây) thay vì cuối mỗi request (write-behind). Chỉ nên bật khi chạy một worker.
+SESSION_WRITE_BEHIND_INTERVAL = float(os.getenv("SESSION_WRITE_BEHIND_INTERVAL", "0"))
+# Nguồn của state/handover_timestamp: "json" (mặc định, đọc từ session_data, ghi song song vào cột) hoặc
+# "columns" (đọc từ cột; chỉ ghi lại session_data khi các trường khác thay đổi). Chỉ chuyển sang "columns" sau khi chạy
+# migration_add_session_state_columns.py.
+SESSION_STATE_SOURCE = os.getenv("SESSION_STATE_SOURCE", "json").lower()
+# Ghi session_data bằng patch JSONB (chỉ các khóa thay đổi, list dài thêm thì nối phần mới) thay vì ghi lại cả khối.
+# Cần chạy migration_session_data_jsonb.py trước khi bật.
+SESSION_DATA_PATCH_WRITES = os.getenv("SESSION_DATA_PATCH_WRITES", "false").lower() == "true"
+
+# Cache cấu hình theo customer (prompt, thông tin cửa hàng, cài đặt chatbot). TTL đảm bảo các worker khác cập nhật sau thay đổi.
+CONFIG_CACHE_SIZE = int(os.getenv("CONFIG_CACHE_SIZE", "5000"))
+CONFIG_CACHE_TTL = float(os.getenv("CONFIG_CACHE_TTL", "60"))
+
+# Cache trạng thái của từng customer (bot bật/tắt, is_sale, số session stopped/tổng). TTL giới hạn độ trễ giữa các worker.
+TENANT_CACHE_SIZE = int(os.getenv("TENANT_CACHE_SIZE", "5000"))
+TENANT_CACHE_TTL = float(os.getenv("TENANT_CACHE_TTL", "30"))
+
+# Công tắc bot toàn hệ thống (bảng global_bot_switch + LISTEN/NOTIFY): chu kỳ đọc lại (giây) phòng khi mất thông báo
+BOT_SWITCH_REFRESH_INTERVAL = float(os.getenv("BOT_SWITCH_REFRESH_INTERVAL", "60"))
+
+# Bộ hẹn giờ handover: định kỳ (giây) đọc lại các session đang chờ nhân viên để nhận handover do process khác tạo. 0 để tắt.
+HANDOVER_RESYNC_INTERVAL = float(os.getenv("HANDOVER_RESYNC_INTERVAL", "300"))
+
+# Metrics Prometheus (/metrics): thời gian từng bước của lượt chat. Mặc định mọi customer gộp thành nhãn "all";
+# METRICS_CUSTOMER_LABEL=true tách nhãn theo customer (mỗi customer sinh thêm một bộ histogram).
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_CUSTOMER_LABEL = os.getenv("METRICS_CUSTOMER_LABEL", "false").lower() == "true"
 
 # FastAPI Config
 APP_CONFIG = {
@@ -1,14 +1,16 @@
 from fastapi import FastAPI, Query, Depends, Form, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-import threading
+from fastapi.responses import StreamingResponse, Response
+import io
 import time
 
 from src.config.settings import APP_CONFIG, CORS_CONFIG
 from src.models.schemas import ControlBotRequest
 from src.api.chat_routes import chat_endpoint, HANDOVER_TIMEOUT, control_bot_endpoint, human_chatting_endpoint, power_off_bot_endpoint, get_session_controls_endpoint, get_chat_history_endpoint
-from dependencies import init_es_client, close_es_client, get_db
-from src.api.chat_routes import power_off_bot_customer_endpoint, get_bot_status_endpoint, delete_chat_history_endpoint
+from dependencies import init_es_client, close_es_client, get_db, get_chat_db
+from src.api.chat_routes import power_off_bot_customer_endpoint, get_bot_status_endpoint, delete_chat_history_endpoint, chat_stream_endpoint, get_chat_turns_endpoint
+from typing import Literal, Optional
 from src.api.order_routes import router as order_router
 from contextlib import asynccontextmanager
 from src.api import upload_data_routes, info_store_routes, settings_routes
@@ -17,6 +19,16 @@ logging.getLogger("watchfiles").setLevel(logging.ERROR)
 from sqlalchemy.orm import Session
 from src.api import customer_is_sale_routes
 from src.api.prompt_routes import prompt_router
+from src.services.llm_service import close_llm_clients, get_llm_client_stats
+from src.services.response_cache import get_response_cache_stats, invalidate_response_cache
+from src.services.intent_service import get_intent_cache_stats
+from src.services.session_store import flush_session, start_write_behind, stop_write_behind, get_session_store_stats
+from src.services.config_cache import get_config_cache_stats
+from src.services.tenant_state import get_tenant_cache_stats
+from src.services.bot_switch import start_bot_switch_listener, stop_bot_switch_listener
+from database.async_database import init_async_engine, close_async_engine
+from src.services.handover_scheduler import start_handover_scheduler, stop_handover_scheduler, get_handover_scheduler_stats
+from src.utils.metrics import render_metrics, register_stats
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -31,10 +43,16 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         print(f"❌ Elasticsearch initialization failed: {e}")
     
-    # Khởi động tác vụ nền để quét session timeout
-    scanner_thread = threading.Thread(target=session_timeout_scanner, daemon=True)
-    scanner_thread.start()
-    print("Đã khởi động tác vụ nền để quét session timeout.")
+    # Khởi động bộ hẹn giờ tự kích hoạt lại bot khi handover quá hạn
+    await start_handover_scheduler(reactivate_timed_out_session, load_pending_handovers)
+    print("Đã khởi động bộ hẹn giờ handover timeout.")
+    start_write_behind()
+    await start_bot_switch_listener()
+    try:
+        if init_async_engine() is not None:
+            print("✅ Async database engine (asyncpg) initialized")
+    except Exception as e:
+        print(f"❌ Async database engine initialization failed, falling back to sync sessions: {e}")
     
     # init_db()
     yield
@@ -44,6 +62,28 @@ async def lifespan(app: FastAPI):
         print("✅ Elasticsearch client closed")
     except Exception as e:
         print(f"❌ Error closing Elasticsearch client: {e}")
+    try:
+        await close_async_engine()
+    except Exception as e:
+        print(f"❌ Error closing async database engine: {e}")
+    try:
+        await stop_bot_switch_listener()
+    except Exception as e:
+        print(f"❌ Error stopping bot switch listener: {e}")
+    try:
+        await stop_handover_scheduler()
+    except Exception as e:
+        print(f"❌ Error stopping handover scheduler: {e}")
+    try:
+        await stop_write_behind()
+        print("✅ Session store flushed")
+    except Exception as e:
+        print(f"❌ Error flushing session store: {e}")
+    try:
+        await close_llm_clients()
+        print("✅ LLM clients closed")
+    except Exception as e:
+        print(f"❌ Error closing LLM clients: {e}")
 
 app = FastAPI(**APP_CONFIG, lifespan=lifespan)
 
@@ -52,54 +92,61 @@ app.add_middleware(CORSMiddleware, **CORS_CONFIG)
 # Phục vụ các tệp tĩnh từ thư mục JS_Chatbot/images
 app.mount("/images", StaticFiles(directory="JS_Chatbot/images"), name="images")
 
-def session_timeout_scanner():
+def load_pending_handovers():
     """
-    Quét và reset các session bị timeout trong một luồng nền.
+    Đọc các session đang chờ/đang chat với nhân viên để dựng lại bộ hẹn giờ handover.
+    Trả về danh sách (customer_id, session_id, deadline).
     """
-    from database.database import SessionLocal, get_sessions_for_timeout_check, add_chat_message
+    from database.database import SessionLocal, get_pending_handovers
+    
+    db = SessionLocal()
+    try:
+        return [
+            (customer_id, session_id, handover_time + HANDOVER_TIMEOUT)
+            for customer_id, session_id, handover_time in get_pending_handovers(db)
+        ]
+    finally:
+        db.close()
+
+def reactivate_timed_out_session(customer_id: str, session_id: str, deadline: float):
+    """
+    Được bộ hẹn giờ gọi khi hết HANDOVER_TIMEOUT: kích hoạt lại bot nếu session vẫn đang chờ nhân viên.
+    """
+    from database.database import SessionLocal, add_chat_message, HANDOVER_STATUSES
     from src.api.chat_routes import _update_session_state
+    from src.services.session_store import load_session
     
-    while True:
-        print("Chạy tác vụ nền: Quét các session timeout...")
-        db = SessionLocal()
-        try:
-            sessions_to_check = get_sessions_for_timeout_check(db)
-            current_time = time.time()
-            
-            print(f"📊 Found {len(sessions_to_check)} sessions to check for timeout")
-            
-            for session in sessions_to_check:
-                session_data = session.session_data or {}
-                handover_time = session_data.get("handover_timestamp")
-                        
-                # Fix 1: Kiểm tra handover_timestamp có tồn tại và hợp lệ không
-                if handover_time is None or handover_time == 0:
-                    continue
-                
-                # Debug: In thông tin thời gian
-                elapsed_time = current_time - handover_time
-                
-                # Fix 2: Kiểm tra timeout với handover_timestamp hợp lệ
-                if elapsed_time > HANDOVER_TIMEOUT:
-                    
-                    # Fix 3: Sử dụng _update_session_state để đảm bảo sync đúng
-                    _update_session_state(db, session.customer_id, session.session_id, "active", session_data)
-                    
-                    # Thêm tin nhắn thông báo
-                    add_chat_message(
-                        db,
-                        customer_id=session.customer_id,
-                        thread_id=session.session_id,
-                        role="bot",
-                        message="Bot đã được tự động kích hoạt lại do không có hoạt động từ nhân viên trong 15 phút."
-                    )
-                    
-        except Exception as e:
-            print(f"Lỗi trong tác vụ nền quét session timeout: {e}")
-        finally:
-            db.close()
+    db = SessionLocal()
+    try:
+        session = load_session(db, customer_id, session_id)
+        if not session:
+            return
+        session_data = session.session_data or {}
+        # Xét state chứ không xét status: handover do khách yêu cầu vẫn có status "active" (_update_chat_history ghi "active").
+        # Admin dừng/kích hoạt lại session thì set_session_status đã hủy hẹn giờ và xóa state handover;
+        # status "stopped" chặn thêm các dòng cũ được dừng trước khi có bước xóa state đó.
+        if session_data.get("state") not in HANDOVER_STATUSES or session.status == "stopped":
+            return
+        
+        # handover_timestamp có thể đã được đặt lại (ví dụ khách gọi nhân viên lần nữa) -> đợi tới mốc mới
+        handover_time = session_data.get("handover_timestamp")
+        if not handover_time or time.time() - handover_time < HANDOVER_TIMEOUT - 1:
+            return
         
-        time.sleep(300)
+        print(f"⏰ Handover timeout cho session {customer_id}-{session_id}, kích hoạt lại bot")
+        _update_session_state(db, customer_id, session_id, "active", session_data)
+        flush_session(db, customer_id, session_id, force=True)
+        
+        # Thêm tin nhắn thông báo
+        add_chat_message(
+            db,
+            customer_id=customer_id,
+            thread_id=session_id,
+            role="bot",
+            message="Bot đã được tự động kích hoạt lại do không có hoạt động từ nhân viên trong 15 phút."
+        )
+    finally:
+        db.close()
 
 
 app.include_router(upload_data_routes.router, tags=["Upload Data"])
@@ -112,13 +159,14 @@ app.include_router(order_router)
 @app.post("/chat/{customer_id}", summary="Gửi tin nhắn đến chatbot (hỗ trợ cả ảnh)")
 async def chat(
     customer_id: str,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_chat_db),
     message: str = Form(""),
     model_choice: str = Form("gemini"),
     api_key: str = Form(...),
     session_id: str = Form("default", description="ID phiên chat"),
     image_url: str = Form(None, description="URL của hình ảnh (nếu có)"),
-    image: UploadFile = File(None, description="File hình ảnh tải lên (nếu có)")
+    image: UploadFile = File(None, description="File hình ảnh tải lên (nếu có)"),
+    history_mode: Literal["full", "incremental"] = Form("full", description="full: trả 50 tin gần nhất; incremental: chỉ trả lượt mới kèm last_message_id")
 ):
     """
     Endpoint chính để tương tác với chatbot. Hỗ trợ cả văn bản, URL ảnh và tải lên file ảnh.
@@ -128,6 +176,7 @@ async def chat(
     - **api_key**: Gemini API Key.
     - **image_url**: (Tùy chọn) Gửi URL của ảnh.
     - **image**: (Tùy chọn) Tải lên file ảnh.
+    - **history_mode**: "full" (mặc định) hoặc "incremental" để chỉ nhận lượt mới.
     """
     if image_url and image:
         raise HTTPException(status_code=400, detail="Chỉ có thể cung cấp image_url hoặc tải lên file ảnh, không phải cả hai.")
@@ -140,7 +189,47 @@ async def chat(
         model_choice=model_choice,
         api_key=api_key,
         image_url=image_url,
-        image=image
+        image=image,
+        history_mode=history_mode
+    )
+
+@app.post("/chat-stream/{customer_id}", summary="Gửi tin nhắn đến chatbot và nhận phản hồi dạng stream (SSE)")
+async def chat_stream(
+    customer_id: str,
+    message: str = Form(""),
+    model_choice: str = Form("gemini"),
+    api_key: str = Form(...),
+    session_id: str = Form("default", description="ID phiên chat"),
+    image_url: str = Form(None, description="URL của hình ảnh (nếu có)"),
+    image: UploadFile = File(None, description="File hình ảnh tải lên (nếu có)"),
+    history_mode: Literal["full", "incremental"] = Form("full", description="full: trả 50 tin gần nhất; incremental: chỉ trả lượt mới kèm last_message_id")
+):
+    """
+    Giống /chat/{customer_id} nhưng trả về text/event-stream:
+    - event "token": từng đoạn câu trả lời ngay khi LLM sinh ra.
+    - event "done": ChatResponse đầy đủ (reply, images, action_data, has_purchase...).
+    - event "error": thông báo lỗi.
+    """
+    if image_url and image:
+        raise HTTPException(status_code=400, detail="Chỉ có thể cung cấp image_url hoặc tải lên file ảnh, không phải cả hai.")
+
+    # Đọc ảnh trước vì stream chạy tiếp sau khi handler trả về; lượt chat tự mở DB session riêng
+    if image:
+        image = UploadFile(file=io.BytesIO(await image.read()), filename=image.filename, headers=image.headers)
+
+    return StreamingResponse(
+        chat_stream_endpoint(
+            customer_id=customer_id,
+            session_id=session_id,
+            message=message,
+            model_choice=model_choice,
+            api_key=api_key,
+            image_url=image_url,
+            image=image,
+            history_mode=history_mode
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
 @app.post("/control-bot/{customer_id}", summary="Dừng hoặc tiếp tục bot cho một session")
@@ -172,12 +261,12 @@ async def human_chatting(
     return await human_chatting_endpoint(customer_id, session_id, db)
 
 @app.post("/power-off-bot", summary="Stop or start the bot globally")
-async def power_off_bot(request: ControlBotRequest):
+async def power_off_bot(request: ControlBotRequest, db: Session = Depends(get_db)):
     """
-    Endpoint to control the bot globally.
+    Endpoint to control the bot globally (applies to every worker).
     - **command**: "start" to continue, "stop" to pause.
     """
-    return await power_off_bot_endpoint(request)
+    return await power_off_bot_endpoint(request, db)
 
 @app.post("/power-off-bot/{customer_id}", summary="Stop or start the bot for a specific customer")
 async def power_off_bot_customer(
@@ -207,14 +296,31 @@ async def get_session_controls(
 async def get_chat_history(
     customer_id: str,
     session_id: str,
+    before_id: Optional[int] = Query(None, description="Chỉ lấy tin nhắn cũ hơn tin có id này (next_before_id của trang trước)"),
+    limit: Optional[int] = Query(None, ge=1, le=500, description="Số tin nhắn mỗi trang; bỏ trống để lấy toàn bộ thread"),
     db: Session = Depends(get_db)
 ):
     """
-    Endpoint để lấy toàn bộ lịch sử chat của một thread của một customer.
+    Endpoint để lấy lịch sử chat của một thread của một customer (tin mới nhất trước).
     - **customer_id**: Mã khách hàng.
     - **session_id**: ID của thread/session.
+    - **before_id**, **limit**: phân trang keyset; response có next_before_id để lấy trang tiếp theo.
     """
-    return await get_chat_history_endpoint(customer_id, session_id, db)
+    return await get_chat_history_endpoint(customer_id, session_id, db, before_id=before_id, limit=limit)
+
+@app.get("/chat-history/{customer_id}/{session_id}/turns", summary="Lấy lịch sử chat theo lượt, phân trang bằng cursor")
+async def get_chat_turns(
+    customer_id: str,
+    session_id: str,
+    before_id: Optional[int] = Query(None, description="Chỉ lấy các lượt trước tin nhắn có id này (next_before_id của trang trước)"),
+    limit: int = Query(20, ge=1, le=100, description="Số lượt tối đa mỗi trang"),
+    db: Session = Depends(get_db)
+):
+    """
+    Endpoint cho widget tải lịch sử lần đầu và cuộn lên xem tin cũ.
+    - Trả về data (các lượt user/bot), next_before_id (None nếu hết) và last_message_id.
+    """
+    return await get_chat_turns_endpoint(customer_id, session_id, db, before_id=before_id, limit=limit)
 
 @app.get("/bot-status/{customer_id}", summary="Lấy trạng thái bot của customer")
 async def get_bot_status(
@@ -250,6 +356,54 @@ async def delete_chat_history(
     """
     return await delete_chat_history_endpoint(customer_id, session_id, db)
 
+# Bộ đếm của các cache và bộ hẹn giờ handover được xuất thành gauge trên /metrics
+register_stats("llm_clients", get_llm_client_stats)
+register_stats("response_cache", get_response_cache_stats)
+register_stats("intent_cache", get_intent_cache_stats)
+register_stats("session_store", get_session_store_stats)
+register_stats("config_cache", get_config_cache_stats)
+register_stats("tenant_cache", get_tenant_cache_stats)
+register_stats("handover_scheduler", get_handover_scheduler_stats)
+
+@app.get("/metrics", summary="Metrics Prometheus")
+async def metrics():
+    """
+    Endpoint cho Prometheus scrape: histogram thời gian từng bước của lượt chat (phân tích ý định, tìm kiếm,
+    lọc/chọn sản phẩm, sinh câu trả lời, đọc/ghi database) và của cả lượt, theo customer_id và model_choice;
+    kèm gauge chatbot_component_stat cho bộ đếm của các cache (size, hits, misses...) và bộ hẹn giờ handover.
+    """
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
+@app.get("/llm-clients/stats", summary="Thống kê pool client LLM")
+async def llm_client_stats():
+    """
+    Endpoint trả về thống kê hit/miss/eviction của pool client LLM (cache theo API key).
+    """
+    return {"status": "success", "data": get_llm_client_stats()}
+
+@app.get("/session-store/stats", summary="Thống kê session store")
+async def session_store_stats():
+    """
+    Endpoint trả về thống kê của session store trong bộ nhớ (hit/miss, số session chưa ghi xuống database).
+    """
+    return {"status": "success", "data": get_session_store_stats()}
+
+@app.get("/tenant-cache/stats", summary="Thống kê cache trạng thái customer")
+async def tenant_cache_stats():
+    """
+    Endpoint trả về thống kê cache trạng thái bot/is_sale/số session của từng customer.
+    """
+    return {"status": "success", "data": get_tenant_cache_stats()}
+
+@app.delete("/response-cache/{customer_id}", summary="Xóa cache câu trả lời của customer")
+async def clear_response_cache(customer_id: str):
+    """
+    Endpoint xóa toàn bộ câu trả lời đã cache của một customer (ví dụ sau khi cập nhật FAQ).
+    """
+    removed = invalidate_response_cache(customer_id)
+    return {"status": "success", "removed": removed}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run("src.main:app", host="0.0.0.0", port=8018, reload=True)
\ No newline at end of file
@@ -38,6 +38,7 @@ class ChatResponse(BaseModel):
     human_handover_required: Optional[bool] = False
     has_negativity: Optional[bool] = False
     action_data: Optional[Action] = None
+    last_message_id: Optional[int] = None  # id tin nhắn cuối của lượt này, dùng làm cursor khi history_mode="incremental"
     
     class Config:
         # Cho phép validate và convert các kiểu dữ liệu
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+from typing import Optional
+
+from src.config.settings import BOT_SWITCH_REFRESH_INTERVAL
+from database.database import engine, SessionLocal, get_global_bot_running, set_global_bot_running, BOT_SWITCH_CHANNEL
+
+# Bản sao cục bộ của công tắc bot toàn hệ thống: đọc mỗi lượt chat không cần truy vấn database.
+# Được cập nhật qua LISTEN/NOTIFY, kèm đọc lại định kỳ phòng khi mất kết nối LISTEN.
+_running = True
+_lock = threading.Lock()
+
+_listener = None  # Kết nối DBAPI (psycopg2) đang LISTEN
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_refresh_task: Optional[asyncio.Task] = None
+
+def is_bot_running() -> bool:
+    return _running
+
+def _apply(running: bool, source: str):
+    global _running
+    with _lock:
+        changed = _running != running
+        _running = running
+    if changed:
+        print(f"🔌 Công tắc bot toàn hệ thống: {'BẬT' if running else 'TẮT'} (nguồn: {source})")
+
+def set_bot_running(db, running: bool):
+    """Ghi công tắc vào database (NOTIFY các worker khác) và cập nhật bản sao của worker hiện tại."""
+    set_global_bot_running(db, running)
+    _apply(running, "local")
+
+def refresh_bot_switch():
+    db = SessionLocal()
+    try:
+        _apply(get_global_bot_running(db), "database")
+    finally:
+        db.close()
+
+def _close_listener():
+    global _listener
+    if _listener is None:
+        return
+    try:
+        if _loop is not None and not _loop.is_closed():
+            _loop.remove_reader(_listener.fileno())
+        _listener.close()
+    except Exception:
+        pass
+    _listener = None
+
+def _on_notify():
+    try:
+        _listener.poll()
+        while _listener.notifies:
+            notify = _listener.notifies.pop(0)
+            _apply(notify.payload == "on", "notify")
+    except Exception as e:
+        # Mất kết nối: vòng đọc lại định kỳ sẽ kết nối lại
+        print(f"❌ Mất kết nối LISTEN {BOT_SWITCH_CHANNEL}: {e}")
+        _close_listener()
+
+def _start_listener():
+    global _listener
+    raw_connection = engine.raw_connection()
+    dbapi_connection = raw_connection.driver_connection
+    if not hasattr(dbapi_connection, "notifies"):
+        raw_connection.close()
+        raise RuntimeError("driver không hỗ trợ LISTEN/NOTIFY, chỉ dùng đọc lại định kỳ")
+    # Tách hẳn khỏi pool: kết nối này chỉ dùng để LISTEN
+    raw_connection.detach()
+    dbapi_connection.autocommit = True
+    with dbapi_connection.cursor() as cursor:
+        cursor.execute(f"LISTEN {BOT_SWITCH_CHANNEL}")
+    _listener = dbapi_connection
+    _loop.add_reader(dbapi_connection.fileno(), _on_notify)
+    print(f"👂 Đang LISTEN kênh '{BOT_SWITCH_CHANNEL}' cho công tắc bot toàn hệ thống.")
+
+async def _refresh_loop():
+    while True:
+        await asyncio.sleep(BOT_SWITCH_REFRESH_INTERVAL)
+        try:
+            if _listener is None:
+                _start_listener()
+            await asyncio.to_thread(refresh_bot_switch)
+        except Exception as e:
+            print(f"❌ Lỗi khi đồng bộ công tắc bot: {e}")
+
+async def start_bot_switch_listener():
+    """Đọc trạng thái công tắc hiện tại, LISTEN thay đổi từ các worker khác và đọc lại mỗi BOT_SWITCH_REFRESH_INTERVAL giây."""
+    global _loop, _refresh_task
+    _loop = asyncio.get_running_loop()
+    try:
+        await asyncio.to_thread(refresh_bot_switch)
+    except Exception as e:
+        print(f"❌ Không đọc được công tắc bot toàn hệ thống: {e}")
+    try:
+        _start_listener()
+    except Exception as e:
+        print(f"⚠️ Không thể LISTEN công tắc bot ({e}), sẽ thử lại định kỳ.")
+    if BOT_SWITCH_REFRESH_INTERVAL > 0 and _refresh_task is None:
+        _refresh_task = asyncio.create_task(_refresh_loop())
+
+async def stop_bot_switch_listener():
+    global _refresh_task
+    if _refresh_task is not None:
+        _refresh_task.cancel()
+        _refresh_task = None
+    _close_listener()
@@ -0,0 +1,69 @@
+import copy
+import threading
+from typing import Any, Callable, Optional
+
+from src.config.settings import CONFIG_CACHE_SIZE, CONFIG_CACHE_TTL
+from src.utils.cache import LRUCache
+from src.utils.get_customer_info import get_customer_store_info
+from database.database import get_or_create_general_prompt, get_or_create_system_prompt, get_chatbot_settings
+
+# Cache cấu hình ít thay đổi (general prompt, prompt của customer, thông tin cửa hàng, cài đặt chatbot).
+# Key có kèm version: endpoint ghi gọi invalidate_config_cache để tăng version, các bản cũ không còn được đọc tới.
+# TTL là chốt chặn khi chạy nhiều worker (endpoint ghi chỉ invalidate được process của nó).
+_config_cache = LRUCache(maxsize=CONFIG_CACHE_SIZE, ttl=CONFIG_CACHE_TTL)
+_versions: dict = {}
+_global_version = 0
+_lock = threading.Lock()
+
+def get_config_version(customer_id: Optional[str] = None) -> tuple:
+    """Version hiện tại của cấu hình chung và của customer (tăng mỗi lần invalidate)."""
+    with _lock:
+        return _global_version, _versions.get(customer_id, 0)
+
+def _cached(kind: str, customer_id: Optional[str], loader: Callable[[], Any]) -> Any:
+    key = (kind, customer_id, get_config_version(customer_id))
+    # Bọc trong tuple để cache được cả giá trị None (vd: customer chưa có thông tin cửa hàng)
+    entry = _config_cache.get(key)
+    if entry is None:
+        entry = (loader(),)
+        # Không lưu nếu đã có invalidate trong lúc đang đọc database
+        if key[2] == get_config_version(customer_id):
+            _config_cache.set(key, entry)
+    return copy.deepcopy(entry[0])
+
+def get_general_prompt_cached(db) -> str:
+    return _cached("general_prompt", None, lambda: get_or_create_general_prompt(db))
+
+def get_system_prompt_cached(db, customer_id: str) -> str:
+    return _cached("system_prompt", customer_id, lambda: get_or_create_system_prompt(db, customer_id))
+
+def get_store_info_cached(db, customer_id: str) -> Optional[dict]:
+    return _cached("store_info", customer_id.strip(), lambda: get_customer_store_info(db, customer_id))
+
+def get_chatbot_settings_cached(db, customer_id: str) -> Optional[dict]:
+    """Cài đặt chatbot dạng dict (không giữ ORM object giữa các request), None nếu chưa có."""
+    def load():
+        settings = get_chatbot_settings(db, customer_id)
+        if not settings:
+            return None
+        return {column.name: getattr(settings, column.name) for column in settings.__table__.columns}
+    return _cached("chatbot_settings", customer_id, load)
+
+def invalidate_config_cache(customer_id: Optional[str] = None):
+    """Tăng version cấu hình của customer (hoặc cấu hình chung nếu customer_id là None, áp dụng cho mọi customer)."""
+    global _global_version
+    with _lock:
+        if customer_id is None:
+            _global_version += 1
+        else:
+            customer_id = customer_id.strip()
+            _versions[customer_id] = _versions.get(customer_id, 0) + 1
+    removed = _config_cache.invalidate_where(lambda key: customer_id is None or key[1] == customer_id)
+    print(f"🧹 Đã làm mới cache cấu hình (customer: {customer_id or 'tất cả'}, xóa {removed} mục)")
+
+def get_config_cache_stats() -> dict:
+    stats = _config_cache.stats()
+    with _lock:
+        stats["global_version"] = _global_version
+        stats["customer_versions"] = len(_versions)
+    return stats
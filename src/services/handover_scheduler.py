@@ -0,0 +1,124 @@
+import asyncio
+import heapq
+import threading
+import time
+from typing import Callable, Iterable, Optional, Tuple
+
+from src.config.settings import HANDOVER_RESYNC_INTERVAL
+
+# Heap (deadline, customer_id, session_id): mỗi handover đang chờ có đúng một mốc hẹn giờ.
+# _pending giữ deadline hiện hành của từng session; phần tử trong heap không khớp _pending là đã bị hủy/đặt lại (xóa lười).
+_heap: list = []
+_pending: dict = {}
+_lock = threading.Lock()
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_wakeup: Optional[asyncio.Event] = None
+_tasks: list = []
+
+def _notify():
+    """Đánh thức vòng lặp hẹn giờ (gọi được từ bất kỳ luồng nào)."""
+    if _loop is not None and _wakeup is not None and not _loop.is_closed():
+        _loop.call_soon_threadsafe(_wakeup.set)
+
+def schedule_handover(customer_id: str, session_id: str, deadline: float):
+    """Đặt (hoặc đặt lại) mốc tự kích hoạt lại bot cho một session đang chờ/đang chat với nhân viên."""
+    key = (customer_id, session_id)
+    with _lock:
+        if _pending.get(key) == deadline:
+            return
+        is_earliest = not _heap or deadline < _heap[0][0]
+        _pending[key] = deadline
+        heapq.heappush(_heap, (deadline, customer_id, session_id))
+    if is_earliest:
+        _notify()
+
+def cancel_handover(customer_id: str, session_id: str):
+    """Hủy mốc hẹn giờ của session (khi bot được kích hoạt lại hoặc bị dừng)."""
+    with _lock:
+        _pending.pop((customer_id, session_id), None)
+
+def _pop_due(now: float) -> Tuple[list, Optional[float]]:
+    due = []
+    with _lock:
+        while _heap and _heap[0][0] <= now:
+            deadline, customer_id, session_id = heapq.heappop(_heap)
+            if _pending.get((customer_id, session_id)) == deadline:
+                del _pending[(customer_id, session_id)]
+                due.append((customer_id, session_id, deadline))
+        next_deadline = _heap[0][0] if _heap else None
+    return due, next_deadline
+
+async def _scheduler_loop(on_expire: Callable[[str, str, float], None]):
+    while True:
+        _wakeup.clear()
+        due, next_deadline = _pop_due(time.time())
+        for customer_id, session_id, deadline in due:
+            try:
+                await asyncio.to_thread(on_expire, customer_id, session_id, deadline)
+            except Exception as e:
+                print(f"❌ Lỗi khi xử lý handover timeout cho session {customer_id}-{session_id}: {e}")
+        if due:
+            continue
+        timeout = None if next_deadline is None else max(0.0, next_deadline - time.time())
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+async def _sync_pending(load_pending: Callable[[], Iterable[Tuple[str, str, float]]]) -> int:
+    pending = await asyncio.to_thread(load_pending)
+    count = 0
+    for customer_id, session_id, deadline in pending:
+        schedule_handover(customer_id, session_id, deadline)
+        count += 1
+    return count
+
+async def _resync_loop(load_pending: Callable[[], Iterable[Tuple[str, str, float]]]):
+    # Nhận các handover do worker/process khác tạo (mỗi process có heap riêng)
+    while True:
+        await asyncio.sleep(HANDOVER_RESYNC_INTERVAL)
+        try:
+            await _sync_pending(load_pending)
+        except Exception as e:
+            print(f"❌ Lỗi khi đồng bộ lại lịch handover: {e}")
+
+async def start_handover_scheduler(on_expire: Callable[[str, str, float], None],
+                                   load_pending: Callable[[], Iterable[Tuple[str, str, float]]]):
+    """
+    Khởi động bộ hẹn giờ handover trên event loop hiện tại.
+    - on_expire(customer_id, session_id, deadline): chạy trong thread khi tới hạn, phải tự kiểm tra lại trạng thái session.
+    - load_pending(): trả về các (customer_id, session_id, deadline) đang chờ trong database, dùng để dựng lại heap khi khởi động.
+    """
+    global _loop, _wakeup
+    if _tasks:
+        return
+    _loop = asyncio.get_running_loop()
+    _wakeup = asyncio.Event()
+    try:
+        count = await _sync_pending(load_pending)
+        print(f"⏰ Đã nạp {count} handover đang chờ vào bộ hẹn giờ.")
+    except Exception as e:
+        print(f"❌ Lỗi khi nạp handover đang chờ: {e}")
+    _tasks.append(asyncio.create_task(_scheduler_loop(on_expire)))
+    if HANDOVER_RESYNC_INTERVAL > 0:
+        _tasks.append(asyncio.create_task(_resync_loop(load_pending)))
+
+async def stop_handover_scheduler():
+    global _loop, _wakeup
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    _loop = None
+    _wakeup = None
+
+def get_handover_scheduler_stats() -> dict:
+    with _lock:
+        next_deadline = min(_pending.values()) if _pending else None
+        return {
+            "pending": len(_pending),
+            "heap_size": len(_heap),
+            "next_in_seconds": round(next_deadline - time.time(), 1) if next_deadline is not None else None,
+            "resync_interval": HANDOVER_RESYNC_INTERVAL,
+        }
@@ -1,19 +1,163 @@
+import copy
+import hashlib
 import json
 import re
 from typing import Dict, Any
 
-from src.services.llm_service import get_gemini_model, get_lmstudio_response, get_openai_model
-from google.generativeai.types import GenerationConfig
+from src.config.settings import INTENT_CACHE_SIZE, INTENT_CACHE_TTL, INTENT_FAST_PATH_ENABLED, INTENT_FAST_PATH_THRESHOLD
+from src.services.llm_service import get_llm_provider
+from src.utils.cache import LRUCache
+from src.utils.helpers import normalize_query
+from src.utils.metrics import timed
 
-def analyze_intent_and_extract_entities(user_query: str, history: list = None, model_choice: str = "gemini", api_key: str = None) -> Dict[str, Any]:
+# Kết quả phân tích ý định không phụ thuộc vào customer, chỉ phụ thuộc câu hỏi + 6 lượt hội thoại gần nhất + model
+# Key: (câu hỏi đã chuẩn hóa, fingerprint lịch sử, model_choice)
+_intent_cache = LRUCache(maxsize=INTENT_CACHE_SIZE, ttl=INTENT_CACHE_TTL)
+
+def _history_fingerprint(history_text: str) -> str:
+    return hashlib.sha256(history_text.encode("utf-8")).hexdigest()[:32]
+
+def get_intent_cache_stats() -> dict:
+    return _intent_cache.stats()
+
+# === BỘ PHÂN LOẠI NHANH BẰNG LUẬT (chạy trước LLM) ===
+# Các câu ngắn, lặp lại nhiều ("ok", "vâng", "chốt", số điện thoại, "shop ở đâu"...) được phân loại bằng từ khóa/regex.
+# Kết quả có cùng schema với LLM kèm "confidence"; chỉ dùng khi confidence >= INTENT_FAST_PATH_THRESHOLD.
+
+# Lời cảm ơn kết thúc hội thoại chứ không trả lời đề nghị của bot, nên chỉ nhường cho LLM khi đang giữa luồng mua hàng
+THANKS_PHRASES = {"cảm ơn", "cám ơn", "cảm ơn shop", "cảm ơn em", "thanks", "thank you", "tks"}
+ACK_PHRASES = {
+    "ok", "oke", "okay", "okie", "uk", "ừ", "ừm", "ờ", "vâng", "dạ", "dạ vâng", "vâng ạ", "dạ ạ", "đúng rồi", "được",
+} | THANKS_PHRASES
+GREETING_PHRASES = {
+    "hi", "hello", "alo", "chào", "chào shop", "chào em", "xin chào", "hi shop", "hello shop", "shop ơi", "ad ơi", "bot",
+}
+CONFIRM_PHRASES = {
+    "ok", "oke", "okay", "vâng", "dạ vâng", "vâng ạ", "đúng rồi", "đúng", "dạ đúng ạ", "đúng ạ", "chốt", "chốt đơn",
+    "chốt luôn", "lấy", "lấy cho anh", "lấy cho chị", "lấy cho em", "có", "ừ", "uk", "đồng ý", "đặt luôn",
+}
+CANCEL_PHRASES = {
+    "không", "ko", "k", "thôi", "thôi ạ", "hủy", "huỷ", "hủy đơn", "huỷ đơn", "bỏ đi", "không mua nữa", "dạ không ạ",
+    "không ạ", "thôi không mua nữa", "để sau",
+}
+STORE_INFO_PATTERN = re.compile(
+    r"^(shop|cửa hàng|bên em|bên shop|cho (em|anh|chị|mình) xin)?\s*(ở đâu|ở chỗ nào|địa chỉ|hotline|số điện thoại|sđt|mấy giờ mở cửa|giờ mở cửa)"
+    r"(\s+(shop|cửa hàng|bên em|ở đâu|là gì|vậy|ạ|thế|nhỉ|em|ad))*$"
+)
+HUMAN_AGENT_PATTERN = re.compile(r"(gặp|nói chuyện với|gọi|cho.*gặp) (nhân viên|người thật|tư vấn viên|admin|chủ shop)")
+BANK_TRANSFER_PATTERN = re.compile(r"(đã|mới|vừa) (chuyển khoản|ck|chuyển tiền)|chuyển khoản (rồi|xong)")
+# Phủ định/câu hỏi đảo nghĩa hai luật trên ("không cần gặp nhân viên", "shop đã chuyển khoản chưa"): nhường cho LLM
+NEGATION_PATTERN = re.compile(r"\b(không|ko|chưa|đừng|chẳng|chả)\b")
+QUESTION_PATTERN = re.compile(r"\b(à|hả|nhỉ|sao|bao giờ|khi nào|thế nào)\b")
+PHONE_PATTERN = re.compile(r"^(\+84|84|0)\d{9}$")
+# Tiểu từ cuối câu cho thấy bot đang hỏi/đề nghị khách làm gì đó ("... cho em xin số điện thoại ạ.")
+REQUEST_PARTICLES = {"ạ", "nhé", "nhé ạ", "nha", "nhen", "không", "không ạ", "ko", "chưa", "chưa ạ", "được không", "đúng không"}
+# Trạng thái session đang chờ khách trả lời trong luồng mua hàng: câu xác nhận ngắn là câu trả lời cho luồng này
+PENDING_FLOW_STATES = {"awaiting_purchase_confirmation", "awaiting_customer_info"}
+
+def _empty_intent(**flags) -> Dict[str, Any]:
+    result = {
+        "needs_search": False,
+        "is_purchase_intent": False,
+        "is_add_to_order_intent": False,
+        "wants_images": False,
+        "wants_specs": False,
+        "wants_human_agent": False,
+        "wants_store_info": False,
+        "wants_warranty_service": False,
+        "is_negative": False,
+        "is_bank_transfer": False,
+        "search_params": {"products": []},
+    }
+    result.update(flags)
+    return result
+
+def _compact_phone(text: str) -> str:
+    return re.sub(r"[\s.\-]", "", text or "")
+
+def _bot_awaits_reply(last_bot_message: str) -> bool:
+    """Tin nhắn cuối của bot là câu hỏi (có "?") hoặc kết thúc bằng tiểu từ hỏi/đề nghị (ạ/nhé/không...)."""
+    if "?" in last_bot_message:
+        return True
+    words = re.sub(r"[\s.!~…,:;)\]]+$", "", last_bot_message.lower()).split()
+    return any(" ".join(words[-size:]) in REQUEST_PARTICLES for size in (1, 2) if len(words) >= size)
+
+def classify_intent_fast(user_query: str, history: list = None, pending_state: str = None) -> Dict[str, Any]:
+    """
+    Phân loại ý định bằng luật cho các câu đơn giản. Trả về dict cùng schema với analyze_intent_and_extract_entities
+    kèm key "confidence", hoặc None nếu không có luật nào khớp.
+    Câu xác nhận ngắn ("ok", "vâng") trả lời cho câu hỏi/đề nghị của bot, hoặc khi session đang chờ trong luồng mua hàng
+    (pending_state), cần kế thừa ngữ cảnh nên bị hạ confidence để nhường cho LLM.
+    """
+    normalized = normalize_query(user_query)
+    if not normalized:
+        return None
+
+    last_bot_message = history[-1].get("bot", "") if history else ""
+    in_pending_flow = pending_state in PENDING_FLOW_STATES
+
+    if user_query.strip().lower() == "/bot":
+        return _empty_intent(confidence=1.0)
+    if PHONE_PATTERN.match(_compact_phone(user_query)):
+        return _empty_intent(confidence=0.95)
+    if normalized in GREETING_PHRASES:
+        return _empty_intent(confidence=0.95)
+    if normalized in ACK_PHRASES:
+        ack_is_ambiguous = in_pending_flow or (normalized not in THANKS_PHRASES and _bot_awaits_reply(last_bot_message))
+        return _empty_intent(confidence=0.5 if ack_is_ambiguous else 0.9)
+    negated_or_question = "?" in user_query or bool(NEGATION_PATTERN.search(normalized) or QUESTION_PATTERN.search(normalized))
+    if BANK_TRANSFER_PATTERN.search(normalized) and not negated_or_question:
+        return _empty_intent(is_bank_transfer=True, confidence=0.9)
+    if HUMAN_AGENT_PATTERN.search(normalized) and not negated_or_question:
+        return _empty_intent(wants_human_agent=True, confidence=0.9)
+    if STORE_INFO_PATTERN.match(normalized):
+        return _empty_intent(wants_store_info=True, confidence=0.9)
+    return None
+
+def classify_purchase_confirmation_fast(user_query: str) -> Dict[str, Any]:
+    """Phân loại nhanh câu trả lời xác nhận đơn hàng: {'decision': 'CONFIRM'/'CANCEL', 'confidence': float} hoặc None."""
+    normalized = normalize_query(user_query)
+    if normalized in CONFIRM_PHRASES:
+        return {"decision": "CONFIRM", "confidence": 0.95}
+    if normalized in CANCEL_PHRASES:
+        return {"decision": "CANCEL", "confidence": 0.95}
+    return None
+
+def extract_customer_info_fast(user_input: str) -> Dict[str, Any]:
+    """Bóc tách nhanh khi khách chỉ gửi một số điện thoại: {'name', 'phone', 'address', 'confidence'} hoặc None."""
+    phone = _compact_phone(user_input)
+    if PHONE_PATTERN.match(phone):
+        return {"name": None, "phone": phone, "address": None, "confidence": 0.95}
+    return None
+
+def accept_fast_path(result: Dict[str, Any]) -> bool:
+    """Kết quả của bộ phân loại luật chỉ được dùng khi fast-path đang bật và confidence đạt ngưỡng."""
+    return bool(INTENT_FAST_PATH_ENABLED and result and result.get("confidence", 0.0) >= INTENT_FAST_PATH_THRESHOLD)
+
+@timed("analyze_intent")
+async def analyze_intent_and_extract_entities(user_query: str, history: list = None, model_choice: str = "gemini", api_key: str = None, pending_state: str = None) -> Dict[str, Any]:
     """
     Sử dụng một lệnh gọi LLM duy nhất để phân tích ý định của người dùng và trích xuất các thực thể cần thiết.
+    Kết quả parse thành công được cache theo (câu hỏi đã chuẩn hóa, fingerprint 6 lượt gần nhất, model_choice).
+    Các câu đơn giản được bộ phân loại luật xử lý trước, không gọi LLM (kết quả có thêm key "confidence").
+    pending_state: session_data["state"] hiện tại, dùng để bộ phân loại luật biết khách đang ở giữa luồng mua hàng.
     """
+    fast_result = classify_intent_fast(user_query, history, pending_state)
+    if accept_fast_path(fast_result):
+        print(f"⚡ Fast-path ý định (confidence {fast_result['confidence']}): {fast_result}")
+        return fast_result
+
     history_text = ""
     if history:
         for turn in history[-6:]:
             history_text += f"Khách: {turn['user']}\nBot: {turn['bot']}\n"
 
+    cache_key = (normalize_query(user_query), _history_fingerprint(history_text), model_choice)
+    cached_result = _intent_cache.get(cache_key)
+    if cached_result is not None:
+        print(f"⚡ Intent cache hit: '{cache_key[0]}'")
+        return copy.deepcopy(cached_result)
+
     # GỢI Ý: Đã tích hợp logic và ví dụ về category của bạn vào prompt này.
     prompt = f"""
     Bạn là một AI phân tích truy vấn của khách hàng. Dựa vào lịch sử hội thoại và câu hỏi mới nhất, hãy phân tích và trả về một đối tượng JSON.
@@ -129,26 +273,11 @@ def analyze_intent_and_extract_entities(user_query: str, history: list = None, m
 
     response_text = None
     try:
-        if model_choice == "gemini":
-            model = get_gemini_model(api_key=api_key)
-            if model:
-                generation_config = GenerationConfig(response_mime_type="application/json")
-                response = model.generate_content(prompt, generation_config=generation_config)
-                response_text = response.text
-        elif model_choice == "lmstudio":
-            response_text = get_lmstudio_response(prompt)
-        elif model_choice == "openai":
-            openai = get_openai_model(api_key=api_key)
-            if openai:
-                completion = openai.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[{"role": "user", "content": prompt}],
-                    response_format={"type": "json_object"},
-                    temperature=0.2
-                )
-                response_text = completion.choices[0].message.content
-        else:
+        if model_choice not in ("gemini", "lmstudio", "openai"):
             return fallback_response
+        provider = get_llm_provider(model_choice, api_key=api_key)
+        if provider:
+            response_text = await provider.generate(prompt, json_mode=True)
 
         if not response_text:
             return fallback_response
@@ -163,6 +292,7 @@ def analyze_intent_and_extract_entities(user_query: str, history: list = None, m
             if 'search_params' in data and 'products' in data['search_params']:
                 print(f"Kết quả phân tích: {data}")
                 print("-----------------------------------")
+                _intent_cache.set(cache_key, copy.deepcopy(data))
                 return data
         
         print("Không thể parse JSON từ phản hồi LLM, sử dụng fallback.")
@@ -172,10 +302,15 @@ def analyze_intent_and_extract_entities(user_query: str, history: list = None, m
         print(f"Lỗi trong quá trình phân tích ý định bằng LLM ({model_choice}): {e}")
         return fallback_response
     
-def extract_customer_info(user_input: str, model_choice: str = "gemini", api_key: str = None) -> Dict:
+async def extract_customer_info(user_input: str, model_choice: str = "gemini", api_key: str = None) -> Dict:
     """
     Sử dụng LLM để bóc tách Tên, SĐT, Địa chỉ từ một chuỗi văn bản.
     """
+    fast_result = extract_customer_info_fast(user_input)
+    if accept_fast_path(fast_result):
+        print(f"⚡ Fast-path bóc tách thông tin: {fast_result['phone']}")
+        return {key: fast_result[key] for key in ("name", "phone", "address")}
+
     prompt = f"""
     Bạn là một AI chuyên bóc tách thông tin. Từ đoạn văn bản dưới đây, hãy trích xuất Tên người (`name`), Số điện thoại (`phone`), và Địa chỉ (`address`) vào một đối tượng JSON.
     Nếu không tìm thấy thông tin nào, hãy để giá trị là null. Chỉ trả về JSON.
@@ -186,10 +321,10 @@ def extract_customer_info(user_input: str, model_choice: str = "gemini", api_key
     JSON:
     """
     try:
-        model = get_gemini_model(api_key=api_key)
-        if model:
-            response = model.generate_content(prompt)
-            json_text = re.search(r'\{.*\}', response.text, re.DOTALL).group(0)
+        provider = get_llm_provider("gemini", api_key=api_key)
+        if provider:
+            response_text = await provider.generate(prompt)
+            json_text = re.search(r'\{.*\}', response_text, re.DOTALL).group(0)
             return json.loads(json_text)
         return {}
     except Exception as e:
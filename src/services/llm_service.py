@@ -1,62 +1,278 @@
 import os
+import hashlib
 import requests
 import asyncio
-from src.config.settings import LMSTUDIO_API_URL, LMSTUDIO_MODEL
-from typing import Optional
+import inspect
+import json
+from abc import ABC, abstractmethod
+from src.config.settings import LMSTUDIO_API_URL, LMSTUDIO_MODEL, LLM_CLIENT_CACHE_SIZE, LLM_CLIENT_TTL
+from src.utils.cache import LRUCache
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
 import io
 from PIL import Image
 
-def get_gemini_model(is_vision: bool = False, api_key: str = None):
-    """Khởi tạo và trả về model Gemini."""
+GEMINI_MODEL = "gemini-2.0-flash"
+
+class _PooledClient:
+    """Client trong pool kèm số lệnh gọi đang dùng; client bị loại khỏi pool chỉ được đóng khi không còn ai dùng."""
+
+    def __init__(self, client):
+        self.client = client
+        self.in_use = 0
+        self.retired = False
+
+async def _close_client(client):
+    """Đóng client bằng API đóng công khai của SDK (AsyncOpenAI.close, genai.Client.aio.aclose)."""
+    aio = getattr(client, "aio", None)
+    close = getattr(aio, "aclose", None) or getattr(client, "close", None)
+    if close is None:
+        return
+    try:
+        result = close()
+        if inspect.isawaitable(result):
+            await result
+    except Exception as e:
+        print(f"Lỗi khi đóng LLM client: {e}")
+
+def _schedule_close(client):
+    try:
+        asyncio.get_running_loop().create_task(_close_client(client))
+    except RuntimeError:
+        # Không có event loop đang chạy, để GC tự giải phóng
+        pass
+
+def _retire_client(key, entry: _PooledClient):
+    """Client bị loại khỏi pool (đầy/hết TTL): đóng ngay nếu rảnh, nếu không thì lệnh gọi cuối cùng sẽ đóng."""
+    entry.retired = True
+    if entry.in_use == 0:
+        _schedule_close(entry.client)
+
+# Pool client theo (provider, hash API key). Mỗi tenant có client riêng nên không còn
+# phụ thuộc vào trạng thái toàn cục của genai.configure, và kết nối được tái sử dụng giữa các lượt.
+_client_pool = LRUCache(maxsize=LLM_CLIENT_CACHE_SIZE, ttl=LLM_CLIENT_TTL, on_evict=_retire_client)
+_lmstudio_session = None
+
+def _client_key(provider: str, api_key: str) -> tuple:
+    return (provider, hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16])
+
+def _create_gemini_client(api_key: str):
+    from google import genai
+    # Client riêng theo API key (API công khai của google-genai) thay vì genai.configure toàn cục
+    return genai.Client(api_key=api_key)
+
+def _create_openai_client(api_key: str):
+    import openai
+    return openai.AsyncOpenAI(api_key=api_key)
+
+_CLIENT_FACTORIES = {"gemini": _create_gemini_client, "openai": _create_openai_client}
+
+def _get_pooled_client(provider: str, api_key: str) -> Optional[_PooledClient]:
+    """Trả về client đã được cache theo (provider, API key), tạo mới nếu chưa có; None nếu thiếu key hoặc lỗi."""
     if not api_key:
-        print("Không tìm thấy GEMINI_API_KEY.")
+        print(f"Không tìm thấy API key cho {provider}.")
         return None
     try:
-        import google.generativeai as genai
-        genai.configure(api_key=api_key)
-        model_name = 'gemini-2.0-flash'
-        model = genai.GenerativeModel(model_name)
-        return model
+        return _client_pool.get_or_create(
+            _client_key(provider, api_key), lambda: _PooledClient(_CLIENT_FACTORIES[provider](api_key))
+        )
     except Exception as e:
-        print(f"Lỗi khi khởi tạo Gemini: {e}")
+        print(f"Lỗi khi khởi tạo {provider} client: {e}")
         return None
 
-def get_lmstudio_response(prompt: str):
-    """Gửi prompt đến LM Studio API và nhận phản hồi."""
+@asynccontextmanager
+async def _lease_client(provider: str, api_key: str):
+    """Mượn client trong suốt một lệnh gọi; client bị loại khỏi pool giữa chừng chỉ được đóng sau khi trả lại."""
+    entry = _get_pooled_client(provider, api_key)
+    if entry is None:
+        raise RuntimeError(f"Không thể khởi tạo {provider} client")
+    entry.in_use += 1
     try:
+        yield entry.client
+    finally:
+        entry.in_use -= 1
+        if entry.retired and entry.in_use == 0:
+            await _close_client(entry.client)
+
+def _get_lmstudio_session():
+    """Trả về aiohttp.ClientSession dùng chung cho LM Studio (giữ kết nối keep-alive)."""
+    global _lmstudio_session
+    import aiohttp
+    if _lmstudio_session is None or _lmstudio_session.closed:
+        _lmstudio_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+    return _lmstudio_session
+
+def get_llm_client_stats() -> dict:
+    """Thống kê hit/miss của pool client LLM."""
+    return _client_pool.stats()
+
+async def close_llm_clients():
+    """Đóng toàn bộ client trong pool, gọi khi ứng dụng shutdown."""
+    global _lmstudio_session
+    for key in _client_pool.keys():
+        entry = _client_pool.pop(key)
+        if entry is not None:
+            await _close_client(entry.client)
+    if _lmstudio_session is not None and not _lmstudio_session.closed:
+        await _lmstudio_session.close()
+    _lmstudio_session = None
+
+class LLMProvider(ABC):
+    """
+    Giao diện chung cho các nhà cung cấp LLM bất đồng bộ.
+    Mỗi lệnh gọi được await trực tiếp nên không chặn event loop của uvicorn.
+    """
+    name = "base"
+
+    @abstractmethod
+    async def generate(self, prompt, json_mode: bool = False, safety_settings: dict = None) -> Optional[str]:
+        """Sinh toàn bộ câu trả lời cho prompt; json_mode yêu cầu provider trả về JSON."""
+
+    async def stream(self, prompt, safety_settings: dict = None) -> AsyncIterator[str]:
+        """Sinh câu trả lời theo từng đoạn văn bản. Mặc định trả về toàn bộ câu trả lời trong một đoạn."""
+        text = await self.generate(prompt, safety_settings=safety_settings)
+        if text:
+            yield text
+
+def _gemini_config(json_mode: bool = False, safety_settings: dict = None):
+    """GenerateContentConfig từ json_mode và safety_settings dạng {category: threshold}."""
+    from google.genai import types
+    config = {}
+    if json_mode:
+        config["response_mime_type"] = "application/json"
+    if safety_settings:
+        config["safety_settings"] = [
+            types.SafetySetting(category=category, threshold=threshold) for category, threshold in safety_settings.items()
+        ]
+    return types.GenerateContentConfig(**config) if config else None
+
+class GeminiProvider(LLMProvider):
+    name = "gemini"
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+
+    async def generate(self, prompt, json_mode: bool = False, safety_settings: dict = None) -> Optional[str]:
+        async with _lease_client("gemini", self.api_key) as client:
+            response = await client.aio.models.generate_content(
+                model=GEMINI_MODEL, contents=prompt, config=_gemini_config(json_mode, safety_settings)
+            )
+        return response.text
+
+    async def stream(self, prompt, safety_settings: dict = None) -> AsyncIterator[str]:
+        async with _lease_client("gemini", self.api_key) as client:
+            response = await client.aio.models.generate_content_stream(
+                model=GEMINI_MODEL, contents=prompt, config=_gemini_config(safety_settings=safety_settings)
+            )
+            async for chunk in response:
+                if chunk.text:
+                    yield chunk.text
+
+class OpenAIProvider(LLMProvider):
+    name = "openai"
+
+    def __init__(self, api_key: str, model_name: str = "gpt-4o-mini"):
+        self.api_key = api_key
+        self.model_name = model_name
+
+    async def generate(self, prompt, json_mode: bool = False, safety_settings: dict = None) -> Optional[str]:
+        kwargs = {"response_format": {"type": "json_object"}, "temperature": 0.2} if json_mode else {"temperature": 0.5, "max_tokens": 4000}
+        async with _lease_client("openai", self.api_key) as client:
+            response = await client.chat.completions.create(
+                model=self.model_name,
+                messages=[{"role": "user", "content": prompt}],
+                **kwargs
+            )
+        usage = response.usage
+        if usage:
+            print(f"📊 Prompt: {usage.prompt_tokens}, Completion: {usage.completion_tokens}, Total: {usage.total_tokens}")
+            cost = (usage.prompt_tokens * 0.15 + usage.completion_tokens * 0.6) / 1_000_000
+            print(f"💰 Estimated cost (GPT-4o-mini): ${cost:.6f}")
+        return response.choices[0].message.content
+
+    async def stream(self, prompt, safety_settings: dict = None) -> AsyncIterator[str]:
+        async with _lease_client("openai", self.api_key) as client:
+            response = await client.chat.completions.create(
+                model=self.model_name,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.5,
+                max_tokens=4000,
+                stream=True
+            )
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+class LMStudioProvider(LLMProvider):
+    name = "lmstudio"
+
+    async def generate(self, prompt, json_mode: bool = False, safety_settings: dict = None) -> Optional[str]:
+        """Gửi prompt đến LM Studio API và nhận phản hồi."""
+        try:
+            url = f"{LMSTUDIO_API_URL}/v1/chat/completions"
+            headers = {"Content-Type": "application/json"}
+            data = {
+                "messages": [{"role": "user", "content": prompt}],
+                "model": LMSTUDIO_MODEL,
+                "temperature": 0.7,
+                "max_tokens": 4000
+            }
+
+            print(f"Gửi yêu cầu đến LM Studio API: {url}")
+            session = _get_lmstudio_session()
+            async with session.post(url, headers=headers, json=data) as response:
+                response.raise_for_status()
+                result = await response.json()
+
+            if "choices" in result and len(result["choices"]) > 0:
+                return result["choices"][0]["message"]["content"]
+            return "Không nhận được phản hồi từ LM Studio."
+        except Exception as e:
+            print(f"Lỗi khi gọi LM Studio: {e}")
+            return None
+
+    async def stream(self, prompt, safety_settings: dict = None) -> AsyncIterator[str]:
+        """Stream phản hồi từ LM Studio (định dạng SSE tương thích OpenAI: các dòng 'data: {...}')."""
         url = f"{LMSTUDIO_API_URL}/v1/chat/completions"
-        headers = {"Content-Type": "application/json"}
         data = {
             "messages": [{"role": "user", "content": prompt}],
             "model": LMSTUDIO_MODEL,
             "temperature": 0.7,
-            "max_tokens": 4000
+            "max_tokens": 4000,
+            "stream": True
         }
-        
-        print(f"Gửi yêu cầu đến LM Studio API: {url}")
-        response = requests.post(url, headers=headers, json=data, timeout=60)
-        response.raise_for_status()
-        result = response.json()
-        
-        if "choices" in result and len(result["choices"]) > 0:
-            return result["choices"][0]["message"]["content"]
-        return "Không nhận được phản hồi từ LM Studio."
-    except Exception as e:
-        print(f"Lỗi khi gọi LM Studio: {e}")
-        return None
+        session = _get_lmstudio_session()
+        async with session.post(url, headers={"Content-Type": "application/json"}, json=data) as response:
+            response.raise_for_status()
+            async for raw_line in response.content:
+                line = raw_line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                choices = json.loads(payload).get("choices") or []
+                content = choices[0].get("delta", {}).get("content") if choices else None
+                if content:
+                    yield content
 
-def _blocking_generate_content(model, prompt: str, image: Image.Image) -> str:
-    """Hàm đồng bộ để chạy generate_content trong một luồng riêng."""
-    response = model.generate_content([prompt, image])
-    return response.text.strip()
+def get_llm_provider(model_choice: str = "gemini", api_key: str = None) -> Optional[LLMProvider]:
+    """Trả về provider bất đồng bộ tương ứng với model_choice, hoặc None nếu không khởi tạo được."""
+    if model_choice in ("gemini", "openai"):
+        # Tạo sẵn client trong pool để trả None ngay nếu thiếu key/không khởi tạo được
+        if _get_pooled_client(model_choice, api_key) is None:
+            return None
+        return GeminiProvider(api_key) if model_choice == "gemini" else OpenAIProvider(api_key)
+    if model_choice == "lmstudio":
+        return LMStudioProvider()
+    return None
 
 async def analyze_image_with_vision(image_url: str = None, image_bytes: bytes = None, api_key: str = None) -> Optional[str]:
     """
     Sử dụng Gemini Pro Vision để phân tích và mô tả nội dung của một hình ảnh (bất đồng bộ).
     """
     try:
-        model = get_gemini_model(is_vision=True, api_key=api_key)
-        if not model:
+        if _get_pooled_client("gemini", api_key) is None:
             print("Không thể khởi tạo model Gemini Vision.")
             return None
 
@@ -81,23 +297,10 @@ async def analyze_image_with_vision(image_url: str = None, image_bytes: bytes =
         
         print(" -> Gửi ảnh và prompt đến Gemini Vision (async)...")
         
-        # Chạy hàm blocking trong một luồng riêng
-        description = await asyncio.to_thread(_blocking_generate_content, model, prompt, image)
-        
-        return description
+        async with _lease_client("gemini", api_key) as client:
+            response = await client.aio.models.generate_content(model=GEMINI_MODEL, contents=[prompt, image])
+        return (response.text or "").strip()
 
     except Exception as e:
         print(f"Lỗi trong quá trình phân tích ảnh bằng AI Vision: {e}")
         return None
-
-def get_openai_model(api_key: str = None):
-    """Khởi tạo và trả về client openai chuẩn >=1.0.0, hoặc None nếu thiếu key."""
-    try:
-        import openai
-        if not api_key:
-            return None
-        client = openai.OpenAI(api_key=api_key)
-        return client
-    except Exception as e:
-        print(f"Lỗi khi khởi tạo OpenAI client: {e}")
-        return None
\ No newline at end of file
@@ -0,0 +1,76 @@
+import copy
+import hashlib
+import re
+from typing import Any, Optional
+
+from src.config.settings import RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL
+from src.utils.cache import LRUCache
+from src.utils.helpers import normalize_query
+
+# Key: (customer_id, câu hỏi đã chuẩn hóa, hash context sản phẩm/FAQ, hash system prompt + cờ sinh prompt).
+# Lịch sử hội thoại không nằm trong key: câu hỏi được cache thì được trả lời không kèm lịch sử (xem is_cacheable_query),
+# nên câu trả lời không chứa thông tin riêng của hội thoại và dùng lại được cho mọi khách của customer.
+_response_cache = LRUCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+# Câu hỏi tham chiếu tới hội thoại trước ("cái đó", "loại này", "như trên", "cái khác"...): câu trả lời phụ thuộc lịch sử
+HISTORY_REFERENCE_PATTERN = re.compile(
+    r"\b(nó|đó|đấy|kia|này|trên|vừa rồi|lúc nãy|ban nãy|hôm trước|như vậy|thế còn|còn cái|cái khác|loại khác|mẫu khác"
+    r"|cái nào|loại nào|mẫu nào|thứ hai|thứ ba|số \d+)\b"
+)
+
+def _digest(*parts: Any) -> str:
+    hasher = hashlib.sha256()
+    for part in parts:
+        hasher.update(repr(part).encode("utf-8"))
+        hasher.update(b"\x1f")
+    return hasher.hexdigest()[:32]
+
+def is_cacheable_query(user_query: str) -> bool:
+    """
+    Câu hỏi có thể trả lời không cần lịch sử hội thoại ("giá bao nhiêu", "còn hàng không", "shop ở đâu"):
+    sản phẩm khách đang nói tới đã được phân tích ý định tìm ra và nằm trong product_context.
+    Câu tham chiếu tới hội thoại trước thì không cache và được trả lời kèm lịch sử.
+    """
+    normalized = normalize_query(user_query)
+    return RESPONSE_CACHE_ENABLED and bool(normalized) and not HISTORY_REFERENCE_PATTERN.search(normalized)
+
+def make_response_cache_key(customer_id: str, user_query: str, product_context: str, faq_context: str, system_prompt: str, flags: tuple) -> Optional[tuple]:
+    """
+    Tạo key cache cho một câu trả lời. Trả về None nếu không thể cache (thiếu customer_id hoặc câu hỏi rỗng).
+    Chỉ dùng cho câu hỏi is_cacheable_query, với prompt không kèm lịch sử hội thoại.
+    - product_context: chuỗi do _build_product_context sinh ra ("" nếu không tìm sản phẩm).
+    - system_prompt: general prompt + prompt của customer + thông tin cửa hàng.
+    - flags: các tham số khác làm thay đổi prompt (model_choice, wants_images, has_history, ...).
+    """
+    normalized = normalize_query(user_query)
+    if not customer_id or not normalized:
+        return None
+    return (customer_id, normalized, _digest(product_context, faq_context), _digest(system_prompt, flags))
+
+def get_cached_response(key: Optional[tuple]) -> Any:
+    if not RESPONSE_CACHE_ENABLED or key is None:
+        return None
+    cached = _response_cache.get(key)
+    if cached is not None:
+        print(f"⚡ Response cache hit cho customer {key[0]}: '{key[1]}'")
+        return copy.deepcopy(cached)
+    return None
+
+def set_cached_response(key: Optional[tuple], response: Any):
+    if not RESPONSE_CACHE_ENABLED or key is None or not response:
+        return
+    _response_cache.set(key, copy.deepcopy(response))
+
+def invalidate_response_cache(customer_id: str = None) -> int:
+    """Xóa cache câu trả lời của một customer (hoặc toàn bộ nếu customer_id là None), ví dụ khi catalog/prompt thay đổi."""
+    if customer_id is None:
+        removed = len(_response_cache)
+        _response_cache.clear()
+    else:
+        removed = _response_cache.invalidate_where(lambda key: key[0] == customer_id)
+    if removed:
+        print(f"🧹 Đã xóa {removed} câu trả lời trong response cache (customer: {customer_id or 'tất cả'})")
+    return removed
+
+def get_response_cache_stats() -> dict:
+    return _response_cache.stats()
@@ -1,14 +1,19 @@
 import json
 import re
 from collections import defaultdict
-from typing import List, Dict, Any
-from src.services.llm_service import get_gemini_model, get_lmstudio_response, get_openai_model
+from typing import List, Dict, Any, Optional, Callable, Awaitable
+from src.services.llm_service import get_llm_provider
 from src.services.search_service import search_faqs
+from src.services.intent_service import classify_purchase_confirmation_fast, accept_fast_path
+from src.services.response_cache import is_cacheable_query, make_response_cache_key, get_cached_response, set_cached_response
 from src.utils.helpers import is_general_query, format_history_text
-from src.utils.get_customer_info import get_customer_store_info
+from src.utils.metrics import timed
+from src.services.config_cache import get_store_info_cached, get_general_prompt_cached, get_system_prompt_cached
+from database.async_database import run_db
 from sqlalchemy.orm import Session
 
-def generate_llm_response(
+@timed("generate_response")
+async def generate_llm_response(
     user_query: str,
     search_results: list,
     history: list = None,
@@ -21,14 +26,21 @@ def generate_llm_response(
     customer_id: str = None,
     api_key: str = None,
     is_sale: bool = False,
+    on_token: Optional[Callable[[str], Awaitable[None]]] = None,
 ) -> str:
     """
     Tạo prompt và gọi đến LLM để sinh câu trả lời.
+    Câu trả lời được cache theo customer_id + câu hỏi đã chuẩn hóa + context sản phẩm/FAQ + system prompt,
+    nên các câu hỏi lặp lại với cùng dữ liệu sẽ không tốn thêm lệnh gọi LLM. Câu hỏi được cache (is_cacheable_query)
+    được trả lời không kèm lịch sử hội thoại; câu tham chiếu tới hội thoại trước thì kèm lịch sử và không cache.
+    Nếu truyền on_token (và không yêu cầu ảnh), câu trả lời được stream từ LLM và từng đoạn văn bản
+    được gửi qua on_token ngay khi nhận được.
     """
+    stream_tokens = on_token is not None and not wants_images
     # Tìm kiếm FAQ trước
     faq_context = ""
     if customer_id:
-        faq_results = search_faqs(customer_id=customer_id, query=user_query)
+        faq_results = await search_faqs(customer_id=customer_id, query=user_query)
         
         if faq_results:
             found_faq = faq_results[0]
@@ -57,13 +69,16 @@ Câu trả lời có sẵn (chỉ trả lời theo câu này nếu bạn thấy
     if faq_context:
         context += faq_context
     
-    if has_history:
+    use_cache = is_cacheable_query(user_query)
+    if has_history and not use_cache:
         context += f"Lịch sử hội thoại gần đây:\n{format_history_text(history)}\n"
+    elif has_history:
+        context += "Lịch sử hội thoại gần đây:\n(Đã lược bỏ, câu hỏi không phụ thuộc vào các tin nhắn trước)\n"
     else:
         context += "Lịch sử hội thoại gần đây:\n(Đây là tin nhắn đầu tiên)\n"
 
-    if needs_product_search:
-        context += _build_product_context(search_results, include_specs, is_sale)
+    product_context = _build_product_context(search_results, include_specs, is_sale) if needs_product_search else ""
+    context += product_context
 
     product_infos = [
         f"{p.get('product_name', '')} ({p.get('properties', '')})"
@@ -72,9 +87,27 @@ Câu trả lời có sẵn (chỉ trả lời theo câu này nếu bạn thấy
 
     store_info_dict = None
     if db and customer_id:
-        store_info_dict = get_customer_store_info(db, customer_id)
-
-    prompt = _build_prompt(user_query, context, needs_product_search, wants_images, product_infos, has_history, is_image_search, store_info_dict, db, customer_id, bool(faq_context))
+        store_info_dict = await run_db(db, get_store_info_cached, customer_id)
+
+    system_prompt_general_content = await run_db(db, get_general_prompt_cached)
+    system_prompt_content = await run_db(db, get_system_prompt_cached, customer_id)
+
+    cache_key = make_response_cache_key(
+        customer_id, user_query, product_context, faq_context,
+        (system_prompt_general_content, system_prompt_content, store_info_dict),
+        (model_choice, needs_product_search, wants_images, include_specs, is_image_search, is_sale, has_history),
+    ) if use_cache else None
+    cached_response = get_cached_response(cache_key)
+    if cached_response is not None:
+        if stream_tokens:
+            await on_token(cached_response)
+        return cached_response
+
+    prompt = _build_prompt(
+        user_query, context, needs_product_search, wants_images, product_infos, has_history, is_image_search,
+        store_info_dict, db, customer_id, bool(faq_context),
+        system_prompt_general_content=system_prompt_general_content, system_prompt_content=system_prompt_content,
+    )
 
     print("--- PROMPT GỬI ĐẾN LLM ---")
     print(prompt)
@@ -82,28 +115,18 @@ Câu trả lời có sẵn (chỉ trả lời theo câu này nếu bạn thấy
 
     llm_response = None
     try:
-        if model_choice == "gemini":
-            model = get_gemini_model(api_key=api_key)
-            if model:
-                response = model.generate_content(prompt, safety_settings={'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE'})
-                llm_response = response.text.strip()
-        elif model_choice == "lmstudio":
-            llm_response = get_lmstudio_response(prompt)
-        elif model_choice == "openai":
-            openai = get_openai_model(api_key=api_key)
-            if not openai:
-                return {"answer": "Không tìm thấy OpenAI API key.", "product_images": []} if wants_images else "Không tìm thấy OpenAI API key."
-            response = openai.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.5,
-                max_tokens=4000
-            )
-            llm_response = response.choices[0].message.content.strip()
-            usage = response.usage
-            print(f"📊 Prompt: {usage.prompt_tokens}, Completion: {usage.completion_tokens}, Total: {usage.total_tokens}")
-            cost = (usage.prompt_tokens * 0.15 + usage.completion_tokens * 0.6) / 1_000_000
-            print(f"💰 Estimated cost (GPT-4o-mini): ${cost:.6f}")
+        provider = get_llm_provider(model_choice, api_key=api_key)
+        if not provider and model_choice == "openai":
+            return {"answer": "Không tìm thấy OpenAI API key.", "product_images": []} if wants_images else "Không tìm thấy OpenAI API key."
+        if provider and stream_tokens:
+            chunks = []
+            async for chunk in provider.stream(prompt, safety_settings={'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE'}):
+                chunks.append(chunk)
+                await on_token(chunk)
+            llm_response = "".join(chunks).strip() or None
+        elif provider:
+            llm_response = await provider.generate(prompt, safety_settings={'HARM_CATEGORY_HARASSMENT': 'BLOCK_NONE'})
+            llm_response = llm_response.strip() if llm_response else None
 
     except Exception as e:
         print(f"Lỗi khi gọi LLM: {e}")
@@ -111,9 +134,12 @@ Câu trả lời có sẵn (chỉ trả lời theo câu này nếu bạn thấy
 
     if wants_images:
         answer, product_images = _parse_answer_and_images(llm_response, product_infos)
+        if llm_response:
+            set_cached_response(cache_key, {"answer": answer, "product_images": product_images})
         return {"answer": answer, "product_images": product_images}
     else:
         if llm_response:
+            set_cached_response(cache_key, llm_response)
             return llm_response
         return _get_fallback_response(search_results, needs_product_search)
 
@@ -173,9 +199,10 @@ def _build_product_context(search_results: List[Dict], include_specs: bool = Fal
     return product_context
 
 
-def _build_prompt(user_query: str, context: str, needs_product_search: bool, wants_images: bool = False, product_infos: list = None, has_history: bool = None, is_image_search: bool = False, store_info_dict: dict = None, db: Session = None, customer_id: str = None, has_faq_context: bool = False) -> str:
+def _build_prompt(user_query: str, context: str, needs_product_search: bool, wants_images: bool = False, product_infos: list = None, has_history: bool = None, is_image_search: bool = False, store_info_dict: dict = None, db: Session = None, customer_id: str = None, has_faq_context: bool = False, system_prompt_general_content: str = None, system_prompt_content: str = None) -> str:
     """
     Xây dựng prompt cho LLM với các quy tắc hội thoại nâng cao.
+    Nếu không truyền sẵn general prompt/prompt của customer thì sẽ đọc từ database.
     """
     image_instruction = ""
     if wants_images:
@@ -245,10 +272,10 @@ def _build_prompt(user_query: str, context: str, needs_product_search: bool, wan
 - **TUYỆT ĐỐI BỎ QUA** lịch sử trò chuyện cũ và không được liệt kê các sản phẩm khác không có trong dữ liệu tìm thấy.
 """
 
-    from database.database import get_or_create_system_prompt, get_or_create_general_prompt
-
-    system_prompt_general_content = get_or_create_general_prompt(db)
-    system_prompt_content = get_or_create_system_prompt(db, customer_id)
+    if system_prompt_general_content is None:
+        system_prompt_general_content = get_general_prompt_cached(db)
+    if system_prompt_content is None:
+        system_prompt_content = get_system_prompt_cached(db, customer_id)
 
     if not needs_product_search:
         return f"""## BỐI CẢNH ##
@@ -364,7 +391,8 @@ def _get_fallback_response(search_results: List[Dict], needs_product_search: boo
     else:
         return "Dạ, em xin lỗi, em không hiểu rõ câu hỏi của anh/chị. Anh/chị có thể hỏi lại không ạ?"
     
-def evaluate_and_choose_product(user_query: str, history_text: str, product_candidates: List[Dict], model_choice: str = "gemini", api_key: str = None) -> Dict:
+@timed("evaluate_product")
+async def evaluate_and_choose_product(user_query: str, history_text: str, product_candidates: List[Dict], model_choice: str = "gemini", api_key: str = None) -> Dict:
     """
     Sử dụng một lệnh gọi AI duy nhất để vừa đánh giá độ cụ thể của yêu cầu,
     vừa chọn ra sản phẩm phù hợp nhất nếu có thể.
@@ -380,6 +408,7 @@ def evaluate_and_choose_product(user_query: str, history_text: str, product_cand
         full_name = f"{name} ({props})" if props and str(props) != '0' else name
         prompt_list += f"{i}: {full_name}\n"
     print("Danh sách các sản phẩm trước khi đánh giá:\n", prompt_list)
+
     prompt = f"""
     Bạn là một AI chuyên phân tích và chọn lựa sản phẩm. Dựa vào yêu cầu của khách hàng và danh sách sản phẩm, hãy thực hiện các nhiệm vụ sau:
     1. Phân tích yêu cầu của khách và danh sách sản phẩm.
@@ -428,10 +457,10 @@ def evaluate_and_choose_product(user_query: str, history_text: str, product_cand
     """
 
     try:
-        model = get_gemini_model(api_key=api_key)
-        if model:
-            response = model.generate_content(prompt)
-            json_text = re.search(r'\{.*\}', response.text, re.DOTALL).group(0)
+        provider = get_llm_provider("gemini", api_key=api_key)
+        if provider:
+            response_text = await provider.generate(prompt)
+            json_text = re.search(r'\{.*\}', response_text, re.DOTALL).group(0)
             data = json.loads(json_text)
             
             request_type = data.get("type", "NO_MATCH").upper()
@@ -446,7 +475,7 @@ def evaluate_and_choose_product(user_query: str, history_text: str, product_cand
             print(f"AI đánh giá: {request_type}, score: {score}, chọn index: {index}, lý do: {reason}")
             
             if request_type in ["PERFECT_MATCH", "CLOSE_MATCH"] and product:
-                 return {'type': request_type, 'score': score, 'product': product, 'reason': reason}
+                return {'type': request_type, 'score': score, 'product': product, 'reason': reason}
 
             return {'type': 'NO_MATCH', 'score': 0.0, 'product': None, 'reason': None}
 
@@ -456,11 +485,16 @@ def evaluate_and_choose_product(user_query: str, history_text: str, product_cand
     # Fallback an toàn
     return {'type': 'NO_MATCH', 'score': 0.0, 'product': None, 'reason': None}
 
-def evaluate_purchase_confirmation(user_query: str, history_text: str, model_choice: str = "gemini", api_key: str = None) -> Dict:
+async def evaluate_purchase_confirmation(user_query: str, history_text: str, model_choice: str = "gemini", api_key: str = None) -> Dict:
     """
     Sử dụng AI để đánh giá phản hồi của khách hàng khi được hỏi xác nhận đơn hàng.
     Trả về một dictionary: {'decision': 'CONFIRM'/'CANCEL'/'UNCLEAR'}
+    Các câu trả lời ngắn rõ ràng ("ok", "chốt", "thôi"...) được phân loại bằng luật, không gọi LLM.
     """
+    fast_result = classify_purchase_confirmation_fast(user_query)
+    if accept_fast_path(fast_result):
+        print(f"⚡ Fast-path xác nhận đơn hàng: {fast_result['decision']}")
+        return {'decision': fast_result['decision']}
 
     prompt = f"""
     Bạn là một AI chuyên phân tích ý định của khách hàng trong ngữ cảnh mua bán.
@@ -485,13 +519,11 @@ def evaluate_purchase_confirmation(user_query: str, history_text: str, model_cho
     """
 
     try:
-        model = get_gemini_model(api_key=api_key)
-        if model:
-            from google.generativeai.types import GenerationConfig
-            generation_config = GenerationConfig(response_mime_type="application/json")
-            response = model.generate_content(prompt, generation_config=generation_config)
+        provider = get_llm_provider("gemini", api_key=api_key)
+        if provider:
+            response_text = await provider.generate(prompt, json_mode=True)
             
-            data = json.loads(response.text)
+            data = json.loads(response_text)
             decision = data.get("decision", "UNCLEAR").upper()
 
             if decision in ["CONFIRM", "CANCEL"]:
@@ -506,7 +538,8 @@ def evaluate_purchase_confirmation(user_query: str, history_text: str, model_cho
         print(f"Lỗi khi AI đánh giá xác nhận đơn hàng: {e}")
         return {'decision': 'UNCLEAR'}
 
-def filter_products_with_ai(user_query: str, history_text: str, product_candidates: List[Dict], api_key: str = None) -> List[Dict]:
+@timed("filter_products")
+async def filter_products_with_ai(user_query: str, history_text: str, product_candidates: List[Dict], api_key: str = None) -> List[Dict]:
     """
     Sử dụng AI để lọc và chọn ra những sản phẩm phù hợp nhất từ danh sách tìm kiếm.
     """
@@ -558,12 +591,10 @@ def filter_products_with_ai(user_query: str, history_text: str, product_candidat
     """
 
     try:
-        model = get_gemini_model(api_key=api_key)
-        if model:
-            from google.generativeai.types import GenerationConfig
-            generation_config = GenerationConfig(response_mime_type="application/json")
-            response = model.generate_content(prompt, generation_config=generation_config)
-            data = json.loads(response.text)
+        provider = get_llm_provider("gemini", api_key=api_key)
+        if provider:
+            response_text = await provider.generate(prompt, json_mode=True)
+            data = json.loads(response_text)
             
             indices = data.get("indices", [])
             if not isinstance(indices, list):
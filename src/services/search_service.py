@@ -1,31 +1,14 @@
-import os
-from elasticsearch import Elasticsearch
 from src.config.settings import PAGE_SIZE
 from typing import List, Dict, Any
 from src.utils.helpers import sanitize_for_es
+from dependencies import get_es_client
+from src.utils.metrics import timed
 
-ELASTIC_HOST = os.environ.get("ELASTIC_HOST", "http://localhost:9200")
 INDEX_NAME = "products_customer"
 FAQ_INDEX = "faqs"
 
-try:
-    es_client = Elasticsearch(hosts=[ELASTIC_HOST])
-    if not es_client.ping():
-        raise ConnectionError("Không thể kết nối đến Elasticsearch từ search_service.")
-except ConnectionError as e:
-    print(f"Lỗi kết nối trong search_service: {e}")
-    es_client = None
-
-def search_products(customer_id: str, product_name: str = None, category: str = None, properties: str = None, offset: int = 0, size: int = PAGE_SIZE, strict_properties: bool = False, strict_category: bool = False) -> List[Dict]:
-    if not customer_id:
-        print("Lỗi: customer_id là bắt buộc để tìm kiếm.")
-        return []
-        
-    if not product_name and not category and not properties:
-        return []
-
-    sanitized_customer_id = sanitize_for_es(customer_id)
-
+def _build_product_search_body(sanitized_customer_id: str, product_name: str = None, category: str = None, properties: str = None, offset: int = 0, size: int = PAGE_SIZE, strict_properties: bool = False, strict_category: bool = False) -> Dict:
+    """Xây dựng body truy vấn tìm kiếm sản phẩm, dùng chung cho search và msearch."""
     body = {
         "query": {
             "bool": {
@@ -96,8 +79,27 @@ def search_products(customer_id: str, product_name: str = None, category: str =
         else:
             body["query"]["bool"]["should"].append(prop_query)
 
+    return body
+
+@timed("search_products")
+async def search_products(customer_id: str, product_name: str = None, category: str = None, properties: str = None, offset: int = 0, size: int = PAGE_SIZE, strict_properties: bool = False, strict_category: bool = False) -> List[Dict]:
+    if not customer_id:
+        print("Lỗi: customer_id là bắt buộc để tìm kiếm.")
+        return []
+        
+    if not product_name and not category and not properties:
+        return []
+
+    sanitized_customer_id = sanitize_for_es(customer_id)
+    body = _build_product_search_body(sanitized_customer_id, product_name, category, properties, offset, size, strict_properties, strict_category)
+
+    es_client = get_es_client()
+    if not es_client:
+        print("Lỗi: Elasticsearch client chưa được khởi tạo.")
+        return []
+
     try:
-        response = es_client.search(
+        response = await es_client.search(
             index=INDEX_NAME,
             body=body,
             routing=sanitized_customer_id
@@ -109,7 +111,49 @@ def search_products(customer_id: str, product_name: str = None, category: str =
         print(f"Lỗi khi tìm kiếm cho customer '{customer_id}': {e}")
         return []
     
-def search_products_by_image(customer_id: str, image_embedding: list, top_k: int = 1, min_similarity: float = 0.97) -> list:
+@timed("msearch_products")
+async def msearch_products(customer_id: str, queries: List[Dict[str, Any]]) -> List[List[Dict]]:
+    """
+    Gửi nhiều truy vấn sản phẩm trong một request _msearch duy nhất.
+    Mỗi phần tử của queries chứa các tham số giống search_products (product_name, category, properties, offset, size, ...).
+    Trả về danh sách kết quả theo đúng thứ tự của queries; truy vấn lỗi hoặc rỗng trả về [].
+    """
+    if not customer_id:
+        print("Lỗi: customer_id là bắt buộc để tìm kiếm.")
+        return [[] for _ in queries]
+
+    sanitized_customer_id = sanitize_for_es(customer_id)
+    results: List[List[Dict]] = [[] for _ in queries]
+    searches = []
+    positions = []
+    for i, query in enumerate(queries):
+        if not query.get("product_name") and not query.get("category") and not query.get("properties"):
+            continue
+        searches.append({"index": INDEX_NAME, "routing": sanitized_customer_id})
+        searches.append(_build_product_search_body(sanitized_customer_id, **query))
+        positions.append(i)
+
+    if not searches:
+        return results
+
+    es_client = get_es_client()
+    if not es_client:
+        print("Lỗi: Elasticsearch client chưa được khởi tạo.")
+        return results
+
+    try:
+        response = await es_client.msearch(searches=searches)
+        for position, item in zip(positions, response['responses']):
+            if 'error' in item:
+                print(f"Lỗi trong msearch cho customer '{customer_id}': {item['error']}")
+                continue
+            results[position] = [hit['_source'] for hit in item['hits']['hits']]
+        print(f"msearch {len(positions)} truy vấn cho customer '{customer_id}': {[len(r) for r in results]} sản phẩm.")
+    except Exception as e:
+        print(f"Lỗi khi msearch cho customer '{customer_id}': {e}")
+    return results
+
+async def search_products_by_image(customer_id: str, image_embedding: list, top_k: int = 1, min_similarity: float = 0.97) -> list:
     """
     Thực hiện tìm kiếm k-Nearest Neighbor (kNN) trong Elasticsearch
     để tìm các sản phẩm có ảnh tương đồng nhất.
@@ -136,8 +180,12 @@ def search_products_by_image(customer_id: str, image_embedding: list, top_k: int
         }
     }
 
+    es_client = get_es_client()
+    if not es_client:
+        return []
+
     try:
-        response = es_client.search(
+        response = await es_client.search(
             index=INDEX_NAME,
             knn=knn_query,
             query=query,
@@ -156,20 +204,21 @@ def search_products_by_image(customer_id: str, image_embedding: list, top_k: int
         print(f"Lỗi khi tìm kiếm bằng vector cho customer '{customer_id}': {e}")
         return []
 
-def search_faqs(
+async def search_faqs(
     customer_id: str,
     query: str,
 ) -> List[Dict[str, Any]]:
     """
     Tìm kiếm câu hỏi tương tự trong index FAQ.
     """
+    es_client = get_es_client()
     if not es_client:
         return []
 
     sanitized_customer_id = sanitize_for_es(customer_id)
 
     try:
-        response = es_client.search(
+        response = await es_client.search(
             index=FAQ_INDEX,
             query={
                 "bool": {
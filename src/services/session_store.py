@@ -0,0 +1,348 @@
+import asyncio
+import copy
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from src.config.settings import (
+    SESSION_STORE_SIZE, SESSION_STORE_TTL, SESSION_STORE_VALIDATE, SESSION_WRITE_BEHIND_INTERVAL, SESSION_STATE_SOURCE, SESSION_DATA_PATCH_WRITES
+)
+from src.utils.cache import LRUCache
+from src.utils.metrics import timed
+from src.services.tenant_state import note_session_status
+from src.services.handover_scheduler import cancel_handover
+from database.database import (
+    SessionLocal, HANDOVER_STATUSES, get_session_control, get_session_control_version, create_or_update_session_control, append_chat_turn,
+    patch_session_control, diff_session_data, _make_json_safe
+)
+
+# Các trường của session_data được lưu thành cột riêng trong session_controls
+STATE_KEYS = ("state", "handover_timestamp")
+# db_updated_at chưa biết (vừa tự ghi xuống database)
+_UNKNOWN = object()
+
+class SessionState:
+    """Trạng thái session (status + session_data) được giữ trong bộ nhớ, kèm cờ dirty khi chưa ghi xuống database."""
+
+    def __init__(self, customer_id: str, session_id: str, status: str, session_data: Optional[dict]):
+        self.customer_id = customer_id
+        self.session_id = session_id
+        self.status = status
+        self.session_data = session_data
+        self.dirty = False
+        self.version = 0
+        # session_data đang nằm trong cột JSON của database (None nếu chưa biết)
+        self.persisted_data = None
+        # status/updated_at của dòng trong database lúc đọc hoặc ghi gần nhất, để phát hiện thay đổi từ worker khác
+        # (db_updated_at là _UNKNOWN khi vừa tự ghi, lần kiểm tra sau sẽ ghi nhận giá trị trong database)
+        self.db_status = None
+        self.db_updated_at = _UNKNOWN
+
+# Session dirty bị loại khỏi cache (đầy/hết hạn) đang chờ ghi. Không ghi ngay trong on_evict vì callback chạy
+# bên trong LRUCache.get/set khi đang giữ _lock trên event loop; load_session lấy lại từ đây nếu chưa kịp ghi.
+_evicted: "OrderedDict[tuple, SessionState]" = OrderedDict()
+_main_loop: Optional[asyncio.AbstractEventLoop] = None
+_background_tasks: set = set()
+
+def _queue_evicted(key, state: SessionState):
+    if state.dirty:
+        with _lock:
+            _evicted[key] = state
+        _schedule_evicted_flush()
+
+def _schedule_evicted_flush():
+    """Ghi các session bị loại trong thread riêng; chế độ write-behind thì để tác vụ nền ghi ở chu kỳ tiếp theo."""
+    if SESSION_WRITE_BEHIND_INTERVAL > 0:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    if loop is not None:
+        task = loop.create_task(asyncio.to_thread(flush_evicted_sessions))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    elif _main_loop is not None and not _main_loop.is_closed():
+        # Bị loại từ một thread (vd. handover timeout chạy qua asyncio.to_thread): nhờ event loop chính lên lịch ghi
+        _main_loop.call_soon_threadsafe(_schedule_evicted_flush)
+
+# Key: (customer_id, session_id). Mỗi process có cache riêng: thay đổi từ worker khác được phát hiện qua
+# SESSION_STORE_VALIDATE, thay đổi từ endpoint quản trị trong cùng process gọi invalidate_session.
+_sessions = LRUCache(maxsize=SESSION_STORE_SIZE, ttl=SESSION_STORE_TTL, on_evict=_queue_evicted)
+_lock = threading.RLock()
+_write_behind_task: Optional[asyncio.Task] = None
+
+def _snapshot(state: SessionState) -> tuple:
+    with _lock:
+        session_data = copy.deepcopy(state.session_data) if state.session_data is not None else None
+        return state.version, state.status, session_data
+
+def _mark_clean(state: SessionState, version: int, status: str, written_data: Optional[dict] = None):
+    with _lock:
+        if written_data is not None:
+            state.persisted_data = written_data
+        state.db_status = status
+        state.db_updated_at = _UNKNOWN
+        # Chỉ xóa cờ dirty nếu không có thay đổi mới trong lúc đang ghi
+        if state.version == version:
+            state.dirty = False
+
+def _without_state_keys(session_data: Optional[dict]) -> dict:
+    return {key: value for key, value in (session_data or {}).items() if key not in STATE_KEYS}
+
+def _json_to_write(state: SessionState, session_data: Optional[dict]) -> Optional[dict]:
+    """
+    Trả về session_data dạng JSON nếu cần ghi lại cột session_data, None nếu chỉ cần cập nhật cột state/handover_timestamp
+    (chế độ "columns" và không có trường nào khác thay đổi so với bản đã ghi).
+    """
+    if session_data is None:
+        return None
+    json_data = _make_json_safe(session_data)
+    if SESSION_STATE_SOURCE == "columns" and state.persisted_data is not None:
+        if _without_state_keys(json_data) == _without_state_keys(state.persisted_data):
+            return None
+    return json_data
+
+def _patch_for(state: SessionState, session_data: Optional[dict], json_data: Optional[dict]) -> Optional[dict]:
+    """Patch JSONB so với bản đã ghi, None nếu phải ghi đầy đủ (tắt patch hoặc chưa biết nội dung trong database)."""
+    if not SESSION_DATA_PATCH_WRITES or session_data is None or state.persisted_data is None:
+        return None
+    if json_data is None:
+        # Chế độ "columns" và chỉ state/handover_timestamp thay đổi: không đụng tới session_data
+        return {"set": {}, "append": {}, "remove": []}
+    return diff_session_data(state.persisted_data, json_data)
+
+@timed("db_write_session")
+def _write(db, state: SessionState):
+    version, status, session_data = _snapshot(state)
+    json_data = _json_to_write(state, session_data)
+    patch = _patch_for(state, session_data, json_data)
+    if patch is None or not patch_session_control(db, state.customer_id, state.session_id, status, patch, session_data):
+        create_or_update_session_control(
+            db, state.customer_id, state.session_id, status=status,
+            session_data=session_data, write_json=session_data is None or json_data is not None
+        )
+    _mark_clean(state, version, status, json_data)
+
+def _session_data_from_row(session_control) -> Optional[dict]:
+    """session_data của một dòng session_controls; chế độ "columns" lấy state/handover_timestamp từ cột."""
+    session_data = copy.deepcopy(session_control.session_data)
+    if SESSION_STATE_SOURCE == "columns":
+        session_data = session_data or {}
+        session_data["state"] = session_control.state
+        if session_control.handover_timestamp is not None:
+            session_data["handover_timestamp"] = session_control.handover_timestamp
+    return session_data
+
+def _is_current(db, state: SessionState) -> bool:
+    """So bản cache với (status, updated_at) trong database; False nếu worker/process khác đã ghi đè session."""
+    row = get_session_control_version(db, state.customer_id, state.session_id)
+    if row is None:
+        # Chưa có trong database: chỉ hợp lệ nếu đây là session mới chưa được ghi
+        return state.db_status is None
+    if row.status != state.db_status:
+        return False
+    with _lock:
+        if state.db_updated_at is _UNKNOWN:
+            state.db_updated_at = row.updated_at
+            return True
+        return row.updated_at == state.db_updated_at
+
+def load_session(db, customer_id: str, session_id: str) -> Optional[SessionState]:
+    """
+    Trả về bản sao trạng thái session (status, session_data) từ cache, hoặc đọc từ database nếu chưa có.
+    Trả về None nếu session chưa tồn tại. Mỗi lượt chat làm việc trên bản sao riêng của session_data.
+    Với SESSION_STORE_VALIDATE, bản cache bị worker khác ghi đè (vd. admin chuyển sang human_chatting/stopped)
+    được bỏ đi và đọc lại, kể cả khi đang có thay đổi chưa ghi: thay đổi từ database được ưu tiên.
+    """
+    key = (customer_id, session_id)
+    with _lock:
+        state = _sessions.get(key)
+        if state is None and key in _evicted:
+            # Bị loại khỏi cache nhưng chưa kịp ghi: dùng lại bản trong bộ nhớ thay vì đọc bản cũ từ database
+            state = _evicted.pop(key)
+            _sessions.set(key, state)
+    if state is not None and SESSION_STORE_VALIDATE and not _is_current(db, state):
+        print(f"🔄 Session {customer_id}-{session_id} đã được thay đổi ở worker khác, đọc lại từ database")
+        with _lock:
+            if _sessions.peek(key) is state:
+                _sessions.pop(key)
+        state = None
+    if state is None:
+        # Đọc database ngoài _lock: với AsyncSession (run_sync) truy vấn nhường event loop cho lượt chat khác,
+        # các lượt đó chạy cùng thread nên RLock không chặn được chúng
+        session_control = get_session_control(db, customer_id, session_id)
+        if not session_control:
+            return None
+        loaded = SessionState(customer_id, session_id, session_control.status, _session_data_from_row(session_control))
+        loaded.persisted_data = copy.deepcopy(session_control.session_data)
+        loaded.db_status = session_control.status
+        loaded.db_updated_at = session_control.updated_at
+        with _lock:
+            # Lượt chat khác đã nạp hoặc ghi session trong lúc đang đọc: giữ bản trong cache
+            state = _sessions.peek(key)
+            if state is None:
+                state = loaded
+                _sessions.set(key, state)
+    with _lock:
+        snapshot = SessionState(customer_id, session_id, state.status, copy.deepcopy(state.session_data))
+    return snapshot
+
+def stage_session(customer_id: str, session_id: str, status: str, session_data: dict = None):
+    """
+    Ghi nhận status/session_data mới vào cache và đánh dấu dirty, chưa ghi xuống database.
+    Giống create_or_update_session_control: session_data None thì giữ nguyên dữ liệu cũ.
+    """
+    key = (customer_id, session_id)
+    with _lock:
+        state = _sessions.peek(key)
+        old_status = state.status if state is not None else None
+        if state is None:
+            state = SessionState(customer_id, session_id, status, None)
+        state.status = status
+        if session_data is not None:
+            state.session_data = copy.deepcopy(session_data)
+        state.dirty = True
+        state.version += 1
+        _sessions.set(key, state)
+    note_session_status(customer_id, old_status, status)
+
+def flush_session(db, customer_id: str, session_id: str, force: bool = False):
+    """
+    Ghi session xuống database (một lần UPDATE/INSERT) nếu có thay đổi.
+    Khi bật write-behind (SESSION_WRITE_BEHIND_INTERVAL > 0) thì để tác vụ nền ghi, trừ khi force=True.
+    """
+    if SESSION_WRITE_BEHIND_INTERVAL > 0 and not force:
+        return
+    state = _sessions.peek((customer_id, session_id))
+    if state is not None and state.dirty:
+        _write(db, state)
+
+@timed("db_write_turn")
+def persist_turn(db, customer_id: str, session_id: str, user_message: str, bot_message: str) -> list:
+    """
+    Ghi tin nhắn của lượt chat cùng trạng thái session đang chờ trong một transaction (append_chat_turn).
+    Khi bật write-behind thì chỉ ghi tin nhắn, trạng thái session để tác vụ nền ghi.
+    Trả về id các tin nhắn đã chèn.
+    """
+    state = _sessions.peek((customer_id, session_id))
+    if state is None or not state.dirty or SESSION_WRITE_BEHIND_INTERVAL > 0:
+        return append_chat_turn(db, customer_id, session_id, user_message, bot_message)
+    version, status, session_data = _snapshot(state)
+    json_data = _json_to_write(state, session_data)
+    message_ids = append_chat_turn(
+        db, customer_id, session_id, user_message, bot_message, status=status,
+        session_data=session_data, write_json=session_data is None or json_data is not None,
+        session_data_patch=_patch_for(state, session_data, json_data)
+    )
+    _mark_clean(state, version, status, json_data)
+    return message_ids
+
+def flush_evicted_sessions(db=None) -> int:
+    """Ghi các session dirty đã bị loại khỏi cache; trả về số session đã ghi."""
+    own_db = db is None
+    db = db or SessionLocal()
+    flushed = 0
+    try:
+        with _lock:
+            pending = list(_evicted.items())
+        for key, state in pending:
+            try:
+                if state.dirty:
+                    _write(db, state)
+                    flushed += 1
+            except Exception as e:
+                db.rollback()
+                print(f"❌ Lỗi khi ghi session bị loại khỏi cache {key}: {e}")
+                continue
+            with _lock:
+                # Chỉ bỏ khỏi hàng chờ nếu load_session chưa lấy lại session này
+                if _evicted.get(key) is state:
+                    del _evicted[key]
+    finally:
+        if own_db:
+            db.close()
+    return flushed
+
+def flush_dirty_sessions(db=None) -> int:
+    """Ghi tất cả session dirty (trong cache và đã bị loại chờ ghi) xuống database, trả về số session đã ghi."""
+    own_db = db is None
+    db = db or SessionLocal()
+    flushed = 0
+    try:
+        flushed += flush_evicted_sessions(db)
+        for key in _sessions.keys():
+            state = _sessions.peek(key)
+            if state is not None and state.dirty:
+                try:
+                    _write(db, state)
+                    flushed += 1
+                except Exception as e:
+                    db.rollback()
+                    print(f"❌ Lỗi khi ghi session {key}: {e}")
+    finally:
+        if own_db:
+            db.close()
+    return flushed
+
+def invalidate_session(customer_id: str, session_id: str = None):
+    """Xóa session khỏi cache (không ghi) sau khi endpoint quản trị thay đổi trực tiếp trong database."""
+    with _lock:
+        if session_id is None:
+            _sessions.invalidate_where(lambda key: key[0] == customer_id)
+        else:
+            _sessions.pop((customer_id, session_id))
+
+def set_session_status(db, customer_id: str, session_id: str, status: str):
+    """
+    Dùng cho endpoint quản trị: ghi các thay đổi đang chờ, cập nhật status trong database rồi làm mới cache.
+    Chuyển sang status ngoài HANDOVER_STATUSES thì hủy hẹn giờ handover và xóa state/handover_timestamp của handover cũ,
+    để bộ hẹn giờ (kể cả ở worker khác khi đồng bộ lại) không tự kích hoạt lại bot đè lên quyết định của admin.
+    """
+    flush_session(db, customer_id, session_id, force=True)
+    previous = load_session(db, customer_id, session_id)
+    session_data = None
+    if status not in HANDOVER_STATUSES:
+        cancel_handover(customer_id, session_id)
+        if previous and previous.session_data and previous.session_data.get("state") in HANDOVER_STATUSES:
+            session_data = previous.session_data
+            session_data["state"] = "stop_bot" if status == "stopped" else None
+            session_data.pop("handover_timestamp", None)
+    result = create_or_update_session_control(db, customer_id, session_id, status, session_data=session_data)
+    invalidate_session(customer_id, session_id)
+    note_session_status(customer_id, previous.status if previous else None, status)
+    return result
+
+async def _write_behind_loop():
+    while True:
+        await asyncio.sleep(SESSION_WRITE_BEHIND_INTERVAL)
+        try:
+            flushed = await asyncio.to_thread(flush_dirty_sessions)
+            if flushed:
+                print(f"💾 Write-behind: đã ghi {flushed} session xuống database")
+        except Exception as e:
+            print(f"❌ Lỗi trong tác vụ write-behind session: {e}")
+
+def start_write_behind():
+    """Khởi động tác vụ nền ghi session định kỳ (chỉ khi SESSION_WRITE_BEHIND_INTERVAL > 0)."""
+    global _write_behind_task, _main_loop
+    _main_loop = asyncio.get_running_loop()
+    if SESSION_WRITE_BEHIND_INTERVAL > 0 and _write_behind_task is None:
+        _write_behind_task = asyncio.create_task(_write_behind_loop())
+        print(f"Đã khởi động write-behind session mỗi {SESSION_WRITE_BEHIND_INTERVAL}s.")
+
+async def stop_write_behind():
+    """Dừng tác vụ nền và ghi nốt các session còn dirty."""
+    global _write_behind_task
+    if _write_behind_task is not None:
+        _write_behind_task.cancel()
+        _write_behind_task = None
+    await asyncio.to_thread(flush_dirty_sessions)
+
+def get_session_store_stats() -> dict:
+    stats = _sessions.stats()
+    stats["dirty"] = sum(1 for key in _sessions.keys() if getattr(_sessions.peek(key), "dirty", False))
+    stats["evicted_pending"] = len(_evicted)
+    stats["validate"] = SESSION_STORE_VALIDATE
+    stats["write_behind_interval"] = SESSION_WRITE_BEHIND_INTERVAL
+    return stats
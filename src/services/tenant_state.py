@@ -0,0 +1,100 @@
+import threading
+from typing import Optional
+
+from src.config.settings import TENANT_CACHE_SIZE, TENANT_CACHE_TTL
+from src.utils.cache import LRUCache
+from database.database import is_bot_active, get_customer_sale_info, count_session_controls_by_status
+
+class TenantControl:
+    """Trạng thái điều khiển của một customer (cửa hàng) được giữ trong bộ nhớ để kiểm tra mỗi lượt chat không cần truy vấn."""
+
+    def __init__(self, customer_id: str, bot_active: bool, sale_thread_id: Optional[str], is_sale: bool,
+                 total_sessions: int, stopped_sessions: int):
+        self.customer_id = customer_id
+        self.bot_active = bot_active
+        # customer_is_sale chỉ có một bản ghi cho mỗi customer_id
+        self.sale_thread_id = sale_thread_id
+        self.is_sale = is_sale
+        self.total_sessions = total_sessions
+        self.stopped_sessions = stopped_sessions
+
+    def is_sale_thread(self, thread_id: str) -> bool:
+        return self.is_sale and thread_id == self.sale_thread_id
+
+    def all_sessions_stopped(self) -> bool:
+        return self.total_sessions > 0 and self.stopped_sessions >= self.total_sessions
+
+# Chỉ có hiệu lực trong một process; các thay đổi ở process khác được cập nhật khi hết TTL.
+_tenants = LRUCache(maxsize=TENANT_CACHE_SIZE, ttl=TENANT_CACHE_TTL)
+_lock = threading.RLock()
+
+def _load_tenant(db, customer_id: str) -> TenantControl:
+    sale_info = get_customer_sale_info(db, customer_id)
+    total_sessions, stopped_sessions = count_session_controls_by_status(db, customer_id)
+    return TenantControl(
+        customer_id,
+        bot_active=is_bot_active(db, customer_id),
+        sale_thread_id=sale_info.thread_id if sale_info else None,
+        is_sale=bool(sale_info and sale_info.is_sale),
+        total_sessions=total_sessions,
+        stopped_sessions=stopped_sessions
+    )
+
+def get_tenant(db, customer_id: str) -> TenantControl:
+    """Trả về trạng thái của customer từ cache, đọc database (3 truy vấn nhỏ) khi chưa có hoặc hết hạn."""
+    tenant = _tenants.get(customer_id)
+    if tenant is None:
+        tenant = _load_tenant(db, customer_id)
+        _tenants.set(customer_id, tenant)
+    return tenant
+
+def is_tenant_bot_active(db, customer_id: str) -> bool:
+    return get_tenant(db, customer_id).bot_active
+
+def is_sale_thread(db, customer_id: str, thread_id: str) -> bool:
+    if not thread_id:
+        return False
+    return get_tenant(db, customer_id).is_sale_thread(thread_id)
+
+def get_tenant_bot_status(db, customer_id: str) -> str:
+    """'stopped' nếu customer có session và tất cả đều bị dừng, 'active' nếu ngược lại."""
+    return "stopped" if get_tenant(db, customer_id).all_sessions_stopped() else "active"
+
+def set_tenant_bot_active(customer_id: str, active: bool):
+    """Gọi sau khi bật/tắt bot cho customer trong database."""
+    with _lock:
+        tenant = _tenants.peek(customer_id)
+        if tenant is not None:
+            tenant.bot_active = active
+
+def set_tenant_sale(customer_id: str, thread_id: str, is_sale: bool):
+    """Gọi sau khi cập nhật customer_is_sale trong database."""
+    with _lock:
+        tenant = _tenants.peek(customer_id)
+        if tenant is not None:
+            tenant.sale_thread_id = thread_id
+            tenant.is_sale = is_sale
+
+def note_session_status(customer_id: str, old_status: Optional[str], new_status: str):
+    """Cập nhật bộ đếm session khi một session đổi trạng thái (old_status None: session mới)."""
+    if old_status == new_status:
+        return
+    with _lock:
+        tenant = _tenants.peek(customer_id)
+        if tenant is None:
+            return
+        if old_status is None:
+            tenant.total_sessions += 1
+        elif old_status == "stopped":
+            tenant.stopped_sessions = max(0, tenant.stopped_sessions - 1)
+        if new_status == "stopped":
+            tenant.stopped_sessions += 1
+
+def invalidate_tenant(customer_id: str = None):
+    if customer_id is None:
+        _tenants.clear()
+    else:
+        _tenants.pop(customer_id)
+
+def get_tenant_cache_stats() -> dict:
+    return _tenants.stats()
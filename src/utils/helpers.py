@@ -1,12 +1,15 @@
-from typing import List
+import hashlib
 import json
 import re
-from typing import List
+import unicodedata
+from typing import Iterable, List
 
-from src.services.llm_service import get_gemini_model
+from src.services.llm_service import get_llm_provider
+from src.utils.metrics import timed
 
 
-def is_asking_for_more(user_query: str, history_text: str, api_key: str = None) -> bool:
+@timed("asking_for_more")
+async def is_asking_for_more(user_query: str, history_text: str, api_key: str = None) -> bool:
     """
     Sử dụng AI để xác định xem người dùng có muốn xem thêm sản phẩm hay không,
     phân biệt với việc hỏi về tồn kho.
@@ -51,13 +54,11 @@ def is_asking_for_more(user_query: str, history_text: str, api_key: str = None)
     """
 
     try:
-        model = get_gemini_model(api_key=api_key)
-        if model:
-            from google.generativeai.types import GenerationConfig
-            generation_config = GenerationConfig(response_mime_type="application/json")
-            response = model.generate_content(prompt, generation_config=generation_config)
+        provider = get_llm_provider("gemini", api_key=api_key)
+        if provider:
+            response_text = await provider.generate(prompt, json_mode=True)
             
-            data = json.loads(response.text)
+            data = json.loads(response_text)
             intent = data.get("intent", "OTHER").upper()
             
             print(f"AI đánh giá ý định 'xem thêm': {intent}")
@@ -78,6 +79,12 @@ def is_general_query(user_query: str) -> bool:
     ]
     return any(kw in user_query.lower() for kw in general_queries)
 
+def normalize_query(user_query: str) -> str:
+    """Chuẩn hóa câu hỏi để so khớp: chuẩn Unicode NFC, chữ thường, bỏ dấu câu và khoảng trắng thừa."""
+    text = unicodedata.normalize("NFC", user_query or "").lower()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
 def format_history_text(history: List[dict], limit: int = 10) -> str:
     """Format lịch sử hội thoại thành text."""
     if not history:
@@ -90,4 +97,35 @@ def format_history_text(history: List[dict], limit: int = 10) -> str:
 
 def sanitize_for_es(text: str) -> str:
     """Làm sạch text để sử dụng trong Elasticsearch."""
-    return text.replace("-", "")
\ No newline at end of file
+    return text.replace("-", "")
+
+def hash_product_key(product_key: str) -> int:
+    """Hash 64-bit (blake2b) của key sản phẩm, dùng để lưu danh sách sản phẩm đã hiển thị gọn hơn chuỗi gốc."""
+    return int.from_bytes(hashlib.blake2b(product_key.encode("utf-8"), digest_size=8).digest(), "big")
+
+def get_shown_product_hashes(session_data: dict) -> set:
+    """
+    Tập hash các sản phẩm đã hiển thị trong session (kiểm tra thuộc tập O(1)).
+    Session cũ lưu key dạng chuỗi "product_name::properties" sẽ được hash lại.
+    """
+    return {
+        hash_product_key(key) if isinstance(key, str) else key
+        for key in session_data.get("shown_product_keys") or []
+    }
+
+def add_shown_product_keys(session_data: dict, product_keys: Iterable[str], max_keys: int):
+    """
+    Thêm các sản phẩm vừa hiển thị vào session_data["shown_product_keys"] (list hash, giữ thứ tự, không trùng).
+    Khi vượt max_keys thì bỏ các sản phẩm cũ nhất.
+    """
+    shown = [
+        hash_product_key(key) if isinstance(key, str) else key
+        for key in session_data.get("shown_product_keys") or []
+    ]
+    seen = set(shown)
+    for product_key in product_keys:
+        key_hash = hash_product_key(product_key)
+        if key_hash not in seen:
+            seen.add(key_hash)
+            shown.append(key_hash)
+    session_data["shown_product_keys"] = shown[-max_keys:] if max_keys > 0 else shown
@@ -0,0 +1,110 @@
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, Histogram, generate_latest
+from prometheus_client.core import REGISTRY, GaugeMetricFamily
+
+from src.config.settings import METRICS_ENABLED, METRICS_CUSTOMER_LABEL
+
+# Bucket (giây) trải từ truy vấn database vài ms tới lệnh gọi LLM vài chục giây
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0)
+
+STAGE_SECONDS = Histogram(
+    "chatbot_stage_duration_seconds", "Thời gian của từng bước trong lượt chat",
+    ["stage", "customer_id", "model_choice"], buckets=_BUCKETS
+)
+TURN_SECONDS = Histogram(
+    "chatbot_turn_duration_seconds", "Thời gian xử lý cả lượt chat",
+    ["customer_id", "model_choice"], buckets=_BUCKETS
+)
+
+# Nhãn [customer_id, model_choice] của lượt chat đang xử lý; các bước chạy ngoài lượt chat (write-behind...) mang nhãn "none"
+_labels: ContextVar[Optional[List[str]]] = ContextVar("metric_labels", default=None)
+_NO_LABELS = ("none", "none")
+# model_choice là field tự do của form: chỉ các provider đã biết được làm nhãn, còn lại gộp thành "other"
+_KNOWN_MODELS = ("gemini", "openai", "lmstudio")
+
+def _model_label(model_choice: Optional[str]) -> str:
+    model_choice = model_choice or "gemini"
+    return model_choice if model_choice in _KNOWN_MODELS else "other"
+
+@contextmanager
+def turn_metrics(model_choice: str):
+    """
+    Đo thời gian cả lượt chat. Nhãn customer_id là "none" cho tới khi lượt chat gọi bind_turn_customer
+    (sau khi đã kiểm tra tenant), để customer_id tuỳ ý trên URL không sinh thêm histogram.
+    """
+    labels = ["none", _model_label(model_choice)]
+    token = _labels.set(labels)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if METRICS_ENABLED:
+            TURN_SECONDS.labels(*labels).observe(time.perf_counter() - start)
+        _labels.reset(token)
+
+def bind_turn_customer(customer_id: str):
+    """Gắn nhãn customer_id cho lượt chat hiện tại (chỉ gọi sau khi customer đã qua kiểm tra)."""
+    labels = _labels.get()
+    if labels is not None:
+        labels[0] = customer_id if METRICS_CUSTOMER_LABEL else "all"
+
+@contextmanager
+def span(stage: str):
+    """Đo thời gian một bước (kể cả khi bước đó ném exception) vào chatbot_stage_duration_seconds."""
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        customer_id, model_choice = _labels.get() or _NO_LABELS
+        STAGE_SECONDS.labels(stage, customer_id, model_choice).observe(time.perf_counter() - start)
+
+def timed(stage: str) -> Callable:
+    """Decorator bọc span(stage) quanh hàm đồng bộ hoặc async."""
+    def decorator(func: Callable) -> Callable:
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Thống kê của các cache/bộ hẹn giờ trong process, đọc lại mỗi lần Prometheus scrape: {component: hàm trả về dict}
+_stats_sources: Dict[str, Callable[[], dict]] = {}
+
+def register_stats(component: str, get_stats: Callable[[], dict]):
+    """Xuất các giá trị số trong get_stats() thành gauge chatbot_component_stat{component, stat} trên /metrics."""
+    _stats_sources[component] = get_stats
+
+class _StatsCollector:
+    def collect(self):
+        gauge = GaugeMetricFamily(
+            "chatbot_component_stat", "Thống kê cache/bộ hẹn giờ trong process (size, hits, misses, evictions...)",
+            labels=["component", "stat"]
+        )
+        for component, get_stats in list(_stats_sources.items()):
+            for stat, value in get_stats().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    gauge.add_metric([component, stat], value)
+        yield gauge
+
+REGISTRY.register(_StatsCollector())
+
+def render_metrics() -> Tuple[bytes, str]:
+    """Nội dung cho endpoint /metrics theo định dạng text của Prometheus."""
+    return generate_latest(), CONTENT_TYPE_LATEST